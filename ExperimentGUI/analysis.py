@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Collect session CSV files into a columnar store and summarise reaction times"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import json
+import locale
+import numpy as np
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+COLUMNS: Dict[str, Tuple[str, str]] = {
+    'cycle start [ISO 8601]': ('start', 'datetime64[us]'),
+    'participant anonymous name': ('participant', 'U16'),
+    'participant gender': ('gender', 'U24'),
+    'participant age': ('age', 'i2'),
+    'participant smokes': ('smokes', 'U24'),
+    'scent 1': ('scent1', 'U32'),
+    'scent 2': ('scent2', 'U32'),
+    'turn on 1 [s]': ('on_wait', 'f4'),
+    'on reaction [s]': ('on_reaction', 'f4'),
+    'switch [s]': ('sw_wait', 'f4'),
+    'switch reaction [s]': ('sw_reaction', 'f4'),
+    'turn off [s]': ('off_wait', 'f4'),
+    'turn off reaction [s]': ('off_reaction', 'f4'),
+    'turn on sent [s]': ('on_sent', 'f4'),
+    'turn on acknowledged [s]': ('on_acknowledged', 'f4'),
+    'on click [s]': ('on_click', 'f4'),
+    'switch sent [s]': ('sw_sent', 'f4'),
+    'switch acknowledged [s]': ('sw_acknowledged', 'f4'),
+    'switch click [s]': ('sw_click', 'f4'),
+    'turn off sent [s]': ('off_sent', 'f4'),
+    'turn off acknowledged [s]': ('off_acknowledged', 'f4'),
+    'turn off click [s]': ('off_click', 'f4'),
+    'loop lag max [s]': ('loop_lag_max', 'f4'),
+    'loop jitter [s]': ('loop_jitter', 'f4'),
+    'input latency max [s]': ('input_latency_max', 'f4'),
+    'timer lateness max [s]': ('timer_late_max', 'f4'),
+    'turn on scheduled [s]': ('on_scheduled', 'f4'),
+    'switch scheduled [s]': ('sw_scheduled', 'f4'),
+    'turn off scheduled [s]': ('off_scheduled', 'f4'),
+}
+"""`Cycle.csv_header()` labels and their field in the store, missing columns are NaN"""
+
+DTYPE = np.dtype([(name, dtype) for name, dtype in COLUMNS.values()])
+
+MEASURES = {
+    'on_reaction': 'scent1',
+    'sw_reaction': 'scent2',
+    'off_reaction': 'scent2',
+}
+"""Reactions and the scent they respond to"""
+
+
+def decimal_point(locale_name: str) -> str:
+    """Decimal separator `Cycle.to_csv()` used under `locale_name`"""
+    saved = locale.setlocale(locale.LC_NUMERIC)
+    try:
+        locale.setlocale(locale.LC_NUMERIC, locale_name)
+        return locale.localeconv()['decimal_point']  # type: ignore
+    except locale.Error:
+        # locale not installed here, numbers have no grouping so guess from the data
+        return ''
+    finally:
+        locale.setlocale(locale.LC_NUMERIC, saved)
+
+
+def read_session(path: str, decimal: str = '') -> np.ndarray:
+    """Parse one session CSV, `decimal` is sniffed from the numbers when empty"""
+    with open(path, encoding='utf-8') as file:
+        lines = file.read().splitlines()
+    if not lines:
+        return np.zeros(0, DTYPE)
+    header = [label.strip('"') for label in lines[0].split(';')]
+    rows = [line.split(';') for line in lines[1:] if line.count(';') == len(header) - 1]
+    data = np.zeros(len(rows), DTYPE)
+    for name, dtype in COLUMNS.values():
+        if dtype == 'f4':
+            data[name] = np.nan
+    if not rows:
+        return data
+    columns = list(zip(*rows))
+    for label, values in zip(header, columns):
+        if label not in COLUMNS:
+            continue
+        name, dtype = COLUMNS[label]
+        if dtype[0] == 'U':
+            data[name] = [value.strip('"') for value in values]
+        elif dtype == 'f4':
+            if not decimal:
+                decimal = ',' if any(',' in value for value in values) else '.'
+            data[name] = [float(value.replace(decimal, '.')) for value in values]
+        else:
+            data[name] = [value.strip('"') for value in values]
+    return data
+
+
+class Store:
+    """Directory of per-session NumPy structured arrays with an index of ingested files"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, 'index.json')
+        self.index: Dict[str, Dict] = {}
+        """Source path to its size, modification time and array file"""
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as file:
+                self.index = json.load(file)
+
+    def pending(self, paths: Iterable[str]) -> List[str]:
+        """Paths not ingested yet or changed since"""
+        result = []
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            entry = self.index.get(path)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                result.append(path)
+        return result
+
+    def ingest(self, paths: Iterable[str], locale_name: str = '',
+               jobs: Optional[int] = None) -> int:
+        """Parse new or changed files in parallel, returns how many were ingested"""
+        pending = self.pending(paths)
+        if not pending:
+            return 0
+        decimal = decimal_point(locale_name) if locale_name else ''
+        with ProcessPoolExecutor(jobs) as pool:
+            arrays = pool.map(read_session, pending, [decimal] * len(pending),
+                              chunksize=max(1, len(pending) // 64))
+            for path, array in zip(pending, arrays):
+                # same file names can come from different directories
+                digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+                name = f'{os.path.splitext(os.path.basename(path))[0]}_{digest}.npy'
+                np.save(os.path.join(self.directory, name), array)
+                stat = os.stat(path)
+                self.index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                                    'array': name, 'rows': len(array)}
+        with open(self._index_path + '.tmp', 'w') as file:
+            json.dump(self.index, file, indent=1)
+        os.replace(self._index_path + '.tmp', self._index_path)
+        return len(pending)
+
+    def load(self) -> np.ndarray:
+        """All ingested cycles as one structured array"""
+        arrays = [np.load(os.path.join(self.directory, entry['array']))
+                  for entry in self.index.values()]
+        return np.concatenate(arrays) if arrays else np.zeros(0, DTYPE)
+
+
+def group_keys(data: np.ndarray, by: Sequence[str], measure: str,
+               age_band: int = 10) -> np.ndarray:
+    """Label of every row for grouping by `scent`, `ordering`, `gender`, `age` and `smokes`"""
+    parts = []
+    for key in by:
+        match key:
+            case 'scent':
+                parts.append(data[MEASURES[measure]])
+            case 'ordering':
+                parts.append(np.char.add(np.char.add(data['scent1'], ' -> '), data['scent2']))
+            case 'age':
+                low = data['age'] // age_band * age_band
+                parts.append(np.char.add(np.char.add(low.astype('U3'), '-'),
+                                         (low + age_band - 1).astype('U3')))
+            case _:
+                parts.append(data[key])
+    if not parts:
+        return np.full(len(data), 'all')
+    labels = parts[0].astype('U')
+    for part in parts[1:]:
+        labels = np.char.add(np.char.add(labels, ' | '), part.astype('U'))
+    return labels
+
+
+def summarise(data: np.ndarray, by: Sequence[str], measure: str = 'on_reaction',
+              resamples: int = 2000, confidence: float = 0.95, age_band: int = 10,
+              seed: Optional[int] = None) -> List[Dict]:
+    """Mean reaction per group with a percentile bootstrap confidence interval
+
+    Premature clicks (-1) and missing values are counted but excluded from the statistics."""
+    labels = group_keys(data, by, measure, age_band)
+    values = data[measure].astype(np.float64)
+    premature = values == -1
+    valid = ~premature & ~np.isnan(values)
+    groups, inverse = np.unique(labels, return_inverse=True)
+    rng = np.random.default_rng(seed)
+    tail = (1 - confidence) / 2
+    result = []
+    order = np.argsort(inverse[valid], kind='stable')
+    sorted_values = values[valid][order]
+    counts = np.bincount(inverse[valid], minlength=len(groups))
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    premature_counts = np.bincount(inverse[premature], minlength=len(groups))
+    for index, group in enumerate(groups):
+        sample = sorted_values[bounds[index]:bounds[index + 1]]
+        entry = {'group': str(group), 'n': int(len(sample)),
+                 'premature': int(premature_counts[index]),
+                 'mean': np.nan, 'median': np.nan, 'low': np.nan, 'high': np.nan}
+        if len(sample):
+            means = _bootstrap_means(sample, resamples, rng)
+            low, high = np.quantile(means, [tail, 1 - tail])
+            entry.update(mean=float(sample.mean()), median=float(np.median(sample)),
+                         low=float(low), high=float(high))
+        result.append(entry)
+    return result
+
+
+def _bootstrap_means(sample: np.ndarray, resamples: int, rng: np.random.Generator,
+                     block_elements: int = 1 << 22) -> np.ndarray:
+    """Means of `resamples` resamples, drawn in blocks to bound memory"""
+    block = max(1, block_elements // len(sample))
+    means = np.empty(resamples)
+    for start in range(0, resamples, block):
+        count = min(block, resamples - start)
+        means[start:start + count] = sample[rng.integers(
+            0, len(sample), (count, len(sample)))].mean(axis=1)
+    return means
+
+
+def _expand(paths: Sequence[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            files.append(path)
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--store', default='results_store', help='store directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help='add session CSV files to the store')
+    ingest.add_argument('paths', nargs='+', help='CSV files or directories')
+    ingest.add_argument('--locale', default='', help='locale the files were written with')
+    ingest.add_argument('-j', '--jobs', type=int)
+    report = commands.add_parser('report', help='summarise reactions in the store')
+    report.add_argument('--by', nargs='*', default=['scent'],
+                        choices=['scent', 'ordering', 'gender', 'age', 'smokes', 'participant'])
+    report.add_argument('--measure', nargs='*', default=list(MEASURES), choices=list(MEASURES))
+    report.add_argument('--age-band', type=int, default=10)
+    report.add_argument('--resamples', type=int, default=2000)
+    report.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    store = Store(args.store)
+    if args.command == 'ingest':
+        count = store.ingest(_expand(args.paths), args.locale, args.jobs)
+        print(f'Ingested {count} files, {sum(e["rows"] for e in store.index.values())} cycles in store')
+    else:
+        data = store.load()
+        for measure in args.measure:
+            print(f'{measure} by {", ".join(args.by) or "nothing"}:')
+            for entry in summarise(data, args.by, measure, args.resamples,
+                                   age_band=args.age_band, seed=args.seed):
+                print(f'  {entry["group"]}: n={entry["n"]} premature={entry["premature"]} '
+                      f'mean={entry["mean"]:.3f} s [{entry["low"]:.3f}, {entry["high"]:.3f}] '
+                      f'median={entry["median"]:.3f} s')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Masking noise looped without gaps from a wav file decoded once into memory"""
+from abc import ABCMeta, abstractmethod
+import argparse
+from dataclasses import dataclass
+from functools import lru_cache
+import sys
+import threading
+from time import perf_counter_ns
+from tracing import tracer
+from typing import Optional
+import wave
+
+
+BACKENDS = ('auto', 'sounddevice', 'winsound', 'none')
+"""Names for `open_player()`, besides a path ending in .wav for the file sink"""
+_DTYPES = {1: 'uint8', 2: 'int16', 3: 'int24', 4: 'int32'}
+"""Sample format of each wav sample width for `sounddevice`, 8 bit wav is unsigned"""
+
+
+@dataclass(frozen=True)
+class Sound:
+    path: str
+    frames: bytes
+    """Interleaved samples as stored in the wav file"""
+    channels: int
+    sample_width: int
+    """Bytes per sample"""
+    rate: int
+    """Frames per second"""
+
+    @property
+    def frame_size(self) -> int:
+        return self.channels * self.sample_width
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.frames) // self.frame_size
+
+    def loop(self, position: int, count: int) -> bytes:
+        """`count` frames from frame `position` on, continuing from the start past the end"""
+        size = self.frame_size
+        data = memoryview(self.frames)
+        start = position * size
+        end = start + count * size
+        if end <= len(data):
+            return bytes(data[start:end])
+        chunks = [data[start:]]
+        remaining = end - len(data)
+        while remaining > 0:
+            chunks.append(data[:remaining])
+            remaining -= len(chunks[-1])
+        return b''.join(chunks)
+
+
+SILENCE = Sound('', bytes(2 * 4410), 1, 2, 44100)
+"""A tenth of a second of silence, for a `FilePlayer` standing in when the noise cannot play"""
+
+
+@lru_cache
+def load_wav(path: str) -> Sound:
+    """Decode an uncompressed wav file, once per path"""
+    try:
+        with wave.open(path, 'rb') as file:
+            return Sound(path, file.readframes(file.getnframes()), file.getnchannels(),
+                         file.getsampwidth(), file.getframerate())
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f'{path} is not an uncompressed wav file: {e}') from e
+
+
+def _sounddevice():
+    """The optional `sounddevice` module, `None` if not installed or PortAudio is missing
+
+    Imported only once a player needs it, as loading PortAudio is slow."""
+    try:
+        import sounddevice
+    except (ImportError, OSError):
+        return None
+    return sounddevice
+
+
+class Player(threading.Thread, metaclass=ABCMeta):
+    """Plays a `Sound` in a loop on its own thread
+
+    `start()` and `stop()` return at once: the output is opened and closed
+    on the player's thread, so a slow audio driver never holds the Tk loop."""
+
+    def __init__(self, sound: Sound, buffer: float = 0.05):
+        super().__init__(name=type(self).__name__, daemon=True)
+        self.sound = sound
+        self.buffer = buffer
+        """Seconds of audio queued ahead of the output"""
+        self.underruns = 0
+        """Times the output ran out of audio and went silent"""
+        self.error = ''
+        """Why playing failed, empty while fine"""
+        self._stopping = threading.Event()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop playing, waiting up to `timeout` seconds for the output to close if given"""
+        self._stopping.set()
+        if timeout is not None and self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        try:
+            self.play()
+        except Exception as e:
+            self.error = str(e)
+            print(f'Masking noise failed: {e}')
+
+    @abstractmethod
+    def play(self):
+        """Output the sound until `stop()` is called"""
+
+    def underrun(self):
+        self.underruns += 1
+        tracer.instant('underrun', 'audio')
+
+
+class SoundDevicePlayer(Player):
+    """Streams the sound from memory through `sounddevice`, with `buffer` as the output latency"""
+
+    def play(self):
+        import sounddevice
+        sound = self.sound
+        position = 0
+
+        def fill(output, frames: int, time, status):
+            nonlocal position
+            if status.output_underflow:
+                self.underrun()
+            output[:] = sound.loop(position, frames)
+            position = (position + frames) % sound.frame_count
+        with sounddevice.RawOutputStream(
+                sound.rate, channels=sound.channels, dtype=_DTYPES[sound.sample_width],
+                latency=self.buffer, callback=fill):
+            self._stopping.wait()
+
+
+class WinsoundPlayer(Player):
+    """Loops the file with `winsound`, the only player before `sounddevice`
+
+    `winsound` cannot play from memory asynchronously, so it reads the file
+    itself and reports no underruns."""
+
+    def play(self):
+        import winsound
+        winsound.PlaySound(self.sound.path,
+                           winsound.SND_FILENAME | winsound.SND_ASYNC | winsound.SND_LOOP)
+        self._stopping.wait()
+        winsound.PlaySound(None, 0)
+
+
+class FilePlayer(Player):
+    """Writes the looped stream to a wav file in real time, or discards it, for headless runs
+
+    Blocks of `buffer` seconds are produced on a timer like an audio
+    device pulls them; falling a whole block behind counts as an underrun."""
+
+    def __init__(self, sound: Sound, buffer: float = 0.05, output: str = ''):
+        super().__init__(sound, buffer)
+        self.output = output
+        """Wav file to write, empty to discard the audio"""
+
+    def play(self):
+        sound = self.sound
+        block = max(1, int(self.buffer * sound.rate))
+        period = block * 1_000_000_000 // sound.rate
+        file = wave.open(self.output, 'wb') if self.output else None
+        if file is not None:
+            file.setnchannels(sound.channels)
+            file.setsampwidth(sound.sample_width)
+            file.setframerate(sound.rate)
+        position = 0
+        due = perf_counter_ns()
+        try:
+            while not self._stopping.wait(max(due - perf_counter_ns(), 0) / 1e9):
+                data = sound.loop(position, block)
+                position = (position + block) % sound.frame_count
+                if file is not None:
+                    file.writeframesraw(data)
+                due += period
+                if perf_counter_ns() - due > period:
+                    self.underrun()
+                    due = perf_counter_ns()
+        finally:
+            if file is not None:
+                file.close()
+
+
+def open_player(backend: str, path: str, buffer: float = 0.05) -> Player:
+    """Player of the wav file at `path`, not started yet
+
+    `backend` is one of `BACKENDS` or a wav file to write the stream to;
+    'auto' picks `sounddevice` if installed, else `winsound` on Windows and
+    'none' elsewhere."""
+    sound = load_wav(path)
+    if backend == 'auto':
+        backend = 'sounddevice' if _sounddevice() is not None else \
+            'winsound' if sys.platform == 'win32' else 'none'
+    match backend:
+        case 'sounddevice':
+            if _sounddevice() is None:
+                raise ValueError('sounddevice is not installed or PortAudio is missing')
+            return SoundDevicePlayer(sound, buffer)
+        case 'winsound':
+            return WinsoundPlayer(sound, buffer)
+        case 'none':
+            return FilePlayer(sound, buffer)
+    if backend.lower().endswith('.wav'):
+        return FilePlayer(sound, buffer, backend)
+    raise ValueError(f'Unknown audio backend {backend!r}, use one of {", ".join(BACKENDS)} '
+                     'or a .wav file')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('wav', nargs='?', default='White_noise.wav')
+    parser.add_argument('--backend', default='auto',
+                        help=f'{", ".join(BACKENDS)} or a .wav file to write to')
+    parser.add_argument('--buffer', type=float, default=0.05, help='seconds of audio buffered')
+    parser.add_argument('--seconds', type=float, default=5.0, help='how long to play')
+    args = parser.parse_args()
+
+    player = open_player(args.backend, args.wav, args.buffer)
+    print(f'Playing {args.wav} with {type(player).__name__} for {args.seconds} s')
+    player.start()
+    player.join(args.seconds)
+    player.stop(timeout=1.0)
+    print(f'{player.underruns} underruns' + (f', failed: {player.error}' if player.error else ''))
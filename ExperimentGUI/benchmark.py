@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Benchmarks of the experiment hot paths, compared against a stored baseline
+
+Runs headless on Linux: the device path uses `emulator.py` on a pseudo-terminal."""
+import argparse
+from datetime import datetime
+from device import OlfactoryDevice, SerialWorker
+from emulator import Emulator
+from engine import Config, Cycle, Participant, Session, load_config
+import json
+import locale
+import os
+import platform
+import serial
+from simulation import SimulatedDevice, VirtualClock
+from statistics import median, quantiles
+import sys
+import threading
+from time import perf_counter_ns
+from typing import Callable, Dict, List
+
+
+def measure(function: Callable[[], object], number: int, repeat: int = 5) -> float:
+    """Median seconds per call over `repeat` runs of `number` calls"""
+    runs = []
+    for _ in range(repeat):
+        started = perf_counter_ns()
+        for _ in range(number):
+            function()
+        runs.append((perf_counter_ns() - started) / number / 1e9)
+    return median(runs)
+
+
+def bench_to_csv(config: Config) -> Dict[str, float]:
+    cycle = Cycle(datetime.now(), 'abcdef', 'Other', 30, 'Smokes', 'Mint', 'Lemon',
+                  5.123, 1.234, 7.5, 0.987, 9.1, -1, 6.1, 6.102, 7.3, 14.0, 14.002,
+                  15.0, 24.1, 24.102, 24.5)
+    try:
+        locale.setlocale(locale.LC_NUMERIC, config.locale)
+    except locale.Error:
+        pass  # the configured locale is not installed, measure the current one
+    values = [cycle.on_wait, cycle.on_reaction, cycle.sw_wait,
+              cycle.sw_reaction, cycle.off_wait, cycle.off_reaction]
+    return {
+        'to_csv': measure(cycle.to_csv, 2000),
+        'format_string': measure(lambda: [locale.format_string('%.3f', v) for v in values], 2000),
+        'fstring': measure(lambda: [f'{v:.3f}' for v in values], 2000),
+    }
+
+
+def bench_transitions(config: Config) -> Dict[str, float]:
+    """Stage transitions of whole sessions with instant acknowledgements"""
+    transitions = 0
+
+    def session():
+        clock = VirtualClock()
+
+        def count(old, new):
+            nonlocal transitions
+            transitions += 1
+        run = Session(config, Participant('bench', 'Other', 30, 'Smokes'), ['Mint', 'Lemon'],
+                      clock, SimulatedDevice(clock, 0), on_stage=count)
+        run.start()
+        for _ in range(run.schedule.batch_size):
+            run.click()  # START
+            clock.run(clock.time + int(config.delay.max * 1e9) + 1)  # TIME_ON elapses
+            run.click()  # ACK_ON
+            clock.run(clock.time + int(config.delay.max * 1e9) + 1)
+            run.click()
+            clock.run(clock.time + int(config.delay.max * 1e9) + 1)
+            run.click()
+        run.finish()
+
+    session()
+    per_session = transitions
+    return {'transition': measure(session, 20) / per_session}
+
+
+def bench_device(config: Config, count: int = 200) -> Dict[str, float]:
+    """Round trip of alternating channel changes through the serial worker and emulator"""
+    latencies: List[float] = []
+    queued: List[float] = []
+    with Emulator() as emulator:
+        port = serial.Serial(emulator.port, 115200, timeout=0.1, write_timeout=None)
+        completed = threading.Event()
+        worker = SerialWorker(port, notify=completed.set)
+        worker.start()
+        device = OlfactoryDevice(worker.submit, intensity=config.intensity)
+        for index in range(count):
+            completed.clear()
+            command = device.set_channels(1 << index % 2)
+            completed.wait()
+            worker.dispatch()
+            if command is not None and not command.error:
+                latencies.append(command.latency)
+                queued.append((command.acknowledged - command.queued) / 1e9)
+        worker.stop()
+        port.close()
+    cuts = quantiles(latencies, n=20)
+    return {
+        'round_trip_p50': cuts[9],
+        'round_trip_p95': cuts[18],
+        'round_trip_max': max(latencies),
+        'submit_to_ack_p50': median(queued),
+    }
+
+
+def bench_config(path: str) -> Dict[str, float]:
+    return {'load': measure(lambda: load_config(path), 200)}
+
+
+BENCHMARKS: Dict[str, Callable[[Config], Dict[str, float]]] = {
+    'csv': bench_to_csv,
+    'stage': bench_transitions,
+    'device': bench_device,
+}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Names of timings slower than the baseline by more than `tolerance` (a fraction)"""
+    regressions = []
+    for group, timings in results['timings'].items():
+        for name, value in timings.items():
+            if name.endswith('_max'):
+                continue  # single outliers are too noisy to gate on
+            reference = baseline['timings'].get(group, {}).get(name)
+            if reference and value > reference * (1 + tolerance):
+                regressions.append(f'{group}.{name}: {1e6 * value:.1f} us, '
+                                   f'baseline {1e6 * reference:.1f} us (+{100 * (value / reference - 1):.0f}%)')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config', default='config.toml')
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS) + ['config'])
+    parser.add_argument('-o', '--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json',
+                        help='compare against this file if it exists')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, 0.2 for 20%%')
+    args = parser.parse_args()
+
+    config = load_config(args.config) if os.path.exists(args.config) else Config()
+    selected = args.only or list(BENCHMARKS) + ['config']
+    results = {
+        'date': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'timings': {},
+    }
+    for name in selected:
+        if name == 'config':
+            timings = bench_config(args.config) if os.path.exists(args.config) else {}
+        else:
+            timings = BENCHMARKS[name](config)
+        results['timings'][name] = timings
+        for key, value in timings.items():
+            print(f'{name}.{key}: {1e6 * value:.2f} us')
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Share one olfactory device between several programs over a loopback TCP socket
+
+Every client talks the firmware protocol as if it owned the device: it
+sends the same command characters and gets the same reply lines, so Python
+clients open `socket://127.0.0.1:7878` with `serial.serial_for_url` and
+Unity connects a `TcpClient`. The broker keeps the channel state each client
+asked for and drives the device to the highest intensity any client wants
+on every channel. Replies are sent once the device acknowledged the merged
+state, so clients measure the real round trip."""
+import argparse
+import asyncio
+from collections import deque
+from device import CHANNEL_COUNT, FULL_INTENSITY, Command, OlfactoryDevice, SerialWorker
+from math import nan
+import serial
+from statistics import quantiles
+from time import perf_counter_ns
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+DEFAULT_PORT = 7878
+
+
+class ClientState:
+    """Channel state one client asked for, following the firmware's rules"""
+
+    def __init__(self, channel_count: int = CHANNEL_COUNT):
+        self.channel_count = channel_count
+        self.intensities = [0] * channel_count
+        self.next_intensity = FULL_INTENSITY
+
+    def apply(self, command: str) -> Optional[str]:
+        """Reply line the firmware prints for `command`, `None` for line breaks"""
+        if command in '\r\n':
+            return None
+        if command == '0':
+            self.intensities = [0] * self.channel_count
+            return 'Turned off all channels\r\n'
+        if '0' <= command <= '9':
+            channel = ord(command) - ord('1')
+            if channel >= self.channel_count:
+                return f'Only {self.channel_count} channels configured\r\n'
+            self.intensities[channel] = self.next_intensity
+            return f'Turned on channel {command} with {self.next_intensity}0% duty cycle\r\n'
+        if 'A' <= command <= 'J' or 'a' <= command <= 'j':
+            self.next_intensity = ord(command.upper()) - ord('A') + 1
+            return f'Set {self.next_intensity}0% duty cycle\r\n'
+        return f'Unrecognised command: {command}\r\n'
+
+
+class Client:
+    def __init__(self, name: str, writer: asyncio.StreamWriter, channel_count: int):
+        self.name = name
+        self.writer = writer
+        self.state = ClientState(channel_count)
+        self.commands = 0
+        self.failed = 0
+        """Commands not replied to because the device failed"""
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        """Seconds from receiving a command to replying, the last 1000"""
+
+    def latency_stats(self) -> Dict[str, float]:
+        latencies = list(self.latencies)
+        if len(latencies) < 2:
+            return {'p50': nan, 'p95': nan, 'max': max(latencies, default=nan)}
+        cuts = quantiles(latencies, n=20)
+        return {'p50': cuts[9], 'p95': cuts[18], 'max': max(latencies)}
+
+
+class Broker:
+    """Owns the serial link and merges the channel state of all connected clients"""
+
+    def __init__(self, port: serial.Serial, loop: asyncio.AbstractEventLoop,
+                 channel_count: int = CHANNEL_COUNT):
+        self.channel_count = channel_count
+        self.worker = SerialWorker(
+            port, notify=lambda: loop.call_soon_threadsafe(self.worker.dispatch))
+        self.device = OlfactoryDevice(
+            self.worker.submit, channel_count, cancel=self.worker.cancel)
+        self.clients: Dict[str, Client] = {}
+        self._last: Optional[Command] = None
+        """Latest command submitted, until completed"""
+        self._waiting: List[Callable[[bool], None]] = []
+        """Called with success when `_last` completes"""
+        self._count = 0
+
+    def start(self):
+        self.worker.start()
+
+    def close(self):
+        self.worker.stop(timeout=2 * self.worker.ack_timeout)
+        self.worker.dispatch()
+
+    @property
+    def merged(self) -> Tuple[int, ...]:
+        """Highest intensity any client asked for on each channel"""
+        return tuple(max((client.state.intensities[channel] for client in self.clients.values()),
+                         default=0) for channel in range(self.channel_count))
+
+    def update(self, on_done: Optional[Callable[[bool], None]] = None):
+        """Drive the device to the merged state, `on_done` once it is there
+
+        Without a change `on_done` waits for the command in flight, as the
+        device only reaches the merged state once that one completes."""
+        waiting = [] if on_done is None else [on_done]
+        command = self.device.set_intensities(self.merged, lambda c: self._done(c, waiting))
+        if command is not None:
+            self._last, self._waiting = command, waiting
+        elif self._last is not None:
+            self._waiting.extend(waiting)
+        elif on_done is not None:
+            on_done(True)
+
+    def _done(self, command: Command, waiting: List[Callable[[bool], None]]):
+        if command is self._last:
+            self._last = None
+        if command.error:
+            print(f'Device command {command.data!r} failed: {command.error}')
+        for callback in waiting:
+            callback(not command.error)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._count += 1
+        peer = writer.get_extra_info('peername')
+        client = Client(f'client{self._count}({peer[0]}:{peer[1]})', writer, self.channel_count)
+        self.clients[client.name] = client
+        print(f'{client.name} connected')
+        writer.write(f'\nOlfactory broker, {self.channel_count} channels shared\r\n'.encode('ascii'))
+        try:
+            while data := await reader.read(1024):
+                received = perf_counter_ns()
+                replies = [reply for reply in map(client.state.apply, data.decode('ascii', errors='replace'))
+                           if reply is not None]
+                if not replies:
+                    continue
+                client.commands += 1
+                self.update(lambda ok, replies=replies, received=received:
+                            self._reply(client, replies, received, ok))
+        except ConnectionError:
+            pass
+        finally:
+            del self.clients[client.name]
+            self.update()  # release the channels this client held
+            stats = client.latency_stats()
+            print(f'{client.name} disconnected after {client.commands} commands, '
+                  f'latency p50 {1000 * stats["p50"]:.2f} ms, max {1000 * stats["max"]:.2f} ms')
+            writer.close()
+
+    def _reply(self, client: Client, replies: List[str], received: int, ok: bool):
+        if not ok:
+            client.failed += 1
+            return  # like the device, stay silent so the client times out
+        if client.writer.is_closing():
+            return
+        client.writer.write(''.join(replies).encode('ascii'))
+        client.latencies.append((perf_counter_ns() - received) / 1e9)
+
+    def report(self) -> str:
+        lines = [f'device {self.device.acknowledged.intensities if self.device.acknowledged else "unknown"}']
+        for client in self.clients.values():
+            stats = client.latency_stats()
+            lines.append(f'  {client.name}: {client.commands} commands ({client.failed} failed), '
+                         f'wants {tuple(client.state.intensities)}, latency p50 '
+                         f'{1000 * stats["p50"]:.2f} ms, p95 {1000 * stats["p95"]:.2f} ms')
+        return '\n'.join(lines)
+
+
+async def serve(device_port: str, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                channel_count: int = CHANNEL_COUNT, report_interval: float = 10.0):
+    loop = asyncio.get_running_loop()
+    link = serial.serial_for_url(device_port, 115200, timeout=0.1, write_timeout=None)
+    broker = Broker(link, loop, channel_count)
+    broker.start()
+    server = await asyncio.start_server(broker.handle, host, port)
+    print(f'Sharing {device_port} on socket://{host}:{port}')
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            if broker.clients:
+                print(broker.report())
+
+    reporter = asyncio.create_task(report())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        reporter.cancel()
+        broker.close()
+        link.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('device', help='serial port of the olfactory device')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on, loopback by default')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--channels', type=int, default=CHANNEL_COUNT)
+    parser.add_argument('--report', type=float, default=10.0,
+                        help='seconds between latency reports')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.device, args.host, args.port, args.channels, args.report))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,411 @@
+"""Serial link to the olfactory device, driven from a background thread"""
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum, auto
+from functools import lru_cache
+from math import nan
+import queue
+import re
+import serial
+import sys
+import threading
+import time
+from time import perf_counter_ns
+from tracing import tracer
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+class AckKind(Enum):
+    OFF = auto()
+    """All channels turned off"""
+    ON = auto()
+    """One channel turned on"""
+    INTENSITY = auto()
+    """Intensity set for the following channels"""
+    ERROR = auto()
+    """Command rejected by the firmware"""
+
+
+@dataclass
+class Ack:
+    """Acknowledgement line printed by `OlfactoryControl.ino`"""
+    kind: AckKind
+    channel: int = 0
+    """Channel number as sent (starting from 1), 0 if not applicable"""
+    intensity: int = 0
+    """Duty cycle in tens of percent, 0 if not applicable"""
+    received: int = 0
+    """`perf_counter_ns()` when the line was read"""
+
+
+_ACK_PATTERNS = [
+    (re.compile(r'Turned off all channels'), AckKind.OFF),
+    (re.compile(r'Turned on channel (\d) with (\d+)0% duty cycle'), AckKind.ON),
+    (re.compile(r'Set (\d+)0% duty cycle'), AckKind.INTENSITY),
+    (re.compile(r'Only \d+ channels configured'), AckKind.ERROR),
+    (re.compile(r'Unrecognised command: .*'), AckKind.ERROR),
+]
+
+
+def parse_ack(line: str) -> Optional[Ack]:
+    """Parse one line of firmware output, `None` for banner and other text"""
+    line = line.strip()
+    for pattern, kind in _ACK_PATTERNS:
+        match = pattern.fullmatch(line)
+        if match is None:
+            continue
+        match kind:
+            case AckKind.ON:
+                return Ack(kind, int(match[1]), int(match[2]))
+            case AckKind.INTENSITY:
+                return Ack(kind, intensity=int(match[1]))
+            case _:
+                return Ack(kind)
+    return None
+
+
+CHANNEL_COUNT = 3
+"""Channels in `OlfactoryControl.ino`"""
+FULL_INTENSITY = 10
+"""Duty cycle in tens of percent, the firmware default"""
+
+
+@dataclass(frozen=True)
+class DeviceState:
+    """Firmware state that decides which bytes a change needs"""
+    intensities: Tuple[int, ...]
+    """Duty cycle of each channel in tens of percent, 0 when off"""
+    next_intensity: int = FULL_INTENSITY
+    """Duty cycle the firmware gives to the next channel turned on, 0 if unknown"""
+
+    def apply(self, ack: Ack) -> 'DeviceState':
+        """State after the firmware printed `ack`"""
+        match ack.kind:
+            case AckKind.OFF:
+                return DeviceState((0,) * len(self.intensities), self.next_intensity)
+            case AckKind.ON:
+                intensities = list(self.intensities)
+                intensities[ack.channel - 1] = ack.intensity
+                return DeviceState(tuple(intensities), self.next_intensity)
+            case AckKind.INTENSITY:
+                return DeviceState(self.intensities, ack.intensity)
+        return self
+
+
+def _turn_on(intensities: Tuple[int, ...], channels: List[int],
+             next_intensity: int) -> Tuple[bytes, int]:
+    """Letters and digits turning `channels` on, grouped by intensity
+
+    The group matching `next_intensity` goes first as it needs no letter."""
+    groups: Dict[int, List[int]] = {}
+    for channel in channels:
+        groups.setdefault(intensities[channel], []).append(channel)
+    order = sorted(groups, key=lambda intensity: intensity != next_intensity)
+    data = bytearray()
+    for intensity in order:
+        if intensity != next_intensity:
+            data.append(ord('A') + intensity - 1)
+            next_intensity = intensity
+        data.extend(ord('1') + channel for channel in groups[intensity])
+    return bytes(data), next_intensity
+
+
+class CommandEncoder:
+    """Shortest command taking the device from one state to another
+
+    Commands from an unknown state and transitions between known states are
+    memoised as they are used; a table of every combination of intensities
+    would grow as 11 to the power of the channel count."""
+
+    def __init__(self, channel_count: int = CHANNEL_COUNT):
+        self.channel_count = channel_count
+
+    @lru_cache(maxsize=4096)
+    def _encode_reset(self, intensities: Tuple[int, ...],
+                      next_intensity: int) -> Tuple[bytes, DeviceState]:
+        channels = [i for i, intensity in enumerate(intensities) if intensity > 0]
+        data, next_intensity = _turn_on(intensities, channels, next_intensity)
+        return b'0' + data, DeviceState(intensities, next_intensity)
+
+    def encode(self, current: Optional[DeviceState],
+               intensities: Tuple[int, ...]) -> Tuple[bytes, DeviceState]:
+        """Bytes to send and the resulting state, empty if already in that state"""
+        if current is None:
+            return self._encode_reset(intensities, 0)
+        return self._encode(current, intensities)
+
+    @lru_cache(maxsize=4096)
+    def _encode(self, current: DeviceState,
+                intensities: Tuple[int, ...]) -> Tuple[bytes, DeviceState]:
+        if current.intensities == intensities:
+            return b'', current
+        # single channels can only be turned off all together with the rest
+        if any(old > 0 and new == 0 for old, new in zip(current.intensities, intensities)):
+            return self._encode_reset(intensities, current.next_intensity)
+        changed = [i for i, (old, new) in enumerate(zip(current.intensities, intensities))
+                   if new != old]
+        data, next_intensity = _turn_on(intensities, changed, current.next_intensity)
+        return data, DeviceState(intensities, next_intensity)
+
+
+@dataclass
+class Command:
+    """Bytes queued for the device, timestamps filled in by the worker"""
+    data: bytes
+    on_done: Optional[Callable[['Command'], None]] = None
+    """Called from `SerialWorker.dispatch()` once acknowledged or failed"""
+    queued: int = 0
+    """`perf_counter_ns()` when submitted"""
+    sent: int = 0
+    """`perf_counter_ns()` when the write returned"""
+    acknowledged: int = 0
+    """`perf_counter_ns()` when the last acknowledgement was read"""
+    acks: List[Ack] = field(default_factory=list)
+    error: str = ''
+    """Reason the command failed, empty on success"""
+    at: int = 0
+    """`perf_counter_ns()` to write at, 0 to write as soon as possible"""
+    cancelled: bool = False
+    """Dropped with `SerialWorker.cancel()` before it was written"""
+
+    @property
+    def expected_acks(self) -> int:
+        """The firmware replies with one line for every command character"""
+        return len(self.data.replace(b'\r', b'').replace(b'\n', b''))
+
+    @property
+    def latency(self) -> float:
+        """Round trip from write to last acknowledgement in seconds"""
+        if self.acknowledged == 0:
+            return nan
+        return (self.acknowledged - self.sent) / 1e9
+
+
+SPIN = 0.02 if sys.platform == 'win32' else 0.002
+"""Seconds before a scheduled write to stop sleeping and busy-wait, sleeps are coarse on Windows"""
+
+
+class SerialWorker(threading.Thread):
+    """Writes queued commands and waits for their acknowledgement off the GUI thread
+
+    Completed commands are collected until the owner calls `dispatch()`, so
+    `Command.on_done` always runs on the owner's thread (the Tk loop).
+    Commands with `at` set are held until that instant, sleeping most of the
+    wait and busy-waiting the last `spin` seconds, so stimuli do not depend
+    on how busy the Tk loop is."""
+
+    def __init__(self, port: serial.Serial, ack_timeout: float = 1.0,
+                 notify: Optional[Callable[[], None]] = None, spin: float = SPIN):
+        super().__init__(name=f'SerialWorker({port.port})', daemon=True)
+        self.port = port
+        self.ack_timeout = ack_timeout
+        """Seconds to wait for all acknowledgements of a command"""
+        self.notify = notify
+        """Called from the worker thread when a command completed, to schedule `dispatch()`"""
+        self.spin = spin
+        self._commands: queue.SimpleQueue[Optional[Command]] = queue.SimpleQueue()
+        self._completed: queue.SimpleQueue[Command] = queue.SimpleQueue()
+        self._writing = threading.Lock()
+        self._wake = threading.Event()
+        self._line = bytearray()
+        """Start of a reply line whose read timed out before its end arrived"""
+
+    def submit(self, data: bytes, on_done: Optional[Callable[[Command], None]] = None,
+               at: int = 0) -> Command:
+        """Queue a command, returns immediately"""
+        command = Command(data, on_done, queued=perf_counter_ns(), at=at)
+        self._commands.put(command)
+        return command
+
+    def cancel(self, command: Command) -> bool:
+        """Drop a command not written yet, `False` if it was already written
+
+        A cancelled command still completes, with an error and no acknowledgements."""
+        with self._writing:
+            if command.sent:
+                return False
+            command.cancelled = True
+        self._wake.set()
+        return True
+
+    def stop(self, timeout: Optional[float] = None):
+        """Finish the commands already queued and end the thread"""
+        self._commands.put(None)
+        self.join(timeout)
+
+    def dispatch(self) -> int:
+        """Call `on_done` for completed commands, returns how many completed"""
+        count = 0
+        while True:
+            try:
+                command = self._completed.get_nowait()
+            except queue.Empty:
+                return count
+            count += 1
+            if command.on_done is not None:
+                command.on_done(command)
+
+    def run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+            self._execute(command)
+            self._completed.put(command)
+            if self.notify is not None:
+                self.notify()
+
+    def _wait(self, command: Command):
+        """Sleep until shortly before `command.at`, then spin, returns early if cancelled"""
+        spin = int(self.spin * 1e9)
+        while not command.cancelled:
+            remaining = command.at - perf_counter_ns()
+            if remaining <= spin:
+                break
+            self._wake.wait((remaining - spin) / 1e9)
+            self._wake.clear()
+        while not command.cancelled and perf_counter_ns() < command.at:
+            time.sleep(0)  # lets the Tk thread take the GIL while spinning
+
+    def _execute(self, command: Command):
+        try:
+            # late replies to an earlier timed out command would be miscounted
+            if self.port.in_waiting:
+                self.port.read(self.port.in_waiting)
+            self._line.clear()
+            if command.at:
+                self._wait(command)
+            with self._writing:
+                if command.cancelled:
+                    command.error = 'Cancelled'
+                    return
+                writing = perf_counter_ns()
+                self.port.write(command.data)
+                self.port.flush()
+                command.sent = perf_counter_ns()
+            tracer.complete('write', 'serial', writing, command.sent,
+                            data=command.data.decode('ascii', errors='replace'),
+                            late_us=(writing - command.at) / 1000 if command.at else 0)
+            deadline = command.sent + int(self.ack_timeout * 1e9)
+            while len(command.acks) < command.expected_acks:
+                # a read timing out mid-line returns what arrived so far
+                self._line += self.port.readline()
+                now = perf_counter_ns()
+                ack = None
+                if self._line.endswith(b'\n'):
+                    ack = parse_ack(self._line.decode('ascii', errors='replace'))
+                    self._line.clear()
+                if ack is not None:
+                    ack.received = now
+                    command.acks.append(ack)
+                    tracer.instant(ack.kind.name, 'ack', now, channel=ack.channel,
+                                   intensity=ack.intensity)
+                elif now > deadline:
+                    command.error = f'No acknowledgement within {self.ack_timeout} s'
+                    tracer.instant('timeout', 'serial', now)
+                    return
+            command.acknowledged = command.acks[-1].received if command.acks else command.sent
+            tracer.complete('acknowledge', 'serial', command.sent, command.acknowledged,
+                            acks=len(command.acks))
+            if any(ack.kind == AckKind.ERROR for ack in command.acks):
+                command.error = 'Command rejected by the device'
+        except serial.SerialException as e:
+            command.error = str(e)
+
+
+@lru_cache(maxsize=None)
+def shared_encoder(channel_count: int = CHANNEL_COUNT) -> CommandEncoder:
+    """One encoder and its tables for all devices with `channel_count` channels"""
+    return CommandEncoder(channel_count)
+
+
+class OlfactoryDevice:
+    """Sends each change of channel state as one write with only the bytes it needs
+
+    Changes are diffed against the last acknowledged state, advanced by the
+    commands still in flight. After a failed command the state is unknown
+    and the next change starts by turning all channels off."""
+
+    def __init__(self, submit: Callable[[bytes, Optional[Callable[[Command], None]], int], Command],
+                 channel_count: int = CHANNEL_COUNT, intensity: int = FULL_INTENSITY,
+                 cancel: Optional[Callable[[Command], bool]] = None):
+        self.submit = submit
+        """`SerialWorker.submit()` or a stand-in"""
+        self._cancel = cancel
+        """`SerialWorker.cancel()` or a stand-in, `None` if commands cannot be cancelled"""
+        self._pending: Deque[Tuple[Command, Optional[DeviceState]]] = deque()
+        """Commands not completed yet and the expected state before each"""
+        self.encoder = shared_encoder(channel_count)
+        self.intensity = intensity
+        """Duty cycle used by `set_channels()`, in tens of percent"""
+        self.acknowledged: Optional[DeviceState] = None
+        """State confirmed by the firmware's replies, `None` if unknown"""
+        self._expected: Optional[DeviceState] = None
+        self._levels: Dict[Tuple[int, int], Tuple[int, ...]] = {}
+        """Intensities of each channel bitmask and `intensity` used by `set_channels()`"""
+
+    @property
+    def expected(self) -> Optional[DeviceState]:
+        """State once the commands in flight complete, which changes are diffed against"""
+        return self._expected
+
+    def assume(self, state: Optional[DeviceState]):
+        """Take `state` as acknowledged without sending anything, e.g. to replay a session"""
+        self.acknowledged = self._expected = state
+
+    def set_intensities(self, intensities: Tuple[int, ...],
+                        on_done: Optional[Callable[[Command], None]] = None,
+                        at: int = 0) -> Optional[Command]:
+        """Queue the change to `intensities`, `None` if the device is already there
+
+        With `at` (`perf_counter_ns()`) the command is written at that instant."""
+        intensities = tuple(intensities) + \
+            (0,) * (self.encoder.channel_count - len(intensities))
+        data, expected = self.encoder.encode(self._expected, intensities)
+        if not data:
+            return None
+        previous = self._expected
+        self._expected = expected
+
+        def done(command: Command):
+            if self._pending and self._pending[0][0] is command:
+                self._pending.popleft()
+            if command.cancelled:
+                pass  # the expected state was rolled back by `cancel()`
+            elif command.error:
+                self.acknowledged = self._expected = None
+            else:
+                # commands complete in order, so this builds on the previous one
+                state = self.acknowledged if self.acknowledged is not None else \
+                    DeviceState((0,) * self.encoder.channel_count, 0)
+                for ack in command.acks:
+                    state = state.apply(ack)
+                self.acknowledged = state
+            if on_done is not None:
+                on_done(command)
+        command = self.submit(data, done, at)
+        self._pending.append((command, previous))
+        return command
+
+    def cancel(self, command: Command) -> bool:
+        """Drop the latest command if not written yet, `False` if it was or cannot be
+
+        Earlier commands can be cancelled one after another, newest first."""
+        if self._cancel is None or not self._pending or self._pending[-1][0] is not command:
+            return False
+        if not self._cancel(command):
+            return False
+        self._expected = self._pending.pop()[1]
+        return True
+
+    def set_channels(self, channels: int,
+                     on_done: Optional[Callable[[Command], None]] = None,
+                     at: int = 0) -> Optional[Command]:
+        """Turn on the channels in bitmask `channels` (bit 0 is channel 1) at `intensity`, the others off"""
+        if channels >> self.encoder.channel_count:
+            raise ValueError(f'Channel beyond the {self.encoder.channel_count} of the device')
+        key = (channels, self.intensity)
+        if key not in self._levels:
+            self._levels[key] = tuple(self.intensity if channels >> channel & 1 else 0
+                                      for channel in range(self.encoder.channel_count))
+        return self.set_intensities(self._levels[key], on_done, at)
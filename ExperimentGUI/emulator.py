@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Stand-in for `OlfactoryControl.ino` on a pseudo-terminal (Linux and macOS)"""
+import argparse
+from dataclasses import dataclass, field
+import os
+import random
+import select
+import threading
+from time import perf_counter_ns, sleep
+import tty
+from typing import List, Optional, Tuple
+
+
+@dataclass
+class Faults:
+    """Misbehaviour injected into the emulated device, times in seconds"""
+    byte_latency: float = 0.0
+    """Delay before each received byte is handled"""
+    jitter: float = 0.0
+    """Extra random delay up to this value, added to `byte_latency`"""
+    drop_reply: float = 0.0
+    """Probability of not printing the reply to a command"""
+    hang: float = 0.0
+    """Probability per received byte of a brownout that stops all processing"""
+    hang_duration: float = 5.0
+    """How long a brownout hangs, the device then restarts and prints the banner"""
+    split_reply: float = 0.0
+    """Pause in the middle of each reply line, as a slow or stalled link produces"""
+
+
+@dataclass
+class StateChange:
+    time: int
+    """`perf_counter_ns()` when the change happened"""
+    intensities: Tuple[int, ...]
+    """Duty cycle of each channel in tens of percent, 0 when off"""
+
+
+@dataclass
+class Timeline:
+    changes: List[StateChange] = field(default_factory=list)
+
+    def state_at(self, time: int) -> Tuple[int, ...]:
+        """Channel intensities in effect at `perf_counter_ns()` value `time`"""
+        state = self.changes[0].intensities
+        for change in self.changes:
+            if change.time > time:
+                break
+            state = change.intensities
+        return state
+
+    def on_time(self, channel: int, start: int = 0, end: Optional[int] = None) -> float:
+        """Seconds `channel` (starting from 1) was on, weighted by duty cycle"""
+        end = end if end is not None else perf_counter_ns()
+        total = 0
+        for change, following in zip(self.changes, self.changes[1:] + [None]):
+            begin = max(start, change.time)
+            finish = min(end, following.time if following is not None else end)
+            if finish > begin:
+                total += (finish - begin) * change.intensities[channel - 1] / 10
+        return total / 1e9
+
+
+class Emulator:
+    """Executes the firmware command set on the master side of a pseudo-terminal
+
+    `port` is the path to open with `serial.Serial`, like a real device."""
+
+    def __init__(self, channel_count: int = 3, faults: Optional[Faults] = None,
+                 seed: Optional[int] = None):
+        self.channel_count = channel_count
+        self.faults = faults if faults is not None else Faults()
+        self.rng = random.Random(seed)
+        self.timeline = Timeline()
+        self.received = bytearray()
+        """All command bytes handled, for assertions"""
+        self._intensities = [0] * channel_count
+        self._next_intensity = 10
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # no echo and no newline translation
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f'Emulator({self.port})', daemon=True)
+
+    def start(self) -> 'Emulator':
+        self._record()
+        self._print_banner()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def intensities(self) -> Tuple[int, ...]:
+        return tuple(self._intensities)
+
+    def _run(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            for byte in data:
+                self._delay()
+                if self.rng.random() < self.faults.hang:
+                    self._brownout()
+                    break  # bytes received during the hang are lost
+                self._handle(chr(byte))
+
+    def _delay(self):
+        delay = self.faults.byte_latency + self.rng.uniform(0, self.faults.jitter)
+        if delay > 0:
+            sleep(delay)
+
+    def _brownout(self):
+        sleep(self.faults.hang_duration)
+        self._intensities = [0] * self.channel_count
+        self._next_intensity = 10
+        self._record()
+        # discard input that arrived while hanging
+        while select.select([self._master], [], [], 0)[0]:
+            os.read(self._master, 1024)
+        self._print_banner()
+
+    def _handle(self, command: str):
+        if command in '\r\n':
+            return
+        self.received += command.encode('ascii', errors='replace')
+        if command == '0':
+            self._intensities = [0] * self.channel_count
+            self._record()
+            self._reply('Turned off all channels\r\n')
+        elif '0' <= command <= '9':
+            channel = ord(command) - ord('1')
+            if channel < self.channel_count:
+                self._intensities[channel] = self._next_intensity
+                self._record()
+                self._reply(f'Turned on channel {command} with '
+                            f'{self._next_intensity}0% duty cycle\r\n')
+            else:
+                self._reply(f'Only {self.channel_count} channels configured\r\n')
+        elif 'A' <= command <= 'J' or 'a' <= command <= 'j':
+            self._next_intensity = ord(command.upper()) - ord('A') + 1
+            self._reply(f'Set {self._next_intensity}0% duty cycle\r\n')
+        else:
+            self._reply(f'Unrecognised command: {command}\r\n')
+
+    def _record(self):
+        self.timeline.changes.append(
+            StateChange(perf_counter_ns(), tuple(self._intensities)))
+
+    def _reply(self, text: str):
+        if self.rng.random() < self.faults.drop_reply:
+            return
+        if self.faults.split_reply > 0:
+            self._write(text[:len(text) // 2])
+            sleep(self.faults.split_reply)
+            text = text[len(text) // 2:]
+        self._write(text)
+
+    def _print_banner(self):
+        self._write(f'\nSend a digit between 1 and {self.channel_count} (inclusive) '
+                    'to turn this channel on\n'
+                    'Send 0 to turn of all channels immediately.\n'
+                    'Send a letter between A and J to set intensity for turned on channels.\n'
+                    "'A' to emit with 10% duty cycle, 'J' for 100% (the default)\n\r\n")
+
+    def _write(self, text: str):
+        try:
+            os.write(self._master, text.encode('ascii'))
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per received byte')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help='probability of a missing reply')
+    parser.add_argument('--hang', type=float, default=0.0,
+                        help='probability of a brownout per received byte')
+    parser.add_argument('--split', type=float, default=0.0,
+                        help='seconds to pause in the middle of each reply')
+    args = parser.parse_args()
+
+    faults = Faults(args.latency, args.jitter, args.drop, args.hang, split_reply=args.split)
+    with Emulator(args.channels, faults) as emulator:
+        print(f'Emulating olfactory device on {emulator.port}, Ctrl+C to stop')
+        print(f'Add ports = ["{emulator.port}"] to config.toml to choose it in the GUI')
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,520 @@
+"""Experiment stage sequence, independent of the GUI, the clock and the device"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from device import Command
+from envelope import EnvelopePlayer, crossfade
+from enum import Enum, auto
+import locale
+from math import isnan, nan
+import random
+from schedule import Schedule, generate
+import tomllib
+from tracing import tracer
+from typing import Any, Callable, List, Optional, Protocol
+
+
+@dataclass
+class Delay:
+    min = 5.0
+    max = 10.0
+
+
+@dataclass
+class Config:
+    locale = 'it_IT'
+    """Locale for formatting numbers in CSV output"""
+    scents = ['Undefined 1', 'Undefined 2']
+    """Scents available to choose in the window, the first ones preselected on the channels in order"""
+    channels = 2
+    """Channels with a scent, 2 up to the `CHANNEL_COUNT` the firmware was built with"""
+    delay = Delay()
+    """Random delay for `TIME_*` stages"""
+    balanced_count = 5
+    """Number of each ordering in a balanced batch"""
+    intensity = 10
+    """Duty cycle of turned on channels in tens of percent, 1 to 10"""
+    ports = []
+    """Serial ports to offer besides the detected ones, e.g. from `emulator.py`"""
+    schedule = ''
+    """Schedule file to run instead of a new random one, see `schedule.py`"""
+    crossfade = 0.0
+    """Seconds to fade between the channels at the switch, 0 to switch at once, see `envelope.py`"""
+    precise_timing = True
+    """Write the actuation ending a `TIME_*` stage from the serial thread at the scheduled instant"""
+    store = 'results.sqlite'
+    """SQLite database collecting the results of all sessions, see `store.py`; empty to write a CSV file per session"""
+    audio = 'auto'
+    """Masking noise output: auto, sounddevice, winsound, none or a .wav file to write it to, see `audio.py`"""
+    audio_buffer = 0.05
+    """Seconds of masking noise buffered ahead of the audio output"""
+    trace = False
+    """Save a timeline of stages, commands and clicks next to the results, see `tracing.py`"""
+    record = False
+    """Save every input of a session next to the results to replay it, see `replay.py`"""
+
+
+def load_config(path: str) -> Config:
+    """Defaults overridden by the values in a TOML file"""
+    config = Config()
+    config.delay = Delay()  # not shared with other `Config` instances
+    with open(path, 'rb') as config_file:
+        data: dict = tomllib.load(config_file)
+        for key, value in data.items():
+            if type(value) is dict:
+                for innerkey, innervalue in value.items():
+                    setattr(getattr(config, key), innerkey, innervalue)
+            else:
+                setattr(config, key, value)
+    return config
+
+
+class Clock(Protocol):
+    """Time source and timers driving a `Session`"""
+
+    def now(self) -> int:
+        """Monotonic time in nanoseconds"""
+        ...
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> Any:
+        """Call `callback` after `delay` seconds, returns a handle for `cancel()`"""
+        ...
+
+    def cancel(self, handle: Any):
+        ...
+
+
+class Device(Protocol):
+    """Olfactory device as seen by a `Session`, e.g. `ControlWindow`"""
+
+    def set_channels(self, channels: int,
+                     on_done: Optional[Callable[[Command], None]] = None,
+                     at: int = 0) -> Optional[Command]:
+        """Queue turning on the channels in bitmask `channels` (bit 0 is channel 1) and the
+        others off, written at `at` (`Clock.now()` time) if given"""
+        ...
+
+    def cancel(self, command: Command) -> bool:
+        """Drop a command not written yet, `False` if already written"""
+        ...
+
+
+@dataclass
+class Participant:
+    name: str
+    """Anonymised name of test participant"""
+    gender: str
+    age: int
+    smokes: str
+
+
+class Stage(Enum):
+    INIT = auto(),
+    """Experiment initialised"""
+    START = auto(),
+    """Ready to start next cycle"""
+    TIME_ON = auto(),
+    """Waiting for emitter to turn on"""
+    ACK_ON = auto(),
+    """Waiting for user to notice emitter is on"""
+    TIME_SW = auto(),
+    """Waiting for emitters to switch"""
+    ACK_SW = auto(),
+    """Waiting for user to acknowledge the switch"""
+    TIME_OFF = auto(),
+    """Waiting for emitter 2 to turn off"""
+    ACK_OFF = auto(),
+    """Waiting for user to notice turn off"""
+
+    __hash__ = object.__hash__  # members are singletons; `Enum.__hash__` is slow Python code
+
+
+STIMULUS = {
+    Stage.TIME_ON: 'on',
+    Stage.ACK_ON: 'on',
+    Stage.TIME_SW: 'sw',
+    Stage.ACK_SW: 'sw',
+    Stage.TIME_OFF: 'off',
+    Stage.ACK_OFF: 'off',
+}
+"""Prefix of `Cycle` fields measured during each stage"""
+
+DELAY_INDEX = {
+    Stage.TIME_ON: 1,
+    Stage.TIME_SW: 2,
+    Stage.TIME_OFF: 3,
+}
+"""Position of each stage's delay in `Schedule.cycle()`"""
+
+NEXT_STAGE = {
+    Stage.INIT: Stage.START,
+    Stage.START: Stage.TIME_ON,
+    Stage.TIME_ON: Stage.ACK_ON,
+    Stage.ACK_ON: Stage.TIME_SW,
+    Stage.TIME_SW: Stage.ACK_SW,
+    Stage.ACK_SW: Stage.TIME_OFF,
+    Stage.TIME_OFF: Stage.ACK_OFF,
+    Stage.ACK_OFF: Stage.START,
+}
+"""Stage sequence when a timer elapses or the participant acknowledges a change"""
+NEXT_STAGE_CLICKED = NEXT_STAGE | {
+    Stage.TIME_ON: Stage.TIME_SW,
+    Stage.TIME_SW: Stage.TIME_OFF,
+    Stage.TIME_OFF: Stage.START,
+}
+"""Stage sequence when the participant clicks prematurely, skipping `ACK_*`"""
+
+
+_REACTION_FIELDS = {stimulus: (f'{stimulus}_reaction', f'{stimulus}_acknowledged',
+                                f'{stimulus}_sent', f'{stimulus}_click')
+                    for stimulus in ('on', 'sw', 'off')}
+"""`Cycle` fields `resolve_reaction()` reads and writes for each stimulus"""
+
+
+@dataclass(slots=True)
+class Cycle:
+    """Data saved from one experiment run"""
+    start_date: datetime
+    """Experiment start time"""
+    participant_name: str
+    """Anonymised name of test participant"""
+    gender: str
+    """Participant gender"""
+    age: int
+    """Participant age"""
+    smokes: str
+    """Participant smoking tobacco"""
+    scent1: str
+    """Scent turned on first"""
+    scent2: str
+    """Scent turned on second"""
+    on_wait: float = nan
+    """Random time until emitter 1 turned on"""
+    on_reaction: float = nan
+    """Time until user noticed the change, -1 if before"""
+    sw_wait: float = nan
+    """Random time until emitters switched"""
+    sw_reaction: float = nan
+    """Time until user noticed the change, -1 if before"""
+    off_wait: float = nan
+    """Random time until emitter 2 turned off"""
+    off_reaction: float = nan
+    """Time until user noticed the change, -1 if before"""
+    on_sent: float = nan
+    """Turn on command written, seconds since `start_ns`"""
+    on_acknowledged: float = nan
+    """Turn on command acknowledged by the device, seconds since `start_ns`"""
+    on_click: float = nan
+    """Click after turn on, seconds since `start_ns`"""
+    sw_sent: float = nan
+    """Switch command written, seconds since `start_ns`"""
+    sw_acknowledged: float = nan
+    """Switch command acknowledged by the device, seconds since `start_ns`"""
+    sw_click: float = nan
+    """Click after switch, seconds since `start_ns`"""
+    off_sent: float = nan
+    """Turn off command written, seconds since `start_ns`"""
+    off_acknowledged: float = nan
+    """Turn off command acknowledged by the device, seconds since `start_ns`"""
+    off_click: float = nan
+    """Click after turn off, seconds since `start_ns`"""
+    loop_lag_max: float = nan
+    """Longest the GUI loop was busy during the cycle, seconds, see `monitor.py`"""
+    loop_jitter: float = nan
+    """Standard deviation of the GUI loop heartbeat lateness, seconds"""
+    input_latency_max: float = nan
+    """Slowest click from input event to handler, seconds above the fastest seen"""
+    timer_late_max: float = nan
+    """Latest firing of a stage timer, seconds"""
+    on_scheduled: float = nan
+    """Turn on command due, seconds since `start_ns`, NaN if written when the timer fired"""
+    sw_scheduled: float = nan
+    """Switch command due, seconds since `start_ns`"""
+    off_scheduled: float = nan
+    """Turn off command due, seconds since `start_ns`"""
+    start_ns: int = 0
+    """`perf_counter_ns()` at cycle start, reference for the timestamps above"""
+
+    def mark(self, event: str, timestamp: int):
+        """Store a `perf_counter_ns()` timestamp in field `event`, e.g. `on_sent`"""
+        setattr(self, event, (timestamp - self.start_ns) / 1e9)
+
+    def resolve_reaction(self, stimulus: str):
+        """Measure the reaction to `stimulus` from the acknowledged actuation, or from the write if never acknowledged"""
+        reaction, acknowledged, sent, click = _REACTION_FIELDS[stimulus]
+        if getattr(self, reaction) == -1:
+            return  # clicked prematurely
+        actuated = getattr(self, acknowledged)
+        if isnan(actuated):
+            actuated = getattr(self, sent)
+        setattr(self, reaction, getattr(self, click) - actuated)
+
+    @staticmethod
+    def csv_header() -> str:
+        return '"cycle start [ISO 8601]";"participant anonymous name";"participant gender";"participant age";"participant smokes";"scent 1";"scent 2";' + \
+            '"turn on 1 [s]";"on reaction [s]";"switch [s]";"switch reaction [s]";"turn off [s]";"turn off reaction [s]";' + \
+            '"turn on sent [s]";"turn on acknowledged [s]";"on click [s]";' + \
+            '"switch sent [s]";"switch acknowledged [s]";"switch click [s]";' + \
+            '"turn off sent [s]";"turn off acknowledged [s]";"turn off click [s]";' + \
+            '"loop lag max [s]";"loop jitter [s]";"input latency max [s]";"timer lateness max [s]";' + \
+            '"turn on scheduled [s]";"switch scheduled [s]";"turn off scheduled [s]"\n'
+
+    def to_csv(self) -> str:
+        start = f'{self.start_date.isoformat()};"{self.participant_name}";"{self.gender}";' + \
+                f'{self.age};"{self.smokes}";"{self.scent1}";"{self.scent2}";'
+        times = [locale.format_string('%.3f', t) for t in [self.on_wait, self.on_reaction,
+                                                           self.sw_wait, self.sw_reaction,
+                                                           self.off_wait, self.off_reaction]]
+        stamps = [locale.format_string('%.6f', t) for t in [self.on_sent, self.on_acknowledged, self.on_click,
+                                                            self.sw_sent, self.sw_acknowledged, self.sw_click,
+                                                            self.off_sent, self.off_acknowledged, self.off_click,
+                                                            self.loop_lag_max, self.loop_jitter,
+                                                            self.input_latency_max, self.timer_late_max,
+                                                            self.on_scheduled, self.sw_scheduled, self.off_scheduled]]
+        return start + ';'.join(times + stamps) + '\n'
+
+
+class Session:
+    """Stage state machine of one participant's experiment
+
+    Timers come from `clock`, clicks are reported with `click()`. Cycles are
+    passed to `on_cycle` once complete and their commands acknowledged."""
+
+    def __init__(self, config: Config, participant: Participant, scents: List[str],
+                 clock: Clock, device: Device,
+                 on_stage: Optional[Callable[[Stage, Stage], None]] = None,
+                 on_cycle: Optional[Callable[[Cycle], None]] = None,
+                 rng: Optional[random.Random] = None,
+                 schedule: Optional[Schedule] = None,
+                 envelopes: Optional[EnvelopePlayer] = None,
+                 started: Optional[datetime] = None):
+        self.config = config
+        self.participant = participant
+        self.scents = scents
+        """Scent on each channel, one cycle uses two of them"""
+        self.clock = clock
+        self.device = device
+        self.on_stage = on_stage
+        """Called with previous and new stage after every transition"""
+        self.on_cycle = on_cycle
+        if schedule is None:
+            seed = rng.getrandbits(63) if rng is not None else None
+            schedule = generate(config.balanced_count, config.delay.min,
+                                config.delay.max, seed, channel_count=len(scents))
+        if schedule.channel_count != len(scents):
+            raise ValueError(f'Schedule is for {schedule.channel_count} channels, '
+                             f'the session has {len(scents)}')
+        self.schedule = schedule
+        """Ordering and delays of every cycle, extended when the session runs longer"""
+        self.envelopes = envelopes
+        """Plays the switch as a crossfade when `config.crossfade` is set"""
+
+        self._stage = Stage.INIT
+        """Current experiment stage"""
+        self._entered_stage = clock.now()
+        """`clock.now()` when entered current stage"""
+        self.started = started or datetime.now()
+        """Date when the session was created, cycles are dated from it by `clock`"""
+        self._started_ns = self._entered_stage
+        self._clicked = 0
+        """`clock.now()` of the click being handled, 0 when advancing on a timer"""
+        self._timer = None
+        """Handle of the pending stage timer to cancel"""
+        self._armed_stage: Optional[Stage] = None
+        """Stage whose actuation is already queued to be written when the timer elapses"""
+        self._armed_at = 0
+        """`clock.now()` the armed actuation is due"""
+        self._armed_command: Optional[Command] = None
+        self.completed_count = 0
+        """Number of cycles completed in this session"""
+        self.unsaved_cycles: List[Cycle] = []
+        """Completed cycles waiting for their commands to be acknowledged"""
+        self._awaiting_commands = 0
+        """Actuation commands submitted but not completed yet"""
+        self.current_cycle: Cycle = None  # type: ignore
+        self.cycle_index = -1
+        """Position of `current_cycle` in the schedule"""
+        self.cycle_channels = (0, 1)
+        """Channel (from 0) turned on first and the one switched to in `current_cycle`"""
+
+    @property
+    def stage(self) -> Stage:
+        return self._stage
+
+    def start(self):
+        self.advance()
+
+    def finish(self):
+        """Stop timers, turn the device off and pass on the remaining cycles"""
+        if self._timer is not None:
+            self.clock.cancel(self._timer)
+            self._timer = None
+        if self._armed_command is not None:
+            self.cancel_armed()
+        if self.envelopes is not None:
+            self.envelopes.stop()
+        if tracer.enabled:
+            tracer.end(self._stage.name, 'stage')
+        self.save_cycles(force=True)
+        self.device.set_channels(0)
+
+    def change_stage(self, new_stage: Stage):
+        """Setter for `self._stage`, handles all state that is related only to the stage"""
+        armed = new_stage == self._armed_stage and not self._clicked
+        # an armed actuation was written on time even if the timer fired late
+        left_stage = self._clicked or (self._armed_at if armed else 0) or self.clock.now()
+        time_in_stage = (left_stage - self._entered_stage) / 1e9
+        match self._stage:
+            case Stage.TIME_ON:
+                self.current_cycle.on_wait = time_in_stage
+            case Stage.TIME_SW:
+                self.current_cycle.sw_wait = time_in_stage
+            case Stage.TIME_OFF:
+                self.current_cycle.off_wait = time_in_stage
+        if self._clicked and self._stage in STIMULUS:
+            stimulus = STIMULUS[self._stage]
+            self.current_cycle.mark(f'{stimulus}_click', self._clicked)
+            self.current_cycle.resolve_reaction(stimulus)
+        old_stage = self._stage
+        self._stage = new_stage
+        self._entered_stage = self.clock.now()
+        if tracer.enabled:  # stage names are looked up only when tracing
+            if old_stage != Stage.INIT:
+                tracer.end(old_stage.name, 'stage', self._entered_stage)
+            tracer.begin(new_stage.name, 'stage', self._entered_stage, cycle=self.cycle_index)
+
+        if self._stage == Stage.TIME_OFF and self.envelopes is not None:
+            self.envelopes.stop()  # crossfade cut short by the participant
+        if not armed:
+            self.actuate(new_stage)
+        self._armed_stage = None
+        self._armed_at = 0
+        self._armed_command = None
+        if new_stage in DELAY_INDEX:
+            delay = self.schedule.cycle(self.cycle_index)[DELAY_INDEX[new_stage]]
+            self._timer = self.clock.call_later(delay, self.timer_elapsed)
+            if self.config.precise_timing:
+                # queued now so it does not wait for the timer to run on a busy loop
+                self._armed_stage = NEXT_STAGE[new_stage]
+                self._armed_at = self._entered_stage + int(delay * 1e9)
+                self._armed_command = self.actuate(self._armed_stage, self._armed_at)
+
+        if self.on_stage is not None:
+            self.on_stage(old_stage, new_stage)
+
+    def actuate(self, stage: Stage, at: int = 0) -> Optional[Command]:
+        """Set the olfactory device for `stage`, timing the actuation of each stimulus"""
+        on_done = None
+        if stage in [Stage.ACK_ON, Stage.ACK_SW, Stage.ACK_OFF]:
+            on_done = self.actuation_timer(
+                self.current_cycle, STIMULUS[stage])
+        command = None
+        first, second = self.cycle_channels
+        match stage:
+            case Stage.ACK_SW if self.config.crossfade > 0 and self.envelopes is not None:
+                command = self.envelopes.play(
+                    crossfade(first + 1, second + 1, self.config.crossfade, self.config.intensity,
+                              self.envelopes.device.encoder.channel_count),
+                    at, on_done)
+            case Stage.START | Stage.TIME_ON | Stage.ACK_OFF:
+                command = self.device.set_channels(0, on_done, at)
+            case Stage.ACK_ON | Stage.TIME_SW:
+                command = self.device.set_channels(1 << first, on_done, at)
+            case Stage.ACK_SW | Stage.TIME_OFF:
+                command = self.device.set_channels(1 << second, on_done, at)
+        if on_done is not None and command is not None:
+            self._awaiting_commands += 1
+        return command
+
+    def cancel_armed(self) -> bool:
+        """Drop the armed actuation if not written yet"""
+        if self._armed_stage == Stage.ACK_SW and self.config.crossfade > 0 \
+                and self.envelopes is not None:
+            return self.envelopes.cancel()
+        return self.device.cancel(self._armed_command)  # type: ignore
+
+    def actuation_timer(self, cycle: Cycle, stimulus: str) -> Callable[[Command], None]:
+        """Callback storing when the command for `stimulus` was due, written and acknowledged"""
+        def done(command: Command):
+            self._awaiting_commands -= 1
+            if not command.cancelled:
+                if command.at:
+                    cycle.mark(f'{stimulus}_scheduled', command.at)
+                if command.sent:
+                    cycle.mark(f'{stimulus}_sent', command.sent)
+                if command.acknowledged:
+                    cycle.mark(f'{stimulus}_acknowledged', command.acknowledged)
+                cycle.resolve_reaction(stimulus)
+            # also when cancelled, it may have been the last command the cycle waited for
+            self.save_cycles()
+        return done
+
+    def save_cycles(self, force=False):
+        """Pass completed cycles to `on_cycle` once their timing is known"""
+        if not self.unsaved_cycles or (self._awaiting_commands > 0 and not force):
+            return
+        for cycle in self.unsaved_cycles:
+            if self.on_cycle is not None:
+                self.on_cycle(cycle)
+        self.unsaved_cycles.clear()
+
+    def timer_elapsed(self):
+        fired = self.clock.now()  # read even when not tracing, so replays see the same clock reads
+        if tracer.enabled:
+            tracer.instant('timer', 'session', fired, stage=self._stage.name)
+        self._timer = None
+        self.advance()
+
+    def click(self, timestamp: int = 0):
+        """Click by the user to advance, `timestamp` from `clock.now()` if known"""
+        clicked = timestamp or self.clock.now()
+        if tracer.enabled:
+            tracer.instant('click', 'session', clicked, stage=self._stage.name)
+        if self._timer is not None:
+            self.clock.cancel(self._timer)
+            self._timer = None
+        if self._armed_command is not None:
+            if self.cancel_armed():
+                self._armed_stage = None
+                self._armed_command = None
+            else:
+                # already written, so this is a reaction to the stimulus
+                self.advance()
+        self._clicked = clicked
+        match self._stage:
+            # was clicked prematurely
+            case Stage.TIME_ON:
+                self.current_cycle.on_reaction = -1
+            case Stage.TIME_SW:
+                self.current_cycle.sw_reaction = -1
+            case Stage.TIME_OFF:
+                self.current_cycle.off_reaction = -1
+        self.advance(False)
+        self._clicked = 0
+
+    def advance(self, timed=True):
+        """Choose next stage in the sequence, handle starting cycle"""
+        new_stage = (NEXT_STAGE if timed else NEXT_STAGE_CLICKED)[self._stage]
+        if new_stage == Stage.START and self.current_cycle is not None:
+            # counted before `on_stage` is called for the new stage
+            self.completed_count += 1
+            self.unsaved_cycles.append(self.current_cycle)
+        self.change_stage(new_stage)
+        if self._stage == Stage.START:
+            self.save_cycles()
+
+            # the pair of channels and their order come from the schedule, in balanced batches
+            self.cycle_index += 1
+            self.cycle_channels = self.schedule.channels(self.cycle_index)
+            first, second = self.cycle_channels
+
+            start_ns = self.clock.now()
+            self.current_cycle = Cycle(
+                self.started + timedelta(microseconds=(start_ns - self._started_ns) // 1000),
+                self.participant.name,
+                self.participant.gender,
+                self.participant.age,
+                self.participant.smokes,
+                self.scents[first],
+                self.scents[second],
+                start_ns=start_ns,
+            )
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Intensity envelopes (ramps, pulses, crossfades) streamed to the device at a fixed tick rate"""
+import argparse
+from dataclasses import dataclass, field
+from device import CHANNEL_COUNT, FULL_INTENSITY, Command, OlfactoryDevice
+from math import ceil, nan
+from statistics import mean
+from tracing import tracer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+BAUD_RATE = 115200
+REPLY_BYTES = 44
+"""Longest acknowledgement line, the firmware replies to every command byte"""
+COMMAND_BUDGET = BAUD_RATE / 10 / REPLY_BYTES
+"""Command bytes per second the link can acknowledge, replies are the bottleneck"""
+
+
+@dataclass
+class Envelope:
+    """Intensity of every channel over time"""
+    duration: float
+    """Seconds, the levels at the end are held afterwards"""
+    levels: Callable[[float], Tuple[int, ...]]
+    """Duty cycle of each channel in tens of percent, by seconds since the start"""
+
+
+def _levels(channel_count: int, channels: Dict[int, int]) -> Tuple[int, ...]:
+    """Intensities with `channels` (starting from 1) set and the others off"""
+    levels = [0] * channel_count
+    for channel, intensity in channels.items():
+        levels[channel - 1] = max(0, min(FULL_INTENSITY, intensity))
+    return tuple(levels)
+
+
+def hold(intensities: Tuple[int, ...], duration: float = 0.0) -> Envelope:
+    return Envelope(duration, lambda t: tuple(intensities))
+
+
+def ramp(channel: int, start: int, end: int, duration: float,
+         channel_count: int = CHANNEL_COUNT) -> Envelope:
+    """`channel` (starting from 1) from `start` to `end` intensity, the others off"""
+    def levels(t: float) -> Tuple[int, ...]:
+        fraction = min(t / duration, 1.0) if duration > 0 else 1.0
+        return _levels(channel_count, {channel: round(start + (end - start) * fraction)})
+    return Envelope(duration, levels)
+
+
+def pulse(channel: int, intensity: int, period: float, duty: float, duration: float,
+          channel_count: int = CHANNEL_COUNT) -> Envelope:
+    """`channel` on for `duty` of every `period` seconds, off at the end"""
+    def levels(t: float) -> Tuple[int, ...]:
+        on = t < duration and t % period < duty * period
+        return _levels(channel_count, {channel: intensity if on else 0})
+    return Envelope(duration, levels)
+
+
+def crossfade(from_channel: int, to_channel: int, duration: float,
+              intensity: int = FULL_INTENSITY, channel_count: int = CHANNEL_COUNT) -> Envelope:
+    """Fade `from_channel` out while `to_channel` fades in"""
+    def levels(t: float) -> Tuple[int, ...]:
+        fraction = min(t / duration, 1.0) if duration > 0 else 1.0
+        rising = round(intensity * fraction)
+        return _levels(channel_count, {from_channel: intensity - rising, to_channel: rising})
+    return Envelope(duration, levels)
+
+
+@dataclass
+class EnvelopeReport:
+    ticks: int = 0
+    commands: int = 0
+    """Ticks that changed the device state and were sent"""
+    skipped: int = 0
+    """Ticks left out to stay within the bandwidth budget"""
+    bytes: int = 0
+    deviations: List[float] = field(default_factory=list)
+    """Seconds each command was written after its tick"""
+
+    @property
+    def mean_deviation(self) -> float:
+        return mean(self.deviations) if self.deviations else nan
+
+    @property
+    def max_deviation(self) -> float:
+        return max(self.deviations, default=nan)
+
+
+class EnvelopePlayer:
+    """Streams an `Envelope` to an `OlfactoryDevice`, sending only the bytes each tick changes
+
+    Ticks are submitted up to `lead` seconds ahead with `Command.at`, so the
+    serial thread writes them on time however late `clock` runs the refill.
+    A deficit token bucket keeps the bytes per second under `budget`; a
+    skipped tick is caught up by the next one as every command is a diff of
+    the device state. The last tick is always sent."""
+
+    def __init__(self, device: OlfactoryDevice, clock: Any, tick: float = 0.05,
+                 lead: float = 0.2, budget: float = COMMAND_BUDGET):
+        self.device = device
+        self.clock = clock
+        """`engine.Clock` running the refills, on the thread using `device`"""
+        self.tick = tick
+        """Seconds between envelope samples"""
+        self.lead = lead
+        self.budget = budget
+        """Command bytes per second"""
+        self.report = EnvelopeReport()
+        """Timing of the envelope playing or played last"""
+        self._envelope: Optional[Envelope] = None
+        self._start = 0
+        self._index = 0
+        self._last_index = 0
+        self._tokens = 0.0
+        self._on_first: Optional[Callable[[Command], None]] = None
+        self._commands: List[Command] = []
+        self._timer = None
+
+    @property
+    def playing(self) -> bool:
+        return self._envelope is not None
+
+    def play(self, envelope: Envelope, start: int = 0,
+             on_first: Optional[Callable[[Command], None]] = None) -> Optional[Command]:
+        """Start `envelope` at `start` (`clock.now()` time, now if 0)
+
+        Ticks up to the first one changing the device are submitted at once,
+        however far ahead, and that command is returned (`None` if the whole
+        envelope changes nothing); `on_first` is only called for it."""
+        self.stop()
+        self._envelope = envelope
+        self._start = start or self.clock.now()
+        self._index = 0
+        self._last_index = ceil(envelope.duration / self.tick - 1e-9)
+        self._tokens = self.budget * self.lead
+        self._on_first = on_first
+        self._commands = []
+        self.report = EnvelopeReport()
+        self._fill()
+        return self._commands[0] if self._commands else None
+
+    def cancel(self) -> bool:
+        """Stop if nothing was written yet, `False` if already playing on the device"""
+        if any(command.sent for command in self._commands):
+            return False
+        return self.stop()
+
+    def stop(self) -> bool:
+        """Drop the ticks not written yet, `False` if some could not be dropped
+
+        The device keeps the levels already written."""
+        if self._timer is not None:
+            self.clock.cancel(self._timer)
+            self._timer = None
+        dropped = True
+        for command in reversed(self._commands):
+            if not command.sent and not command.error and not command.cancelled:
+                dropped = self.device.cancel(command) and dropped
+        self._envelope = None
+        return dropped
+
+    def _fill(self):
+        self._timer = None
+        envelope = self._envelope
+        if envelope is None:
+            return
+        horizon = self.clock.now() + int(self.lead * 1e9)
+        tick = int(self.tick * 1e9)
+        while self._index <= self._last_index:
+            at = self._start + self._index * tick
+            if at > horizon and self._commands:
+                break
+            final = self._index == self._last_index
+            self._tokens = min(self._tokens + self.budget * self.tick, self.budget * self.lead)
+            self.report.ticks += 1
+            if self._tokens < 0 and not final:
+                self.report.skipped += 1
+            else:
+                levels = envelope.levels(min(self._index * self.tick, envelope.duration))
+                on_done = self._on_first if not self._commands else None
+                command = self.device.set_intensities(levels, self._done(on_done), at)
+                if command is not None:
+                    self._commands.append(command)
+                    self._tokens -= len(command.data)
+                    self.report.commands += 1
+                    self.report.bytes += len(command.data)
+            self._index += 1
+        if self._index <= self._last_index:
+            due = self._start + self._index * tick - int(self.lead * 1e9) - self.clock.now()
+            self._timer = self.clock.call_later(max(due / 1e9, self.lead / 2), self._fill)
+        else:
+            self._envelope = None
+            tracer.instant('envelope', 'device', ticks=self.report.ticks,
+                           skipped=self.report.skipped, bytes=self.report.bytes)
+
+    def _done(self, on_done: Optional[Callable[[Command], None]]) -> Callable[[Command], None]:
+        def done(command: Command):
+            if command.sent and command.at:
+                self.report.deviations.append((command.sent - command.at) / 1e9)
+            if on_done is not None:
+                on_done(command)
+        return done
+
+
+if __name__ == '__main__':
+    import asyncio
+    from orchestrator import LoopClock
+    import serial
+    from device import SerialWorker
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('port')
+    parser.add_argument('--tick', type=float, default=0.05, help='seconds between samples')
+    shapes = parser.add_subparsers(dest='shape', required=True)
+    shape = shapes.add_parser('ramp')
+    shape.add_argument('channel', type=int)
+    shape.add_argument('start', type=int)
+    shape.add_argument('end', type=int)
+    shape.add_argument('duration', type=float)
+    shape = shapes.add_parser('pulse')
+    shape.add_argument('channel', type=int)
+    shape.add_argument('intensity', type=int)
+    shape.add_argument('period', type=float)
+    shape.add_argument('duty', type=float)
+    shape.add_argument('duration', type=float)
+    shape = shapes.add_parser('crossfade')
+    shape.add_argument('from_channel', type=int)
+    shape.add_argument('to_channel', type=int)
+    shape.add_argument('duration', type=float)
+    args = parser.parse_args()
+
+    match args.shape:
+        case 'ramp':
+            envelope = ramp(args.channel, args.start, args.end, args.duration)
+        case 'pulse':
+            envelope = pulse(args.channel, args.intensity, args.period, args.duty, args.duration)
+        case _:
+            envelope = crossfade(args.from_channel, args.to_channel, args.duration)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        port = serial.Serial(args.port, 115200, timeout=0.1, write_timeout=None)
+        worker = SerialWorker(port, notify=lambda: loop.call_soon_threadsafe(worker.dispatch))
+        worker.start()
+        device = OlfactoryDevice(worker.submit, cancel=worker.cancel)
+        player = EnvelopePlayer(device, LoopClock(loop), args.tick)
+        player.play(envelope)
+        await asyncio.sleep(envelope.duration + 0.5)
+        device.set_channels(0)
+        worker.stop(timeout=2 * worker.ack_timeout)
+        worker.dispatch()
+        port.close()
+        return player.report
+
+    report = asyncio.run(main())
+    print(f'{report.ticks} ticks, {report.commands} commands ({report.bytes} bytes), '
+          f'{report.skipped} skipped for bandwidth, deviation mean '
+          f'{1000 * report.mean_deviation:.3f} ms, max {1000 * report.max_deviation:.3f} ms')
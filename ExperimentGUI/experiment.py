@@ -1,45 +1,39 @@
 #!/usr/bin/env python3
-from dataclasses import dataclass
+from audio import SILENCE, FilePlayer, Player, open_player
+from collections import deque
 from datetime import datetime
-from enum import Enum, auto
+from device import CHANNEL_COUNT, Command, OlfactoryDevice, SerialWorker
+from engine import Config, Cycle, Participant, Session, Stage, load_config
+from envelope import EnvelopePlayer
 import locale
-from math import nan
-import random
+from math import ceil
+from monitor import LatencyMonitor
+from ports import Port, PortScanner, load_last_port, save_last_port
 import re
+from replay import Recorder
+from results import CycleBuffer, ResultWriter
+from schedule import Schedule, generate
 import serial
-from serial.tools import list_ports
-from time import time
+from statistics import fmean
+from store import ResultStore
+from time import perf_counter_ns
 from tkinter import *  # pyright: ignore (this is tkinter style)
 from tkinter import font
 from tkinter import ttk
-import tomllib
-from typing import List
-import winsound
+from tracing import tracer
+from typing import Any, Callable, Deque, Dict, List, Optional
 
 
-@dataclass
-class Delay:
-    min = 5.0
-    max = 10.0
-
-
-@dataclass
-class Config:
-    locale = 'it_IT'
-    """Locale for formatting numbers in CSV output"""
-    scents = ['Undefined 1', 'Undefined 2']
-    """Scents available to choose in the window"""
-    delay = Delay()
-    """Random delay for `TIME_*` stages"""
-    balanced_count = 5
-    """Number of each ordering in a balanced batch"""
+POLL_INTERVAL = 5
+"""Milliseconds between checks for completed serial commands"""
+PORT_POLL_INTERVAL = 250
+"""Milliseconds between checks for ports found by the scanner"""
 
 
 class ControlWindow:
     def __init__(self, root: Tk, config: Config):
         self.root = root
         self.config = config
-        self.olfactory_state = (None, None)  # type: ignore
         root.title("Olfactory reaction experiment")
 
         self.com_port = StringVar()
@@ -63,49 +57,64 @@ class ControlWindow:
 
         ttk.Button(hardframe, text='Refresh',
                    command=self.refresh_ports).grid(column=3, row=0)
-        self.refresh_ports()
+        self.ports: Dict[str, Port] = {}
+        self.last_port = load_last_port()
+        self.auto_connect = True
+        """Connect `last_port` when it appears, off once the operator disconnected"""
+        self.store = ResultStore(config.store) if config.store else None
+        """Results of all sessions, also checked for returning participants"""
+        self.scanner = PortScanner()
+        self.scanner.start()
+        # from the Tk loop, so a fast first scan cannot connect before the widgets exist
+        self.root.after(0, self.update_ports)
 
         self.serial: serial.Serial = None  # type: ignore
+        self.device: SerialWorker = None  # type: ignore
+        self.olfactory: OlfactoryDevice = None  # type: ignore
         self.experiment_window = None
         self.connect_btn = ttk.Button(
             hardframe, text='Connect', command=self.connect)
         self.connect_btn.grid(column=0, row=1)
         self.disconnect_btn = ttk.Button(
-            hardframe, text='Disconnect', command=self.disconnect)
+            hardframe, text='Disconnect', command=self.disconnect_clicked)
         self.disconnect_btn.grid(column=1, row=1)
 
-        self.ch1_btn = ttk.Button(
-            hardframe, text='Channel 1', command=lambda: self.set_olfactory(True, False))
-        self.ch1_btn.grid(column=0, row=2)
-        self.ch2_btn = ttk.Button(
-            hardframe, text='Channel 2', command=lambda: self.set_olfactory(False, True))
-        self.ch2_btn.grid(column=1, row=2)
-        self.both_btn = ttk.Button(
-            hardframe, text='Both', command=lambda: self.set_olfactory(True, True))
-        self.both_btn.grid(column=2, row=2)
+        channelframe = ttk.Frame(hardframe)
+        channelframe.grid(column=0, row=2, columnspan=4, sticky='w')
+        self.channel_btns = []
+        for channel in range(config.channels):
+            self.channel_btns.append(ttk.Button(
+                channelframe, text=f'Channel {channel + 1}',
+                command=lambda channel=channel: self.set_channels(1 << channel)))
+            self.channel_btns[-1].grid(column=channel % 4, row=channel // 4)
+        self.all_btn = ttk.Button(
+            channelframe, text='All', command=lambda: self.set_channels((1 << config.channels) - 1))
+        self.all_btn.grid(column=0, row=(config.channels - 1) // 4 + 1)
         self.none_btn = ttk.Button(
-            hardframe, text='None', command=lambda: self.set_olfactory(False, False))
-        self.none_btn.grid(column=3, row=2)
+            channelframe, text='None', command=lambda: self.set_channels(0))
+        self.none_btn.grid(column=1, row=(config.channels - 1) // 4 + 1)
+        self.device_text = StringVar()
+        ttk.Label(hardframe, textvariable=self.device_text).grid(
+            column=0, row=3, columnspan=4, sticky='w')
 
         expframe = ttk.Labelframe(
             mainframe, text='Experiment:', padding=padding)
         expframe.grid(column=0, row=1, sticky='we')
-        expframe.columnconfigure(0, weight=1)
-        expframe.columnconfigure(1, weight=1)
 
-        self.ch1_scent = StringVar()
-        self.ch2_scent = StringVar()
+        # assigned in the configured order, the experimenter can still change them
+        self.channel_scents = [StringVar(value=self.config.scents[channel]
+                                         if channel < len(self.config.scents) else '')
+                               for channel in range(config.channels)]
         ttk.Label(expframe, text='Select scent for each channel:').grid(
-            column=0, row=0, sticky='w')
-        self.radio1 = []
-        self.radio2 = []
-        for col, (scent, radio) in enumerate([(self.ch1_scent, self.radio1), (self.ch2_scent, self.radio2)]):
+            column=0, row=0, columnspan=config.channels, sticky='w')
+        for col, scent in enumerate(self.channel_scents):
+            expframe.columnconfigure(col, weight=1)
             frame = ttk.Frame(expframe)
-            frame.grid(column=col, row=1, sticky='w')
+            frame.grid(column=col, row=1, sticky='nw')
+            ttk.Label(frame, text=f'Channel {col + 1}').grid(column=0, row=0, sticky='w')
             for i, name in enumerate(self.config.scents):
-                radio.append(ttk.Radiobutton(
-                    frame, text=name, variable=scent, value=name, command=self.update_active))
-                radio[-1].grid(column=0, row=i, sticky='w')
+                ttk.Radiobutton(frame, text=name, variable=scent, value=name,
+                                command=self.update_active).grid(column=0, row=i + 1, sticky='w')
 
         partframe = ttk.Labelframe(
             mainframe, text='Participant:', padding=padding)
@@ -139,6 +148,16 @@ class ControlWindow:
         smokes_box.grid(column=1, row=5, sticky='w')
         smokes_box.bind('<<ComboboxSelected>>', self.update_active)
 
+        self.queue: Deque[Participant] = deque()
+        """Participants to run one after another in the same experiment window"""
+        self.queue_btn = ttk.Button(
+            partframe, text='Add to queue', command=self.queue_participant)
+        self.queue_btn.grid(column=0, row=6, sticky='e')
+        self.queue_list = Listbox(partframe, height=4)
+        self.queue_list.grid(column=1, row=6, rowspan=2, sticky='we')
+        ttk.Button(partframe, text='Remove', command=self.remove_queued).grid(
+            column=0, row=7, sticky='ne')
+
         self.error_text = StringVar()
         ttk.Label(mainframe, textvariable=self.error_text,
                   foreground='red').grid(column=0, row=9)
@@ -154,18 +173,69 @@ class ControlWindow:
         self.update_active()
 
     def refresh_ports(self, *args):
-        ports = list_ports.comports()
-        text_list = [f'{p[0]} - {p[1]}' for p in ports]
-        self.ports_box['values'] = tuple(text_list)
+        self.scanner.rescan()
+
+    def update_ports(self):
+        """Apply ports plugged in or out since the last check, reconnecting the last used one"""
+        changes = self.scanner.changes()
+        if changes is not None:
+            added, removed = changes
+            for port in removed:
+                self.ports.pop(port.device, None)
+            for port in added:
+                self.ports[port.device] = port
+            text_list = [port.label for port in self.ports.values()]
+            text_list.extend(self.config.ports)
+            self.ports_box['values'] = tuple(text_list)
+
+            if self.serial is not None and \
+                    any(port.device == self.serial.port for port in removed):
+                self.disconnect()
+                self.device_text.set(f'{self.last_port} unplugged, waiting for it to return')
+            if self.serial is None:  # also when replugged since the last check
+                selected = self.com_port.get().split(' - ')[0]
+                if self.auto_connect and self.last_port in self.ports:
+                    self.com_port.set(self.ports[self.last_port].label)
+                    self.connect()
+                elif selected not in self.ports and selected not in self.config.ports:
+                    arduinos = [port for port in self.ports.values() if port.is_arduino]
+                    self.com_port.set(arduinos[0].label if len(arduinos) == 1 else '')
+                    self.update_active()
+        self.root.after(PORT_POLL_INTERVAL, self.update_ports)
 
     def connect(self, *args):
-        self.serial = serial.Serial(
-            self.com_port.get().split(' - ')[0], 115200,
-            timeout=None,        # blocking mode, wait until requested number of bytes
-            write_timeout=None)  # blocking mode, infinite timeout; setting to 0 would fail silently
+        device = self.com_port.get().split(' - ')[0]
+        try:
+            self.serial = serial.serial_for_url(  # also opens socket:// URLs of broker.py
+                device, 115200,
+                timeout=0.1,         # the worker polls for acknowledgements until its own deadline
+                write_timeout=None)  # blocking mode, infinite timeout; setting to 0 would fail silently
+        except serial.SerialException as e:
+            self.device_text.set(f'Cannot open {device}: {e}')
+            return
+        if device != self.last_port:
+            self.last_port = device
+            save_last_port(device)
+        self.auto_connect = True
+        self.device_text.set(f'Connected to {device}')
+        self.device = SerialWorker(self.serial)
+        self.device.start()
+        self.olfactory = OlfactoryDevice(
+            self.device.submit, max(CHANNEL_COUNT, self.config.channels), self.config.intensity,
+            cancel=self.device.cancel)
+        self.poll_device()
         self.update_active()
 
+    def disconnect_clicked(self, *args):
+        """Disconnect and stay disconnected until the operator connects again"""
+        self.auto_connect = False
+        self.disconnect()
+
     def disconnect(self, *args):
+        self.device.stop(timeout=2 * self.device.ack_timeout)
+        self.device.dispatch()
+        self.device = None  # type: ignore
+        self.olfactory = None  # type: ignore
         self.serial.close()
         self.serial = None  # type: ignore
         self.update_active()
@@ -180,148 +250,199 @@ class ControlWindow:
             self.serial is None) else 'disabled'
         self.connect_btn['state'] = 'normal' \
             if (self.serial is None and self.com_port.get() != '') else 'disabled'
-        for button in [self.disconnect_btn, self.ch1_btn, self.ch2_btn, self.both_btn, self.none_btn]:
+        for button in [self.disconnect_btn, *self.channel_btns, self.all_btn, self.none_btn]:
             button['state'] = 'normal' if self.serial is not None else 'disabled'
 
         self.experiment_btn['state'] = 'disabled'
+        self.queue_btn['state'] = 'disabled'
         if self.serial is None:
             self.error_text.set('Connect the olfactory device')
             return False
-        if (self.ch1_scent.get() == '') or (self.ch2_scent.get() == ''):
+        scents = self.scents
+        if '' in scents:
             self.error_text.set('Choose scent for each channel')
             return False
-        if self.ch1_scent.get() == self.ch2_scent.get():
+        if len(set(scents)) != len(scents):
             self.error_text.set('The scent must be different for each channel')
             return False
-        if self.participant_name.get() == '':
-            self.error_text.set('Enter participant identifier')
+        error = self.participant_error()
+        if error and not (self.queue and self.form_empty()):
+            self.error_text.set(error)
             return False
+
+        self.error_text.set('')
+        if not error:
+            self.queue_btn['state'] = 'normal'
+            name = self.participant_name.get()
+            sessions = self.store.sessions(name) if self.store is not None else []
+            if any(participant.name == name for participant in self.queue):
+                self.error_text.set('Identifier already in the queue')
+            elif sessions:
+                # a warning only, a participant may return or two may share initials
+                self.error_text.set(f'Identifier already used in {len(sessions)} sessions, '
+                                    f'last on {sessions[-1][0][:10]}')
+        # queueing stays open during a run, a second window would share the device
+        if self.experiment_window is None:
+            self.experiment_btn['state'] = 'normal'
+        return True
+
+    def form_empty(self) -> bool:
+        """No participant details entered, so the queue can start on its own"""
+        return not any(field.get() for field in [self.participant_name, self.participant_gender,
+                                                 self.participant_age, self.participant_smokes])
+
+    def participant_error(self) -> str:
+        """Reason the entered participant details are incomplete, empty if valid"""
+        if self.participant_name.get() == '':
+            return 'Enter participant identifier'
         if len(self.participant_name.get()) != 6:
-            self.error_text.set(
-                'Identifier should be three first letters of name and surname')
-            return False
+            return 'Identifier should be three first letters of name and surname'
         if self.participant_gender.get() == '':
-            self.error_text.set('Select participant gender')
-            return False
+            return 'Select participant gender'
         if self.participant_age.get() == '':
-            self.error_text.set('Enter participant age')
-            return False
+            return 'Enter participant age'
         try:
             age = int(self.participant_age.get())
             if age <= 0:
-                self.error_text.set('Age must be a positive number')
-                return False
+                return 'Age must be a positive number'
         except ValueError:
-            self.error_text.set('Age must be a valid number')
-            return False
+            return 'Age must be a valid number'
         if self.participant_smokes.get() == '':
-            self.error_text.set('Select if participant smokes')
-            return False
-
-        self.error_text.set('')
-        self.experiment_btn['state'] = 'normal'
-        return True
+            return 'Select if participant smokes'
+        return ''
+
+    def queue_participant(self, *args):
+        """Move the entered participant to the end of the queue and clear the details"""
+        if self.participant_error():
+            return
+        participant = Participant(
+            self.participant_name.get(),
+            self.participant_gender.get(),
+            int(self.participant_age.get()),
+            self.participant_smokes.get())
+        self.queue.append(participant)
+        self.queue_list.insert(END, participant.name)
+        for field in [self.participant_name, self.participant_gender,
+                      self.participant_age, self.participant_smokes]:
+            field.set('')
+        self.update_active()
 
-    def set_olfactory(self, ch1: bool, ch2: bool):
-        """Send olfactory command over serial"""
-        command = '0'
-        if ch1:
-            command = command + '1'
-        if ch2:
-            command = command + '2'
+    def remove_queued(self, *args):
+        for index in reversed(self.queue_list.curselection()):
+            self.queue_list.delete(index)
+            del self.queue[index]
+        self.update_active()
 
-        if self.serial is not None:
-            # TODO: Handle serial error better: indicate in GUI, save experiment data
-            self.serial.write(command.encode('ascii'))
-            self.olfactory_state = (ch1, ch2)
-            self.serial.read_all()  # empty the OS buffer
+    def next_participant(self) -> Optional[Participant]:
+        """Take the first participant off the queue"""
+        if not self.queue:
+            return None
+        self.queue_list.delete(0)
+        return self.queue.popleft()
+
+    @property
+    def scents(self) -> List[str]:
+        """Scent chosen for each channel, empty if not chosen"""
+        return [scent.get() for scent in self.channel_scents]
+
+    def set_channels(self, channels: int,
+                     on_done: Optional[Callable[[Command], None]] = None,
+                     at: int = 0) -> Optional[Command]:
+        """Queue the bytes turning on the channels in bitmask `channels`, returns without waiting
+
+        Returns `None` when the device is already in the requested state."""
+        if self.device is not None:
+            def done(result: Command):
+                self.command_done(result)
+                if on_done is not None:
+                    on_done(result)
+            return self.olfactory.set_channels(channels, done, at)
+        return None
+
+    def cancel(self, command: Command) -> bool:
+        """Drop a scheduled command not written yet"""
+        return self.olfactory is not None and self.olfactory.cancel(command)
+
+    def command_done(self, command: Command):
+        """Show the outcome of a completed command"""
+        if command.cancelled:
+            return
+        if command.error:
+            self.device_text.set(
+                f'Command {command.data.decode("ascii")} failed: {command.error}')
+        else:
+            self.device_text.set(
+                f'Command {command.data.decode("ascii")} acknowledged in {1000 * command.latency:.1f} ms')
+
+    def poll_device(self):
+        """Deliver completed commands on the Tk thread while connected"""
+        if self.device is not None:
+            self.device.dispatch()
+            self.root.after(POLL_INTERVAL, self.poll_device)
 
     def show_experiment_window(self, *args):
-        if self.update_active():
-            self.experiment_window = ExperimentWindow(self.root, self)
-
-
-class Stage(Enum):
-    INIT = auto(),
-    """Experiment initialised"""
-    START = auto(),
-    """Ready to start next cycle"""
-    TIME_ON = auto(),
-    """Waiting for emitter to turn on"""
-    ACK_ON = auto(),
-    """Waiting for user to notice emitter is on"""
-    TIME_SW = auto(),
-    """Waiting for emitters to switch"""
-    ACK_SW = auto(),
-    """Waiting for user to acknowledge the switch"""
-    TIME_OFF = auto(),
-    """Waiting for emitter 2 to turn off"""
-    ACK_OFF = auto(),
-    """Waiting for user to notice turn off"""
-
-
-@dataclass
-class Cycle:
-    """Data saved from one experiment run"""
-    start_date: datetime
-    """Experiment start time"""
-    participant_name: str
-    """Anonymised name of test participant"""
-    gender: str
-    """Participant gender"""
-    age: int
-    """Participant age"""
-    smokes: str
-    """Participant smoking tobacco"""
-    scent1: str
-    """Scent turned on first"""
-    scent2: str
-    """Scent turned on second"""
-    on_wait: float = nan
-    """Random time until emitter 1 turned on"""
-    on_reaction: float = nan
-    """Time until user noticed the change, -1 if before"""
-    sw_wait: float = nan
-    """Random time until emitters switched"""
-    sw_reaction: float = nan
-    """Time until user noticed the change, -1 if before"""
-    off_wait: float = nan
-    """Random time until emitter 2 turned off"""
-    off_reaction: float = nan
-    """Time until user noticed the change, -1 if before"""
-
-    @staticmethod
-    def csv_header() -> str:
-        return '"cycle start [ISO 8601]";"participant anonymous name";"participant gender";"participant age";"participant smokes";"scent 1";"scent 2";' + \
-            '"turn on 1 [s]";"on reaction [s]";"switch [s]";"switch reaction [s]";"turn off [s]";"turn off reaction [s]"\n'
-
-    def to_csv(self) -> str:
-        start = f'{self.start_date.isoformat()};"{self.participant_name}";"{self.gender}";' + \
-                f'{self.age};"{self.smokes}";"{self.scent1}";"{self.scent2}";'
-        times = [locale.format_string('%.3f', t) for t in [self.on_wait, self.on_reaction,
-                                                           self.sw_wait, self.sw_reaction,
-                                                           self.off_wait, self.off_reaction]]
-        return start + ';'.join(times) + '\n'
+        if self.experiment_window is None and self.update_active():
+            self.queue_participant()  # entered last, so run last
+            ExperimentWindow(self.root, self)
+            self.update_active()
+
+
+class TkClock:
+    """`engine.Clock` using Tk timers, which fire with millisecond resolution"""
+
+    def __init__(self, widget: Misc, monitor: Optional[LatencyMonitor] = None):
+        self.widget = widget
+        self.monitor = monitor
+        """Told how late each timer fired"""
+
+    def now(self) -> int:
+        return perf_counter_ns()
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> str:
+        # rounded up, so a stage never changes before its armed actuation is written
+        if self.monitor is None:
+            return self.widget.after(ceil(1000 * delay), callback)
+        scheduled = perf_counter_ns() + int(delay * 1e9)
+
+        def fired():
+            self.monitor.timer_fired(scheduled, perf_counter_ns())  # type: ignore
+            callback()
+        return self.widget.after(ceil(1000 * delay), fired)
+
+    def cancel(self, handle: str):
+        self.widget.after_cancel(handle)
 
 
 class ExperimentWindow(Toplevel):
+    """Fullscreen window running the queued participants one after another
+
+    The widgets, the sound loop, the clock and the latency monitor are set up
+    once and reused; each participant gets a new `Session`. Cycles are
+    written as they complete and kept in a `CycleBuffer` for the summary
+    printed when the participant ends."""
+
     def __init__(self, root, control: ControlWindow):
         super().__init__(root)
         self.control = control
-
-        self._stage = Stage.INIT
-        """Current experiment stage"""
-        self._entered_stage = time()
-        """Time when entered current stage"""
-        self._after_reference = ''
-        """Reference from `after()` method to cancel"""
-        self.complete_cycles: List[Cycle] = []
-        self.current_cycle: Cycle = None  # type: ignore
-        self.balanced_reverses = []
-        self.reversed_cycle = False
-
-        winsound.PlaySound('White_noise.wav',
-                           winsound.SND_ASYNC | winsound.SND_LOOP)
+        # set before anything can close the window, which clears it again
+        control.experiment_window = self
+        self.results: ResultWriter = None  # type: ignore
+        self.store = control.store
+        self.store_session = 0
+        """Id of the current session in `store`"""
+        self.buffer = CycleBuffer()
+        """Completed cycles of the current participant, for `summary()`"""
+        self.basename = ''
+        """Name of the current participant's results and schedule files without extension"""
+
+        config = self.control.config
+        try:
+            player = open_player(config.audio, 'White_noise.wav', config.audio_buffer)
+        except (OSError, ValueError) as e:
+            print(f'Cannot play the masking noise: {e}')
+            player = FilePlayer(SILENCE, config.audio_buffer)  # the experiment runs silent
+        self.player: Player = player
+        """Loops the masking noise on its own thread, started with the first session"""
 
         self.title('Experiment')
         self.geometry('1920x1080')
@@ -329,7 +450,7 @@ class ExperimentWindow(Toplevel):
 
         self.bind('<ButtonPress-1>', self.acknowledge)  # LMB
         # self.bind('<MouseWheel>', self.acknowledge)  # HACK: Scroll for testing
-        self.bind('<ButtonPress-3>', self.quit)  # RMB
+        self.bind('<ButtonPress-3>', self.end_participant)  # RMB
         # when window is closed by system
         self.protocol('WM_DELETE_WINDOW', self.quit)
 
@@ -347,41 +468,78 @@ class ExperimentWindow(Toplevel):
         ttk.Label(
             self.mainframe, text='Click right mouse button to end', font=bigFont).grid(column=1, row=2, sticky='sw')
         self.cycletext = StringVar()
-        self.cycletext.set(
-            f'(participant "{self.control.participant_name.get()}")')
         ttk.Label(self.mainframe, textvariable=self.cycletext,
                   font=bigFont).grid(column=1, row=3, sticky='sw')
 
-        self.advance()
-
-    def change_stage(self, new_stage):
-        """Setter for `self._stage`, handles all state that is related only to the stage"""
-        print(f'Changing from {self._stage} to {new_stage}', end='')
-        time_in_stage = time() - self._entered_stage
-        match self._stage:
-            case Stage.TIME_ON:
-                self.current_cycle.on_wait = time_in_stage
-            case Stage.ACK_ON:
-                self.current_cycle.on_reaction = time_in_stage
-            case Stage.TIME_SW:
-                self.current_cycle.sw_wait = time_in_stage
-            case Stage.ACK_SW:
-                self.current_cycle.sw_reaction = time_in_stage
-            case Stage.TIME_OFF:
-                self.current_cycle.off_wait = time_in_stage
-            case Stage.ACK_OFF:
-                self.current_cycle.off_reaction = time_in_stage
-        if new_stage in [Stage.TIME_ON, Stage.TIME_SW, Stage.TIME_OFF]:
-            delay = int(1000 * random.uniform(self.control.config.delay.min,
-                        self.control.config.delay.max))  # delay in milliseconds
-            self._after_reference = self.after(delay, self.stage_elapsed)
-        self._stage = new_stage
-        self._entered_stage = time()
-
-        # Set displayed text
-        match self._stage:
+        self.monitor = LatencyMonitor(self)
+        self.monitor.start()
+        self.clock = TkClock(self, self.monitor)
+        self.envelopes: Optional[EnvelopePlayer] = None
+        if config.crossfade > 0 and self.control.olfactory is not None:
+            # own clock, so crossfade refills do not count as late stage timers
+            self.envelopes = EnvelopePlayer(self.control.olfactory, TkClock(self))
+        self.session: Session = None  # type: ignore
+        self.recorder: Optional[Recorder] = None
+        """Logs the inputs of the current session when `config.record` is set"""
+        self.start_participant()
+        if self.session is not None:  # not closed at once
+            self.player.start()
+
+    def start_participant(self):
+        """Start a session for the next participant in the queue, close if none or no schedule"""
+        config = self.control.config
+        scents = self.control.scents
+        try:
+            if config.schedule:
+                schedule = Schedule.load(config.schedule)
+            else:
+                schedule = generate(config.balanced_count, config.delay.min, config.delay.max,
+                                    channel_count=len(scents))
+            if schedule.channel_count != len(scents):
+                raise ValueError(f'it is for {schedule.channel_count} channels, '
+                                 f'{len(scents)} scents are chosen')
+        except (OSError, ValueError) as e:
+            # the participant stays in the queue for when the schedule is fixed
+            error = f'Cannot use the schedule {config.schedule}: {e}' if config.schedule else str(e)
+            print(error)
+            self.quit()
+            self.control.error_text.set(error)
+            return
+        participant = self.control.next_participant()
+        if participant is None:
+            self.quit()
+            return
+        self.basename = datetime.now().strftime('%Y%m%dT%H%M%S') + f'_{participant.name}'
+        # kept with the results to audit or rerun the session on another station
+        schedule.save(self.basename + '.schedule')
+        print(f'Schedule seed {schedule.seed}, digest {schedule.digest()}')
+        if self.store is not None:
+            self.store_session = self.store.begin_session(participant, scents, schedule.digest())
+        if config.trace:
+            tracer.start(self.basename + '.trace.json')
+        self.cycletext.set(f'(participant "{participant.name}")')
+        if config.record and self.envelopes is None and self.control.olfactory is not None:
+            self.recorder = Recorder(
+                config, participant, scents, schedule, self.clock, self.control,
+                self.control.olfactory, on_stage=self.stage_changed, on_cycle=self.save_cycle)
+            self.session = self.recorder.session
+        else:
+            self.session = Session(
+                config, participant, scents, self.clock, self.control,
+                on_stage=self.stage_changed, on_cycle=self.save_cycle, schedule=schedule,
+                envelopes=self.envelopes)
+        self.session.start()
+
+    def stage_changed(self, old_stage: Stage, new_stage: Stage):
+        """Update the displayed text after a stage transition"""
+        match new_stage:
             case Stage.START:
+                if self.session.current_cycle is not None:
+                    self.monitor.attach(self.session.current_cycle)  # the cycle just completed
                 self.statustext.set('Click to start next cycle')
+                if self.session.completed_count > 0:
+                    self.cycletext.set(f'(participant "{self.session.participant.name}",' +
+                                       f'completed cycles: {self.session.completed_count}/{self.session.schedule.batch_size})')
             case Stage.TIME_ON | Stage.ACK_ON:
                 self.statustext.set('Click when you feel the scent')
             case Stage.TIME_SW | Stage.ACK_SW:
@@ -389,113 +547,91 @@ class ExperimentWindow(Toplevel):
             case Stage.TIME_OFF | Stage.ACK_OFF:
                 self.statustext.set("Click when you don't feel the scent")
 
-        # Set olfactory device
-        match self._stage:
-            case Stage.START | Stage.TIME_ON | Stage.ACK_OFF:
-                self.control.set_olfactory(False, False)
-            case Stage.ACK_ON | Stage.TIME_SW:
-                self.control.set_olfactory(
-                    not self.reversed_cycle, self.reversed_cycle)
-            case Stage.ACK_SW | Stage.TIME_OFF:
-                self.control.set_olfactory(
-                    self.reversed_cycle, not self.reversed_cycle)
-        print(f', olfactory state: {self.control.olfactory_state}')
-
-    def stage_elapsed(self):
-        self.advance()
-
-    def acknowledge(self, *args):
+    def save_cycle(self, cycle: Cycle):
+        """Write a completed cycle at once, so a crash loses none, and keep it for the summary"""
+        self.write_cycle(cycle)
+        if self.store is not None:
+            self.store.commit()
+        self.buffer.append(cycle)
+
+    def write_cycle(self, cycle: Cycle):
+        """Append a cycle to the results store or file"""
+        if self.store is not None:
+            self.store.write(self.store_session, cycle)
+            return
+        if self.results is None:
+            self.results = ResultWriter(self.basename + '.csv', Cycle.csv_header())
+        self.results.write(cycle.to_csv())
+
+    def summary(self) -> str:
+        """Mean reaction times of the current participant's cycles"""
+        means = []
+        for stimulus in ('on', 'sw', 'off'):
+            reactions = [reaction for cycle in self.buffer
+                         if (reaction := getattr(cycle, f'{stimulus}_reaction')) >= 0]
+            means.append(f'{fmean(reactions):.3f}' if reactions else '-')
+        return f'{len(self.buffer)} cycles, mean reaction on/switch/off {"/".join(means)} s'
+
+    def acknowledge(self, event: Event):
         """Click by the user to advance"""
-        try:
-            self.after_cancel(self._after_reference)
-        except:
-            pass
-        match self._stage:
-            # was clicked prematurely
-            case Stage.TIME_ON:
-                self.current_cycle.on_reaction = -1
-            case Stage.TIME_SW:
-                self.current_cycle.sw_reaction = -1
-            case Stage.TIME_OFF:
-                self.current_cycle.off_reaction = -1
-        self.advance(False)
-
-    def advance(self, timed=True):
-        """Choose next stage in the sequence, handle starting cycle"""
-        next_stage = {
-            Stage.INIT: Stage.START,
-            Stage.START: Stage.TIME_ON,
-            Stage.TIME_ON: Stage.ACK_ON if timed else Stage.TIME_SW,
-            Stage.ACK_ON: Stage.TIME_SW,
-            Stage.TIME_SW: Stage.ACK_SW if timed else Stage.TIME_OFF,
-            Stage.ACK_SW: Stage.TIME_OFF,
-            Stage.TIME_OFF: Stage.ACK_OFF if timed else Stage.START,
-            Stage.ACK_OFF: Stage.START,
-        }
-        self.change_stage(next_stage[self._stage])
-        if self._stage == Stage.START:
-            # save the completed cycle
-            if self.current_cycle is not None:
-                self.complete_cycles.append(self.current_cycle)
-                self.cycletext.set(f'(participant "{self.control.participant_name.get()}",' +
-                                   f'completed cycles: {len(self.complete_cycles)}/{self.control.config.balanced_count * 2})')
-
-            # create a new balanced list if just starting or completed all
-            if len(self.balanced_reverses) == 0:
-                count = self.control.config.balanced_count
-                self.balanced_reverses.extend([True for _ in range(count)])
-                self.balanced_reverses.extend([False for _ in range(count)])
-                random.shuffle(self.balanced_reverses)
-
-            # choose if this cycle will be in normal or reversed order
-            self.reversed_cycle = self.balanced_reverses.pop()
-
-            self.current_cycle = Cycle(
-                datetime.now(),
-                self.control.participant_name.get(),
-                self.control.participant_gender.get(),
-                int(self.control.participant_age.get()),
-                self.control.participant_smokes.get(),
-                (self.control.ch1_scent.get() if (not self.reversed_cycle)
-                 else self.control.ch2_scent.get()),
-                (self.control.ch2_scent.get() if (not self.reversed_cycle)
-                 else self.control.ch1_scent.get()),
-            )
+        handled = perf_counter_ns()
+        # before the click, which may complete the cycle and attach the statistics to it
+        self.monitor.input_event(event, handled)
+        if self.recorder is not None:
+            self.recorder.click(handled)
+        else:
+            self.session.click(handled)
+
+    def finish_participant(self):
+        """Stop the session and save its cycles"""
+        if self.recorder is not None:
+            self.recorder.finish()
+            self.recorder.save(self.basename + '.replay.json')
+            self.recorder = None
+        else:
+            self.session.finish()
+        tracer.stop()
+        print(f'Participant "{self.session.participant.name}": {self.summary()}')
+        if self.store is not None:
+            self.store.commit()
+            print(f'Saved {len(self.buffer)} cycles to {self.store.path}')
+        self.buffer.clear()
+        if self.results is not None:
+            self.results.close()
+            print(f'Saved {self.results.count} cycles to {self.results.path}')
+            self.results = None  # type: ignore
+        if self.envelopes is not None:
+            report = self.envelopes.report
+            print(f'Last crossfade: {report.commands} commands, {report.skipped} ticks skipped, '
+                  f'written {1000 * report.max_deviation:.3f} ms late at most')
+        self.session = None  # type: ignore
+
+    def end_participant(self, *args):
+        """Save the current participant and go on with the next one in the queue"""
+        self.finish_participant()
+        self.start_participant()
 
     def quit(self, *args):
-        """Save gathered data and close"""
-        if len(self.complete_cycles) > 0:
-            csvdata = Cycle.csv_header() + \
-                ''.join([c.to_csv() for c in self.complete_cycles])
-            print()
-            print(csvdata)
-            filename = datetime.now().strftime('%Y%m%dT%H%M%S') + \
-                f'_{self.complete_cycles[0].participant_name}.csv'
-            with open(filename, 'w') as outfile:
-                outfile.write(csvdata)
-            print(f'Saved {len(self.complete_cycles)} cycles to {filename}')
-
-        winsound.PlaySound(None, 0)  # stop sound
-        self.control.set_olfactory(False, False)
+        """Save gathered data and close, participants left in the queue stay there"""
+        if self.session is not None:
+            self.finish_participant()
+        self.monitor.stop()
+        self.player.stop()
+        if self.player.underruns:
+            print(f'Masking noise ran out {self.player.underruns} times')
         self.control.root.focus_force()
         self.control.experiment_window = None
+        self.control.update_active()
         self.destroy()
 
 
 if __name__ == '__main__':
-    config = Config()
     try:
-        with open('config.toml', 'rb') as config_file:
-            data: dict = tomllib.load(config_file)
-            for key, value in data.items():
-                if type(value) is dict:
-                    for innerkey, innervalue in value.items():
-                        setattr(getattr(config, key), innerkey, innervalue)
-                else:
-                    setattr(config, key, value)
+        config = load_config('config.toml')
     except Exception as e:
         print('Error loading config:')
         print(e)
+        config = Config()
 
     locale.setlocale(locale.LC_ALL, config.locale)
     root = Tk()
@@ -505,7 +641,13 @@ if __name__ == '__main__':
     except Exception as e:
         print(e)
 
-    winsound.PlaySound(None, 0)  # stop sound
+    control_window.scanner.stop()
+    if control_window.store is not None:
+        control_window.store.close()
+    if control_window.experiment_window is not None:
+        control_window.experiment_window.player.stop(timeout=1.0)
 
+    if control_window.device is not None:
+        control_window.device.stop(timeout=2 * control_window.device.ack_timeout)
     if control_window.serial is not None:
         control_window.serial.close()
@@ -0,0 +1,105 @@
+"""Timing quality of the Tk event loop while an experiment runs"""
+from dataclasses import dataclass
+from engine import Cycle
+from math import inf, nan, sqrt
+from time import perf_counter_ns
+from tkinter import Event, Misc
+from tracing import tracer
+
+
+@dataclass
+class RunningStats:
+    """Count, mean, standard deviation and maximum without keeping the samples"""
+    count: int = 0
+    total: float = 0.0
+    total_squares: float = 0.0
+    max: float = nan
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+        self.max = value if self.count == 1 else max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else nan
+
+    @property
+    def sd(self) -> float:
+        if self.count < 2:
+            return nan
+        variance = (self.total_squares - self.total * self.total / self.count) / (self.count - 1)
+        return sqrt(max(variance, 0.0))
+
+
+class LatencyMonitor:
+    """Heartbeat, input and timer latency of the Tk loop, collected per cycle
+
+    The heartbeat is an `after()` callback re-armed every `interval` ms; how
+    late it runs is how long the loop was busy. Input latency compares the
+    event's `time` field with when its handler ran. The two clocks have an
+    unknown offset, so latencies are relative to the fastest event seen
+    (the first click measures 0) and limited to the resolution of the event
+    time, which is coarse on Windows."""
+
+    def __init__(self, widget: Misc, interval: int = 10, stall: float = 0.05):
+        self.widget = widget
+        self.interval = interval
+        """Milliseconds between heartbeats"""
+        self.stall = stall
+        """Heartbeat lateness in seconds traced as a stall"""
+        self.heartbeat = RunningStats()
+        """Heartbeat lateness in seconds"""
+        self.input = RunningStats()
+        """Input event to handler latency in seconds"""
+        self.timers = RunningStats()
+        """Lateness of stage timers in seconds"""
+        self.stalls = 0
+        self._offset = inf
+        """Smallest difference between handler and event time in ms"""
+        self._expected = 0
+        self._handle = None
+
+    def start(self):
+        self._expected = perf_counter_ns() + self.interval * 1_000_000
+        self._handle = self.widget.after(self.interval, self._beat)
+
+    def stop(self):
+        if self._handle is not None:
+            self.widget.after_cancel(self._handle)
+            self._handle = None
+
+    def _beat(self):
+        now = perf_counter_ns()
+        lag = max(now - self._expected, 0) / 1e9
+        self.heartbeat.add(lag)
+        if lag > self.stall:
+            self.stalls += 1
+            tracer.complete('stall', 'monitor', self._expected, now)
+        self._expected = now + self.interval * 1_000_000
+        self._handle = self.widget.after(self.interval, self._beat)
+
+    def input_event(self, event: Event, handled: int) -> float:
+        """Record the latency of `event` handled at `handled` (`perf_counter_ns()`), in seconds"""
+        # event time is a wrapping 32-bit millisecond counter
+        delta = (handled // 1_000_000 - event.time) % (1 << 32)
+        self._offset = min(self._offset, delta)
+        latency = (delta - self._offset) / 1000
+        self.input.add(latency)
+        tracer.instant('input', 'monitor', handled, latency=latency)
+        return latency
+
+    def timer_fired(self, scheduled: int, fired: int):
+        """Record a stage timer due at `scheduled` running at `fired`, both `perf_counter_ns()`"""
+        self.timers.add(max(fired - scheduled, 0) / 1e9)
+
+    def attach(self, cycle: Cycle):
+        """Store the statistics since the previous cycle in `cycle` and start over"""
+        cycle.loop_lag_max = self.heartbeat.max
+        cycle.loop_jitter = self.heartbeat.sd
+        cycle.input_latency_max = self.input.max
+        cycle.timer_late_max = self.timers.max
+        self.heartbeat = RunningStats()
+        self.input = RunningStats()
+        self.timers = RunningStats()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Run experiment sessions on several olfactory devices from one process
+
+Each station runs its participants one after another, either synthetic
+ones or real ones from a queue file whose clicks arrive as lines naming
+their station, e.g. from a button box or typed at the console."""
+import argparse
+import asyncio
+from collections import deque
+import csv
+from dataclasses import dataclass, field
+from datetime import datetime
+from device import CHANNEL_COUNT, Command, OlfactoryDevice, SerialWorker
+from engine import Config, Cycle, Participant, Session, Stage, load_config
+from math import nan
+import os
+import random
+from results import ResultWriter
+import serial
+from simulation import Behaviour, SyntheticParticipant
+from statistics import quantiles
+from store import ResultStore
+import sys
+import threading
+from time import perf_counter, perf_counter_ns
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, TextIO
+
+
+class LoopClock:
+    """`engine.Clock` using asyncio timers"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def now(self) -> int:
+        return perf_counter_ns()
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> asyncio.TimerHandle:
+        return self.loop.call_later(delay, callback)
+
+    def cancel(self, handle: asyncio.TimerHandle):
+        handle.cancel()
+
+
+@dataclass
+class StationStats:
+    cycles: int = 0
+    commands: int = 0
+    failed: int = 0
+    """Commands not acknowledged or rejected"""
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=1000))
+    """Round trip of the most recent commands in seconds"""
+
+
+class Station:
+    """One olfactory device running its own sequence of sessions"""
+
+    def __init__(self, name: str, port: str, config: Config,
+                 loop: asyncio.AbstractEventLoop, results_dir: str = '.',
+                 store: Optional[ResultStore] = None):
+        self.name = name
+        self.config = config
+        self.loop = loop
+        self.results_dir = results_dir
+        self.store = store
+        """Shared by all stations on the loop, CSV files in `results_dir` if `None`"""
+        self.store_session = 0
+        self.clock = LoopClock(loop)
+        self.stats = StationStats()
+        self.session: Optional[Session] = None
+        self.results: Optional[ResultWriter] = None
+        self.serial = serial.serial_for_url(port, 115200, timeout=0.1, write_timeout=None)
+        self.worker = SerialWorker(
+            self.serial, notify=lambda: loop.call_soon_threadsafe(self.worker.dispatch))
+        self.worker.start()
+        self.olfactory = OlfactoryDevice(
+            self.worker.submit, max(CHANNEL_COUNT, config.channels), config.intensity,
+            cancel=self.worker.cancel)
+
+    def set_channels(self, channels: int,
+                     on_done: Optional[Callable[[Command], None]] = None,
+                     at: int = 0) -> Optional[Command]:
+        """`engine.Device` for the station's session"""
+        def done(command: Command):
+            if not command.cancelled:
+                self.stats.commands += 1
+                if command.error:
+                    self.stats.failed += 1
+                else:
+                    self.stats.latencies.append(command.latency)
+            if on_done is not None:
+                on_done(command)
+        return self.olfactory.set_channels(channels, done, at)
+
+    def cancel(self, command: Command) -> bool:
+        return self.olfactory.cancel(command)
+
+    def new_session(self, participant: Participant, scents: List[str]) -> Session:
+        """Prepare a session to `start()` from the event loop"""
+        self.session = Session(self.config, participant, scents, self.clock, self,
+                               on_cycle=self.save_cycle)
+        if self.store is not None:
+            self.store_session = self.store.begin_session(participant, scents,
+                                                          self.session.schedule.digest())
+            return self.session
+        filename = datetime.now().strftime('%Y%m%dT%H%M%S') + \
+            f'_{self.name}_{participant.name}.csv'
+        self.results = ResultWriter(os.path.join(
+            self.results_dir, filename), Cycle.csv_header())
+        return self.session
+
+    def save_cycle(self, cycle: Cycle):
+        self.stats.cycles += 1
+        if self.store is not None:
+            self.store.write(self.store_session, cycle)  # committed in batches
+        else:
+            self.results.write(cycle.to_csv())  # type: ignore
+
+    def finish_session(self):
+        if self.session is not None:
+            self.session.finish()
+            self.session = None
+        if self.results is not None:
+            self.results.close()
+            self.results = None
+
+    def click(self, timestamp: int = 0):
+        """Participant input, may be called from any thread"""
+        timestamp = timestamp or perf_counter_ns()
+        if not self.loop.is_closed():  # input may outlive the run
+            self.loop.call_soon_threadsafe(self._click, timestamp)
+
+    def _click(self, timestamp: int):
+        if self.session is not None:
+            self.session.click(timestamp)
+
+    def close(self):
+        self.finish_session()
+        self.worker.stop(timeout=2 * self.worker.ack_timeout)
+        self.worker.dispatch()
+        self.serial.close()
+
+
+def summary(stations: List[Station], elapsed: float) -> Dict[str, Any]:
+    """Throughput and command latency per station and over all stations"""
+    def latency_stats(latencies: List[float]) -> Dict[str, float]:
+        if len(latencies) < 2:
+            return {'p50': nan, 'p95': nan, 'max': max(latencies, default=nan)}
+        cuts = quantiles(latencies, n=20)
+        return {'p50': cuts[9], 'p95': cuts[18], 'max': max(latencies)}
+
+    result: Dict[str, Any] = {'stations': {}}
+    everything: List[float] = []
+    for station in stations:
+        latencies = list(station.stats.latencies)
+        everything.extend(latencies)
+        result['stations'][station.name] = {
+            'cycles': station.stats.cycles,
+            'commands': station.stats.commands,
+            'failed': station.stats.failed,
+            'latency': latency_stats(latencies),
+        }
+    cycles = sum(station.stats.cycles for station in stations)
+    result['cycles'] = cycles
+    result['cycles_per_minute'] = 60 * cycles / elapsed if elapsed > 0 else nan
+    result['latency'] = latency_stats(everything)
+    return result
+
+
+def load_queue(path: str, station_count: int) -> List[List[Participant]]:
+    """Participants of each station, in order, from a CSV file
+
+    The columns are station (from 1), name, gender, age and smokes, with a
+    header line naming them."""
+    queues: List[List[Participant]] = [[] for _ in range(station_count)]
+    with open(path, newline='', encoding='utf-8') as file:
+        for line, row in enumerate(csv.DictReader(file), 2):
+            try:
+                station = int(row['station'])
+                participant = Participant(row['name'], row['gender'], int(row['age']),
+                                          row['smokes'])
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f'{path}:{line}: expected station, name, gender, age and '
+                                 f'smokes ({e})') from e
+            if not 1 <= station <= station_count:
+                raise ValueError(f'{path}:{line}: station {station} of {station_count}')
+            queues[station - 1].append(participant)
+    return queues
+
+
+def read_clicks(stations: List[Station], lines: TextIO):
+    """Click for each line naming a station, by number (from 1) or name, until end of input"""
+    by_name = {station.name: station for station in stations}
+    for line in lines:
+        key = line.strip()
+        if key.isdigit() and 1 <= int(key) <= len(stations):
+            key = stations[int(key) - 1].name
+        if key in by_name:
+            by_name[key].click()
+        elif key:
+            print(f'No station {key!r}', file=sys.stderr)
+
+
+async def run_simulated(config: Config, ports: List[str], participants: int,
+                        behaviour: Behaviour, seed: Optional[int] = None,
+                        results_dir: str = '.', report_interval: float = 10.0,
+                        store: Optional[ResultStore] = None) -> Dict[str, Any]:
+    """Run `participants` synthetic participants on every device in parallel"""
+    loop = asyncio.get_running_loop()
+    stations = [Station(f'station{i + 1}', port, config, loop, results_dir, store)
+                for i, port in enumerate(ports)]
+    rng = random.Random(seed)
+
+    async def run_station(station: Station):
+        for index in range(participants):
+            finished = loop.create_future()
+            participant = Participant(f'{station.name}sim{index:03d}', 'Other',
+                                      rng.randint(18, 70), 'Prefer not to answer')
+            session = station.new_session(participant, config.scents[:config.channels])
+            SyntheticParticipant(session, station.clock, behaviour,
+                                 random.Random(rng.getrandbits(64)),
+                                 session.schedule.batch_size,
+                                 on_finish=lambda: finished.set_result(None))
+            session.start()
+            await finished
+            station.finish_session()
+    return await run_stations(stations, run_station, report_interval, store)
+
+
+async def run_queued(config: Config, ports: List[str], queues: List[List[Participant]],
+                     clicks: TextIO, results_dir: str = '.', report_interval: float = 10.0,
+                     store: Optional[ResultStore] = None) -> Dict[str, Any]:
+    """Run each station's queue of real participants, one balanced batch each
+
+    Clicks are read from `clicks` on a thread, see `read_clicks()`."""
+    loop = asyncio.get_running_loop()
+    stations = [Station(f'station{i + 1}', port, config, loop, results_dir, store)
+                for i, port in enumerate(ports)]
+    threading.Thread(target=read_clicks, args=(stations, clicks), name='Clicks',
+                     daemon=True).start()
+
+    async def run_station(station: Station, queue: List[Participant]):
+        for participant in queue:
+            finished = loop.create_future()
+            session = station.new_session(participant, config.scents[:config.channels])
+
+            def stage_changed(old_stage: Stage, new_stage: Stage, session=session,
+                              finished=finished):
+                if new_stage != Stage.START:
+                    return
+                if session.completed_count >= session.schedule.batch_size:
+                    if not finished.done():
+                        finished.set_result(None)
+                    return
+                print(f'{station.name}: {session.participant.name} on cycle '
+                      f'{session.completed_count + 1} of {session.schedule.batch_size}, '
+                      'click to start')
+            session.on_stage = stage_changed
+            session.start()
+            await finished
+            station.finish_session()
+            print(f'{station.name}: {participant.name} done')
+    queued = dict(zip(stations, queues))
+    return await run_stations(stations, lambda station: run_station(station, queued[station]),
+                              report_interval, store)
+
+
+async def run_stations(stations: List[Station], run_station: Callable[[Station], Awaitable[None]],
+                       report_interval: float = 10.0,
+                       store: Optional[ResultStore] = None) -> Dict[str, Any]:
+    """Run `run_station` for every station in parallel and close them, returns the `summary()`"""
+    started = perf_counter()
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            stats = summary(stations, perf_counter() - started)
+            print(f'{stats["cycles"]} cycles, {stats["cycles_per_minute"]:.1f}/min, '
+                  f'latency p95 {1000 * stats["latency"]["p95"]:.2f} ms')
+
+    reporter = asyncio.create_task(report())
+    try:
+        await asyncio.gather(*[run_station(station) for station in stations])
+    finally:
+        reporter.cancel()
+        for station in stations:
+            station.close()
+        if store is not None:
+            store.commit()
+    return summary(stations, perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ports', nargs='+', help='serial port of each station')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('-n', '--participants', type=int, default=1,
+                        help='synthetic participants per station')
+    source.add_argument('--queue', help='CSV file of real participants with columns station, '
+                        'name, gender, age and smokes; clicks are lines on standard input '
+                        'naming the station by number or name')
+    parser.add_argument('--config', help='TOML configuration, e.g. config.toml')
+    parser.add_argument('--delay', type=float, nargs=2, metavar=('MIN', 'MAX'),
+                        help='override the random delay of `TIME_*` stages')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--results', default='.', help='directory for result files')
+    parser.add_argument('--store', help='SQLite database for the results instead of CSV files')
+    args = parser.parse_args()
+
+    config = load_config(args.config) if args.config else Config()
+    if args.delay:
+        config.delay.min, config.delay.max = args.delay
+    queues = load_queue(args.queue, len(args.ports)) if args.queue else None
+    store = ResultStore(args.store) if args.store else None
+    if queues is not None:
+        stats = asyncio.run(run_queued(config, args.ports, queues, sys.stdin, args.results,
+                                       store=store))
+    else:
+        stats = asyncio.run(run_simulated(config, args.ports, args.participants,
+                                          Behaviour(), args.seed, args.results, store=store))
+    if store is not None:
+        store.close()
+    for name, station in stats['stations'].items():
+        print(f'{name}: {station["cycles"]} cycles, {station["commands"]} commands '
+              f'({station["failed"]} failed), latency p50 {1000 * station["latency"]["p50"]:.2f} ms')
+    print(f'Total: {stats["cycles"]} cycles, {stats["cycles_per_minute"]:.1f} cycles/min, '
+          f'latency p50 {1000 * stats["latency"]["p50"]:.2f} ms, '
+          f'p95 {1000 * stats["latency"]["p95"]:.2f} ms, max {1000 * stats["latency"]["max"]:.2f} ms')
@@ -0,0 +1,124 @@
+"""Serial port discovery on a background thread"""
+from dataclasses import dataclass
+import os
+import queue
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+
+ARDUINO_IDS = {
+    0x2341: None,    # Arduino SA
+    0x2A03: None,    # Arduino.org
+    0x1A86: 0x7523,  # CH340 USB serial on Arduino UNO clones
+}
+"""USB vendor ID and product ID (`None` for any) of boards running the firmware"""
+
+LAST_PORT_FILE = 'last_port.txt'
+
+
+@dataclass(frozen=True)
+class Port:
+    device: str
+    description: str = ''
+    vid: Optional[int] = None
+    pid: Optional[int] = None
+
+    @property
+    def is_arduino(self) -> bool:
+        if self.vid not in ARDUINO_IDS:
+            return False
+        pid = ARDUINO_IDS[self.vid]
+        return pid is None or pid == self.pid
+
+    @property
+    def label(self) -> str:
+        """Text shown in the port list, starting with the device path"""
+        return f'{self.device} - {self.description}' + (' (Arduino)' if self.is_arduino else '')
+
+
+class PortScanner(threading.Thread):
+    """Lists serial ports periodically and reports which appeared or disappeared
+
+    Changes are collected until the owner calls `changes()`, so the GUI only
+    touches the list from its own thread."""
+
+    def __init__(self, interval: float = 2.0):
+        super().__init__(name='PortScanner', daemon=True)
+        self.interval = interval
+        """Seconds between scans"""
+        self.ports: Dict[str, Port] = {}
+        """Ports found by the last scan, by device path"""
+        self._scans: queue.SimpleQueue[Tuple[Dict[str, Port], List[Port]]] = queue.SimpleQueue()
+        """Ports found by each scan that changed something, and the ones it found gone"""
+        self._reported: Dict[str, Port] = {}
+        """Ports as of the last `changes()`, which the owner acted on"""
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def rescan(self):
+        """Scan now instead of waiting for the interval"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def changes(self) -> Optional[Tuple[List[Port], List[Port]]]:
+        """Added and removed ports since the last call, `None` if nothing changed
+
+        A port unplugged and back between two calls is reported removed and
+        added, as a connection to it is broken."""
+        found = None
+        gone: Set[str] = set()
+        while True:
+            try:
+                found, lost = self._scans.get_nowait()
+            except queue.Empty:
+                break
+            gone.update(port.device for port in lost)
+        if found is None:
+            return None
+        reported = self._reported
+        self._reported = found
+        added = [port for device, port in found.items()
+                 if reported.get(device) != port or device in gone]
+        removed = [port for device, port in reported.items()
+                   if device not in found or device in gone]
+        if not added and not removed:
+            return None
+        return added, removed
+
+    def _scanned(self, found: Dict[str, Port]):
+        """Take the ports found by a scan, by device path"""
+        changed = any(self.ports.get(device) != port for device, port in found.items())
+        removed = [port for device, port in self.ports.items() if device not in found]
+        self.ports = found
+        if changed or removed:
+            self._scans.put((found, removed))
+
+    def run(self):
+        # imported here, enumerating the ports is the slow part of starting the GUI
+        from serial.tools import list_ports
+        while not self._stopped:
+            self._scanned({p.device: Port(p.device, p.description, p.vid, p.pid)
+                           for p in list_ports.comports()})
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+def load_last_port() -> str:
+    """Device path of the port connected last time, empty if none"""
+    try:
+        with open(LAST_PORT_FILE) as file:
+            return file.read().strip()
+    except OSError:
+        return ''
+
+
+def save_last_port(device: str):
+    try:
+        with open(LAST_PORT_FILE + '.tmp', 'w') as file:
+            file.write(device + '\n')
+        os.replace(LAST_PORT_FILE + '.tmp', LAST_PORT_FILE)
+    except OSError:
+        pass  # reconnecting automatically is only a convenience
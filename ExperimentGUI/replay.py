@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""Record every input of a session and replay it deterministically
+
+A `Recorder` sits between a `Session` and its clock and device: it logs
+each `now()` value, timer firing, click, command written and the
+firmware's replies to it. `Replay` feeds the log back into a new `Session`
+and an `OlfactoryDevice` encoder, as fast as possible or at the original
+speed, and compares the cycles and command bytes with the recorded ones.
+A difference means a change to the state machine or the encoder altered
+the outcome of the session."""
+import argparse
+import base64
+from dataclasses import asdict, dataclass, fields
+from device import CHANNEL_COUNT, Ack, AckKind, Command, DeviceState, OlfactoryDevice
+from engine import Clock, Config, Cycle, Device, Participant, Session, Stage
+import json
+from math import isnan
+from schedule import Schedule
+import sys
+from time import perf_counter_ns, sleep
+from typing import Any, Callable, Dict, List, Optional
+
+
+VERSION = 1
+RECORDED = [f.name for f in fields(Cycle) if f.name != 'start_date']
+"""`Cycle` fields logged, the wall clock date differs between runs"""
+UNCOMPARED = {'loop_lag_max', 'loop_jitter', 'input_latency_max', 'timer_late_max'}
+"""Filled in by the GUI's `LatencyMonitor`, which a replay does not have"""
+_CONFIG = ('balanced_count', 'intensity', 'crossfade', 'precise_timing', 'channels')
+"""`Config` values the session depends on"""
+
+
+class RecordingClock:
+    """`engine.Clock` logging every value and timer firing of another clock"""
+
+    def __init__(self, clock: Clock, events: List[list]):
+        self.clock = clock
+        self.events = events
+        self._timers = 0
+
+    def now(self) -> int:
+        now = self.clock.now()
+        self.events.append(['now', now])
+        return now
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> Any:
+        timer = self._timers
+        self._timers += 1
+
+        def fired():
+            self.events.append(['timer', timer, self.clock.now()])
+            callback()
+        return self.clock.call_later(delay, fired)
+
+    def cancel(self, handle: Any):
+        self.clock.cancel(handle)
+
+
+class RecordingDevice:
+    """`engine.Device` logging the commands of another device and their completion"""
+
+    def __init__(self, device: Device, clock: Clock, events: List[list]):
+        self.device = device
+        self.clock = clock
+        """Time of completions, not logged as `now()` values"""
+        self.events = events
+        self._ids: Dict[int, int] = {}
+        """Index of each command by `id()`"""
+        self._commands: List[Command] = []
+        """Keeps the commands alive, so their `id()` is not reused"""
+
+    def set_channels(self, channels: int,
+                     on_done: Optional[Callable[[Command], None]] = None,
+                     at: int = 0) -> Optional[Command]:
+        index = len(self._commands)
+
+        def done(command: Command):
+            self.events.append([
+                'done', index, self.clock.now(), command.queued, command.sent,
+                command.acknowledged, command.error, command.cancelled,
+                [[ack.kind.name, ack.channel, ack.intensity, ack.received] for ack in command.acks]])
+            if on_done is not None:
+                on_done(command)
+        command = self.device.set_channels(channels, done, at)
+        if command is None:
+            self.events.append(['command', None, '', at])
+            return None
+        self._ids[id(command)] = index
+        self._commands.append(command)
+        self.events.append(['command', index, command.data.decode('ascii'), at])
+        return command
+
+    def cancel(self, command: Command) -> bool:
+        cancelled = self.device.cancel(command)
+        self.events.append(['cancel', self._ids.get(id(command)), cancelled])
+        return cancelled
+
+
+class Recorder:
+    """Runs a `Session` and logs its inputs for `Replay`
+
+    Clicks and the end of the session go through `click()` and `finish()`.
+    Crossfades are played by an `EnvelopePlayer` outside the session's
+    device, so sessions with envelopes cannot be recorded."""
+
+    def __init__(self, config: Config, participant: Participant, scents: List[str],
+                 schedule: Schedule, clock: Clock, device: Device,
+                 olfactory: Optional[OlfactoryDevice] = None,
+                 on_stage: Optional[Callable[[Stage, Stage], None]] = None,
+                 on_cycle: Optional[Callable[[Cycle], None]] = None):
+        self.clock = clock
+        self.on_cycle = on_cycle
+        state = olfactory.expected if olfactory is not None else None
+        self.header = {
+            'version': VERSION,
+            'config': {name: getattr(config, name) for name in _CONFIG},
+            'participant': asdict(participant),
+            'scents': scents,
+            'schedule': base64.b64encode(schedule.to_bytes()).decode('ascii'),
+            'channel_count': olfactory.encoder.channel_count if olfactory is not None
+            else max(CHANNEL_COUNT, len(scents)),
+            'device': [list(state.intensities), state.next_intensity] if state is not None else None,
+        }
+        """Everything the session starts from besides the events"""
+        self.events: List[list] = []
+        self.session = Session(config, participant, scents, RecordingClock(clock, self.events),
+                               RecordingDevice(device, clock, self.events),
+                               on_stage=on_stage, on_cycle=self.cycle, schedule=schedule)
+
+    def cycle(self, cycle: Cycle):
+        self.events.append(['cycle', [getattr(cycle, name) for name in RECORDED]])
+        if self.on_cycle is not None:
+            self.on_cycle(cycle)
+
+    def start(self):
+        self.session.start()
+
+    def click(self, timestamp: int = 0):
+        self.events.append(['click', timestamp, self.clock.now()])
+        self.session.click(timestamp)
+
+    def finish(self):
+        self.events.append(['finish', None, self.clock.now()])
+        self.session.finish()
+
+    def save(self, path: str):
+        """Write the log, call after `finish()` outside time-critical code"""
+        with open(path, 'w') as file:
+            json.dump(self.header | {'events': self.events}, file, separators=(',', ':'))
+
+
+class ReplayDivergence(Exception):
+    """The replayed session asked for an input the recorded one did not"""
+
+
+class ReplayClock:
+    """`engine.Clock` returning the recorded `now()` values, timers fired by `Replay`"""
+
+    def __init__(self, replay: 'Replay'):
+        self.replay = replay
+        self.timers: Dict[int, Callable[[], Any]] = {}
+        self._timers = 0
+
+    def now(self) -> int:
+        return self.replay.take('now')[1]
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> int:
+        timer = self._timers
+        self._timers += 1
+        self.timers[timer] = callback
+        return timer
+
+    def cancel(self, handle: int):
+        self.timers.pop(handle, None)
+
+
+class ReplayDevice:
+    """`engine.Device` encoding commands like the device did, completed with the recorded replies"""
+
+    def __init__(self, replay: 'Replay', channel_count: int, intensity: int,
+                 state: Optional[DeviceState]):
+        self.replay = replay
+        self.olfactory = OlfactoryDevice(self._submit, channel_count, intensity, cancel=self._cancel)
+        self.olfactory.assume(state)
+        self.commands: Dict[int, Command] = {}
+        """Replayed commands by recorded index"""
+        self._recorded: list = []
+        self._cancelled = False
+
+    def set_channels(self, channels: int,
+                     on_done: Optional[Callable[[Command], None]] = None,
+                     at: int = 0) -> Optional[Command]:
+        self._recorded = self.replay.take('command')
+        command = self.olfactory.set_channels(channels, on_done, at)
+        if (command is None) != (self._recorded[1] is None):
+            raise ReplayDivergence(f'command {self._recorded[2]!r} recorded, '
+                                   f'{command.data if command else None!r} replayed')
+        return command
+
+    def _submit(self, data: bytes, on_done: Optional[Callable[[Command], None]],
+                at: int) -> Command:
+        _, index, recorded, recorded_at = self._recorded
+        self.replay.report.commands += 1
+        if data.decode('ascii') != recorded or at != recorded_at:
+            self.replay.report.command_mismatches += 1
+        command = Command(data, on_done, at=at)
+        self.commands[index] = command
+        return command
+
+    def cancel(self, command: Command) -> bool:
+        self._cancelled = self.replay.take('cancel')[2]
+        cancelled = self.olfactory.cancel(command)
+        if cancelled != self._cancelled:
+            raise ReplayDivergence(f'cancel {"succeeded" if self._cancelled else "failed"} recorded, '
+                                   f'{"succeeded" if cancelled else "failed"} replayed')
+        return cancelled
+
+    def _cancel(self, command: Command) -> bool:
+        command.cancelled = self._cancelled
+        return self._cancelled
+
+    def complete(self, event: list):
+        """Fill in a command from a recorded `done` event and pass it on"""
+        _, index, _, queued, sent, acknowledged, error, cancelled, acks = event
+        command = self.commands.pop(index)
+        command.queued, command.sent, command.acknowledged = queued, sent, acknowledged
+        command.error, command.cancelled = error, cancelled
+        command.acks = [Ack(AckKind[kind], channel, intensity, received)
+                        for kind, channel, intensity, received in acks]
+        if command.on_done is not None:
+            command.on_done(command)
+
+
+@dataclass
+class ReplayReport:
+    events: int = 0
+    """Recorded events consumed"""
+    cycles: int = 0
+    cycle_mismatches: int = 0
+    commands: int = 0
+    command_mismatches: int = 0
+    """Commands whose bytes or scheduled time differ from the recorded ones"""
+    diverged: str = ''
+    """Why the replay stopped early, empty if it consumed the whole log"""
+    elapsed: float = 0.0
+    """Seconds the replay took"""
+
+    @property
+    def ok(self) -> bool:
+        return not (self.cycle_mismatches or self.command_mismatches or self.diverged)
+
+
+def _same(recorded: Any, replayed: Any) -> bool:
+    if isinstance(recorded, float) and isinstance(replayed, float):
+        return recorded == replayed or (isnan(recorded) and isnan(replayed))
+    return recorded == replayed
+
+
+class Replay:
+    """Runs a recorded session again from its log, see `Recorder`"""
+
+    def __init__(self, log: Dict[str, Any]):
+        if log.get('version') != VERSION:
+            raise ValueError('Not a session log or unsupported version')
+        self.log = log
+        self.events: List[list] = log['events']
+        self.position = 0
+        self.report = ReplayReport()
+
+    @staticmethod
+    def load(path: str) -> 'Replay':
+        with open(path) as file:
+            return Replay(json.load(file))
+
+    def take(self, kind: str) -> list:
+        """Next event, which must be of `kind`"""
+        if self.position >= len(self.events):
+            raise ReplayDivergence(f'{kind} replayed after the end of the log')
+        event = self.events[self.position]
+        if event[0] != kind:
+            raise ReplayDivergence(f'{event[0]} recorded, {kind} replayed at event {self.position}')
+        self.position += 1
+        return event
+
+    def cycle(self, cycle: Cycle):
+        recorded = self.take('cycle')[1]
+        self.report.cycles += 1
+        if not all(_same(value, getattr(cycle, name)) for name, value in zip(RECORDED, recorded)
+                   if name not in UNCOMPARED):
+            self.report.cycle_mismatches += 1
+
+    def run(self, speed: float = 0.0) -> ReplayReport:
+        """Replay the whole log, `speed` 1 at the original pace, 0 as fast as possible"""
+        log = self.log
+        config = Config()
+        for name, value in log['config'].items():
+            setattr(config, name, value)
+        state = DeviceState(tuple(log['device'][0]), log['device'][1]) if log['device'] else None
+        clock = ReplayClock(self)
+        device = ReplayDevice(self, log['channel_count'], config.intensity, state)
+        started = perf_counter_ns()
+        first = None
+        try:
+            session = Session(config, Participant(**log['participant']), log['scents'], clock, device,
+                              on_cycle=self.cycle,
+                              schedule=Schedule.from_bytes(base64.b64decode(log['schedule'])))
+            session.start()
+            while self.position < len(self.events):
+                event = self.events[self.position]
+                if event[0] not in ('timer', 'click', 'done', 'finish'):
+                    raise ReplayDivergence(f'{event[0]} recorded, not replayed at event {self.position}')
+                self.position += 1
+                if speed > 0:
+                    # the third value of these events is the recorded clock's time
+                    first = event[2] if first is None else first
+                    sleep(max(started + (event[2] - first) / speed - perf_counter_ns(), 0) / 1e9)
+                match event[0]:
+                    case 'timer':
+                        if event[1] not in clock.timers:
+                            raise ReplayDivergence(f'timer {event[1]} fired but was cancelled')
+                        clock.timers.pop(event[1])()
+                    case 'click':
+                        session.click(event[1])
+                    case 'done':
+                        device.complete(event)
+                    case 'finish':
+                        session.finish()
+        except ReplayDivergence as error:
+            self.report.diverged = str(error)
+        self.report.events = self.position
+        self.report.elapsed = (perf_counter_ns() - started) / 1e9
+        return self.report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('logs', nargs='+', metavar='LOG', help='.replay.json file of a session')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='1 for the original pace, 0 (default) as fast as possible')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the functions the replays spent most time in')
+    args = parser.parse_args()
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+    failed = 0
+    for path in args.logs:
+        report = Replay.load(path).run(args.speed)
+        failed += not report.ok
+        print(f'{path}: {"ok" if report.ok else "DIFFERS"}, {report.events} events, '
+              f'{report.cycles} cycles ({report.cycle_mismatches} differ), '
+              f'{report.commands} commands ({report.command_mismatches} differ) '
+              f'in {1000 * report.elapsed:.1f} ms')
+        if report.diverged:
+            print(f'  diverged: {report.diverged}')
+    if args.profile:
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Crash-safe storage of experiment results in CSV files"""
+from array import array
+from dataclasses import fields
+from datetime import datetime, timedelta
+from engine import Cycle
+import os
+import sys
+from time import monotonic
+from typing import Dict, Iterator, List
+
+
+class ResultWriter:
+    """Appends each completed cycle to a CSV file as soon as it is known
+
+    Every line is flushed to the OS immediately and synchronised to disk at
+    most every `fsync_interval` seconds, so a crash loses at most the line
+    being written. Use `repair()` to remove it afterwards."""
+
+    def __init__(self, path: str, header: str, fsync_interval: float = 5.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        """Seconds between `os.fsync()` calls, 0 to synchronise every line"""
+        self.count = 0
+        """Cycles written by this writer"""
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a')
+        self._synced = monotonic()
+        if new_file:
+            self._file.write(header)
+            self._sync()
+
+    def write(self, line: str):
+        """Append one line produced by `Cycle.to_csv()`"""
+        self._file.write(line)
+        self._file.flush()
+        self.count += 1
+        if monotonic() - self._synced >= self.fsync_interval:
+            self._sync()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._sync()
+        self._file.close()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_EPOCH = datetime(1970, 1, 1)
+_TEXT = ('participant_name', 'gender', 'smokes', 'scent1', 'scent2')
+_NUMBERS = [f.name for f in fields(Cycle)
+            if f.name not in _TEXT and f.name not in ('start_date', 'age', 'start_ns')]
+
+
+class CycleBuffer:
+    """Completed cycles of one participant packed into arrays, for back-to-back participants
+
+    A cycle takes one row of doubles; the participant and scent names are
+    stored once and referenced by index. Iterating rebuilds each `Cycle`,
+    `clear()` empties the buffer for the next participant."""
+
+    def __init__(self):
+        self._starts = array('q')
+        """Microseconds from 1970 of each `start_date`, which is naive local time"""
+        self._numbers = array('d')
+        """`_NUMBERS` fields of each cycle, in that order"""
+        self._texts = array('H')
+        """Indices into `_names` of the `_TEXT` fields and the age of each cycle"""
+        self._names: List[str] = []
+        self._indices: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def _index(self, name: str) -> int:
+        if name not in self._indices:
+            self._indices[name] = len(self._names)
+            self._names.append(name)
+        return self._indices[name]
+
+    def append(self, cycle: Cycle):
+        self._starts.append((cycle.start_date - _EPOCH) // timedelta(microseconds=1))
+        self._numbers.extend(getattr(cycle, name) for name in _NUMBERS)
+        self._texts.extend(self._index(getattr(cycle, name)) for name in _TEXT)
+        self._texts.append(self._index(str(cycle.age)))
+
+    def __iter__(self) -> Iterator[Cycle]:
+        numbers, texts = len(_NUMBERS), len(_TEXT) + 1
+        for row, start in enumerate(self._starts):
+            name, gender, smokes, scent1, scent2, age = \
+                (self._names[index] for index in self._texts[row * texts:(row + 1) * texts])
+            yield Cycle(_EPOCH + timedelta(microseconds=start), name, gender, int(age), smokes,
+                        scent1, scent2,
+                        *self._numbers[row * numbers:(row + 1) * numbers])  # type: ignore
+
+    def clear(self):
+        del self._starts[:]
+        del self._numbers[:]
+        del self._texts[:]
+        self._names.clear()
+        self._indices.clear()
+
+
+def repair(path: str) -> int:
+    """Truncate an incomplete last line left by a crash, returns removed byte count"""
+    with open(path, 'rb+') as file:
+        size = file.seek(0, os.SEEK_END)
+        position = size
+        chunk = 4096
+        while position > 0:
+            start = max(0, position - chunk)
+            file.seek(start)
+            data = file.read(position - start)
+            newline = data.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            position = start
+        else:
+            end = 0
+        if end != size:
+            file.truncate(end)
+            os.fsync(file.fileno())
+        return size - end
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'repair':
+        print(f'Usage: {sys.argv[0]} repair FILE...')
+        sys.exit(1)
+    for path in sys.argv[2:]:
+        removed = repair(path)
+        if removed:
+            print(f'{path}: removed incomplete line ({removed} bytes)')
+        else:
+            print(f'{path}: complete')
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Seeded trial schedule computed before a session starts
+
+A schedule holds the ordering and the three `TIME_*` delays of every cycle,
+so a session can be audited beforehand and replayed on another station.
+An ordering is the channel turned on first and the one switched to; every
+batch holds each ordered pair of channels `balanced_count` times, so the
+batch grows with the square of the channel count, not its factorial."""
+import argparse
+from array import array
+from dataclasses import dataclass, field
+from functools import lru_cache
+import hashlib
+import random
+import struct
+import sys
+from typing import List, Optional, Tuple
+
+
+MAGIC = b'OLFS'
+VERSION = 2
+_HEADER = struct.Struct('<4sHQIddI')
+"""Magic, version, seed, balanced count, delay min and max, cycle count"""
+_CHANNELS = struct.Struct('<H')
+"""Channel count following the header since version 2, version 1 had two channels"""
+
+
+@lru_cache(maxsize=None)
+def ordered_pairs(channel_count: int) -> List[Tuple[int, int]]:
+    """First and second channel (from 0) of every ordering, indexed by `Schedule.orderings`
+
+    For two channels ordering 1 is the reversed one, as in version 1 files."""
+    return [(first, second) for first in range(channel_count)
+            for second in range(channel_count) if first != second]
+
+
+def _little_endian(values: array) -> array:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+@dataclass
+class Schedule:
+    seed: int
+    balanced_count: int
+    """Number of each ordering in a balanced batch"""
+    delay_min: float
+    delay_max: float
+    channel_count: int = 2
+    orderings: array = field(default_factory=lambda: array('B'))
+    """Index into `ordered_pairs(channel_count)`, one per cycle"""
+    delays: array = field(default_factory=lambda: array('d'))
+    """Seconds of `TIME_ON`, `TIME_SW` and `TIME_OFF`, three per cycle"""
+
+    def __len__(self) -> int:
+        return len(self.orderings)
+
+    @property
+    def batch_size(self) -> int:
+        return len(ordered_pairs(self.channel_count)) * self.balanced_count
+
+    def cycle(self, index: int) -> Tuple[int, float, float, float]:
+        """Ordering and delays of cycle `index`, extending the schedule if needed"""
+        while index >= len(self):
+            self.extend()
+        on, sw, off = self.delays[3 * index:3 * index + 3]
+        return self.orderings[index], on, sw, off
+
+    def channels(self, index: int) -> Tuple[int, int]:
+        """First and second channel (from 0) of cycle `index`"""
+        return ordered_pairs(self.channel_count)[self.cycle(index)[0]]
+
+    def extend(self, batches: int = 1):
+        """Append balanced batches, each drawn from its own seed so they never depend on each other"""
+        count = len(ordered_pairs(self.channel_count))
+        for _ in range(batches):
+            batch = len(self) // self.batch_size
+            rng = random.Random(f'{self.seed}/{batch}')
+            # highest first, so two channels draw the same batches as version 1
+            orderings = [ordering for ordering in reversed(range(count))
+                         for _ in range(self.balanced_count)]
+            rng.shuffle(orderings)
+            self.orderings.extend(orderings)
+            self.delays.extend(rng.uniform(self.delay_min, self.delay_max)
+                               for _ in range(3 * self.batch_size))
+
+    def problems(self) -> List[str]:
+        """Reasons the schedule is not balanced or out of bounds, empty if valid"""
+        result = []
+        if len(self.delays) != 3 * len(self):
+            result.append(f'{len(self.delays)} delays for {len(self)} cycles')
+        count = len(ordered_pairs(self.channel_count))
+        for index, ordering in enumerate(self.orderings):
+            if ordering >= count:
+                result.append(f'ordering of cycle {index} is {ordering} of {count}')
+        for start in range(0, len(self) - self.batch_size + 1, self.batch_size):
+            batch = self.orderings[start:start + self.batch_size]
+            for ordering in range(count):
+                if batch.count(ordering) != self.balanced_count:
+                    first, second = ordered_pairs(self.channel_count)[ordering]
+                    result.append(f'batch at cycle {start} has {batch.count(ordering)} of '
+                                  f'{first + 1} -> {second + 1}, not {self.balanced_count}')
+        for index, delay in enumerate(self.delays):
+            if not self.delay_min <= delay <= self.delay_max:
+                result.append(f'delay {index % 3} of cycle {index // 3} is {delay:.3f} s')
+        return result
+
+    def digest(self) -> str:
+        """Short fingerprint to confirm two stations run the same schedule"""
+        return hashlib.sha256(self.to_bytes()).hexdigest()[:16]
+
+    def to_bytes(self) -> bytes:
+        header = _HEADER.pack(MAGIC, VERSION, self.seed, self.balanced_count,
+                              self.delay_min, self.delay_max, len(self))
+        return header + _CHANNELS.pack(self.channel_count) + self.orderings.tobytes() + \
+            _little_endian(self.delays).tobytes()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Schedule':
+        if len(data) < _HEADER.size:
+            raise ValueError('Not a schedule file')
+        magic, version, seed, balanced_count, delay_min, delay_max, cycles = \
+            _HEADER.unpack_from(data)
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError('Not a schedule file or unsupported version')
+        offset = _HEADER.size
+        channel_count = 2
+        if version >= 2:
+            if len(data) < offset + _CHANNELS.size:
+                raise ValueError('Schedule file is truncated')
+            channel_count, = _CHANNELS.unpack_from(data, offset)
+            offset += _CHANNELS.size
+        orderings = array('B', data[offset:offset + cycles])
+        delays = array('d', data[offset + cycles:offset + cycles + 24 * cycles])
+        if len(orderings) != cycles or len(delays) != 3 * cycles:
+            raise ValueError('Schedule file is truncated')
+        return Schedule(seed, balanced_count, delay_min, delay_max, channel_count,
+                        orderings, _little_endian(delays))
+
+    def save(self, path: str):
+        with open(path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    @staticmethod
+    def load(path: str) -> 'Schedule':
+        with open(path, 'rb') as file:
+            return Schedule.from_bytes(file.read())
+
+
+def generate(balanced_count: int, delay_min: float, delay_max: float,
+             seed: Optional[int] = None, batches: int = 1, channel_count: int = 2) -> Schedule:
+    """Schedule of `batches` balanced batches, with a random seed if not given"""
+    if not 2 <= channel_count <= 9:
+        raise ValueError('Schedules need 2 to 9 channels')
+    if seed is None:
+        seed = random.getrandbits(63)
+    schedule = Schedule(seed, balanced_count, delay_min, delay_max, channel_count)
+    schedule.extend(batches)
+    return schedule
+
+
+if __name__ == '__main__':
+    from engine import Config, load_config
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config', default='config.toml')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('generate', help='write a new schedule file')
+    create.add_argument('output')
+    create.add_argument('--seed', type=int)
+    create.add_argument('--batches', type=int, default=1)
+    show = commands.add_parser('show', help='print and check a schedule file')
+    show.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        try:
+            config = load_config(args.config)
+        except OSError:
+            config = Config()
+        schedule = generate(config.balanced_count, config.delay.min, config.delay.max,
+                            args.seed, args.batches, config.channels)
+        schedule.save(args.output)
+        print(f'Saved {len(schedule)} cycles with seed {schedule.seed} to {args.output}')
+    else:
+        schedule = Schedule.load(args.path)
+        print(f'seed {schedule.seed}, {len(schedule)} cycles, {schedule.channel_count} channels, '
+              f'balanced count {schedule.balanced_count}, '
+              f'delays {schedule.delay_min}-{schedule.delay_max} s, digest {schedule.digest()}')
+        pairs = ordered_pairs(schedule.channel_count)
+        for index in range(len(schedule)):
+            ordering, on, sw, off = schedule.cycle(index)
+            first, second = pairs[ordering] if ordering < len(pairs) else (-1, -1)
+            print(f'{index:4d} {first + 1} -> {second + 1} {on:6.3f} {sw:6.3f} {off:6.3f}')
+        problems = schedule.problems()
+        for problem in problems:
+            print(f'INVALID {problem}')
+        sys.exit(1 if problems else 0)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Headless experiment sessions on a virtual clock with synthetic participants
+
+A process runs 700 to 1000 participants of ten cycles per second, about
+15 µs per stage. The time is spread over the stage logic, the device state
+tracking, the simulated device and participant and the event queue, with
+no single hot spot left, so larger runs need `simulate_parallel()` to
+spread them over processes: tens of thousands per second take 16 or more
+cores."""
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from device import CHANNEL_COUNT, Ack, AckKind, Command, OlfactoryDevice
+from engine import Config, Cycle, Participant, Session, Stage
+import heapq
+import os
+import random
+from schedule import ordered_pairs
+import sys
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+STARTED = datetime(2000, 1, 1)
+"""Date of the first simulated session, each next participant starts an hour later"""
+
+
+class VirtualClock:
+    """`engine.Clock` where time only advances when the next event is run"""
+
+    def __init__(self):
+        self.time = 0
+        """Current virtual time in nanoseconds"""
+        self._events: List[list] = []
+        self._sequence = 0
+
+    def now(self) -> int:
+        return self.time
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> list:
+        # [time, sequence, callback], sequence keeps events at the same time in order
+        event = [self.time + int(delay * 1e9), self._sequence, callback]
+        self._sequence += 1
+        heapq.heappush(self._events, event)
+        return event
+
+    def cancel(self, handle: list):
+        handle[2] = None
+
+    def run(self, until: Optional[int] = None):
+        """Run events in time order until none are left or the next is after `until`"""
+        events = self._events
+        while events:
+            if until is not None and events[0][0] > until:
+                self.time = until
+                return
+            time, _, callback = heapq.heappop(events)
+            if callback is None:
+                continue
+            self.time = time
+            callback()
+
+
+class SimulatedDevice(OlfactoryDevice):
+    """`engine.Device` acknowledging commands after a fixed latency"""
+
+    def __init__(self, clock: VirtualClock, latency: float = 0.002, intensity: int = 10,
+                 channel_count: int = CHANNEL_COUNT):
+        super().__init__(self.acknowledge_later, channel_count, intensity, cancel=self.cancel_later)
+        self.clock = clock
+        self.latency = latency
+        """Seconds from write to acknowledgement"""
+        self.commands = 0
+        self._next_intensity = 10
+        self._replies: Dict[Tuple[bytes, int], Tuple[Tuple[Ack, ...], int]] = {}
+        """Acknowledgements and the next intensity after them, for each command and next intensity"""
+
+    def replies(self, data: bytes) -> Tuple[Ack, ...]:
+        """Acknowledgements the firmware sends for `data`, the same few commands repeat every cycle"""
+        key = (data, self._next_intensity)
+        if key not in self._replies:
+            acks = []
+            next_intensity = self._next_intensity
+            for byte in data:
+                if byte == ord('0'):
+                    acks.append(Ack(AckKind.OFF))
+                elif ord('1') <= byte <= ord('9'):
+                    acks.append(Ack(AckKind.ON, byte - ord('0'), next_intensity))
+                else:
+                    next_intensity = byte - ord('A') + 1
+                    acks.append(Ack(AckKind.INTENSITY, intensity=next_intensity))
+            self._replies[key] = tuple(acks), next_intensity
+        acks, self._next_intensity = self._replies[key]
+        return acks
+
+    def acknowledge_later(self, data: bytes,
+                          on_done: Optional[Callable[[Command], None]] = None,
+                          at: int = 0) -> Command:
+        command = Command(data, on_done, queued=self.clock.now(), at=at)
+        self.commands += 1
+        command.acks.extend(self.replies(data))
+
+        def acknowledge():
+            if command.cancelled:
+                command.error = 'Cancelled'
+            else:
+                command.sent = max(command.queued, command.at)
+                command.acknowledged = self.clock.now()
+            if on_done is not None:
+                on_done(command)
+        wait = max(command.at - command.queued, 0) / 1e9
+        self.clock.call_later(wait + self.latency, acknowledge)
+        return command
+
+    def cancel_later(self, command: Command) -> bool:
+        """Cancel a command not written yet in virtual time"""
+        if max(command.queued, command.at) <= self.clock.now():
+            return False
+        command.cancelled = True
+        return True
+
+
+@dataclass
+class Behaviour:
+    """Statistical model of a synthetic participant, times in seconds"""
+    reaction_mean: float = 1.5
+    reaction_sd: float = 0.5
+    reaction_min: float = 0.15
+    premature: float = 0.05
+    """Probability of clicking during a `TIME_*` stage"""
+    start_delay: float = 1.0
+    """Time to click on the start prompt"""
+
+
+class SyntheticParticipant:
+    """Clicks through a `Session` according to a `Behaviour`"""
+
+    def __init__(self, session: Session, clock: VirtualClock, behaviour: Behaviour,
+                 rng: random.Random, cycles: int,
+                 on_finish: Optional[Callable[[], None]] = None):
+        self.session = session
+        self.clock = clock
+        self.behaviour = behaviour
+        self.rng = rng
+        self.cycles = cycles
+        """Cycles to complete before finishing the session"""
+        self.on_finish = on_finish
+        """Called after the session finished"""
+        self._click = None
+        session.on_stage = self.stage_changed
+
+    def stage_changed(self, old_stage: Stage, new_stage: Stage):
+        if self._click is not None:
+            self.clock.cancel(self._click)
+            self._click = None
+        behaviour = self.behaviour
+        match new_stage:
+            case Stage.START:
+                if self.session.completed_count >= self.cycles:
+                    self.clock.call_later(0, self.finish)
+                    return
+                delay = behaviour.start_delay
+            case Stage.TIME_ON | Stage.TIME_SW | Stage.TIME_OFF:
+                if self.rng.random() >= behaviour.premature:
+                    return
+                config = self.session.config
+                delay = self.rng.uniform(0, config.delay.max)
+            case _:
+                delay = max(behaviour.reaction_min,
+                            self.rng.gauss(behaviour.reaction_mean, behaviour.reaction_sd))
+        self._click = self.clock.call_later(delay, self.click)
+
+    def click(self):
+        self._click = None
+        self.session.click()
+
+    def finish(self):
+        self.session.finish()
+        if self.on_finish is not None:
+            self.on_finish()
+
+
+def simulate(config: Config, participants: int, behaviour: Behaviour = Behaviour(),
+             seed: Optional[int] = None, latency: float = 0.002,
+             on_cycle: Optional[Callable[[Cycle], None]] = None) -> int:
+    """Run sessions of one balanced batch each, returns number of cycles"""
+    return _simulate_range(config, 0, participants, behaviour, seed, latency, on_cycle)
+
+
+def _simulate_range(config: Config, first: int, last: int, behaviour: Behaviour,
+                    seed: Optional[int], latency: float,
+                    on_cycle: Optional[Callable[[Cycle], None]]) -> int:
+    rng = random.Random(f'{seed}/{first}' if seed is not None else None)
+    completed = 0
+    for index in range(first, last):
+        clock = VirtualClock()
+        participant = Participant(f'sim{index:06d}', 'Other', rng.randint(18, 70),
+                                  'Prefer not to answer')
+        session = Session(config, participant, config.scents[:config.channels], clock,
+                          SimulatedDevice(clock, latency, config.intensity,
+                                          max(CHANNEL_COUNT, config.channels)), on_cycle=on_cycle,
+                          rng=random.Random(rng.getrandbits(64)),
+                          started=STARTED + timedelta(hours=index))
+        SyntheticParticipant(session, clock, behaviour, rng,
+                             session.schedule.batch_size)
+        session.start()
+        clock.run()
+        completed += session.completed_count
+    return completed
+
+
+def _count_orderings(config: Config, first: int, last: int, behaviour: Behaviour,
+                     seed: Optional[int], latency: float) -> Tuple[int, Counter]:
+    orderings = Counter()
+
+    def count(cycle: Cycle):
+        orderings[cycle.scent1, cycle.scent2] += 1
+    return _simulate_range(config, first, last, behaviour, seed, latency, count), orderings
+
+
+def simulate_parallel(config: Config, participants: int, behaviour: Behaviour = Behaviour(),
+                      seed: Optional[int] = None, latency: float = 0.002,
+                      jobs: Optional[int] = None) -> Tuple[int, Counter]:
+    """Split participants over processes, returns number of cycles and count of each scent ordering"""
+    jobs = jobs or os.cpu_count() or 1
+    bounds = [participants * i // jobs for i in range(jobs + 1)]
+    cycles, orderings = 0, Counter()
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_count_orderings, config, first, last, behaviour, seed, latency)
+                   for first, last in zip(bounds, bounds[1:]) if last > first]
+        for future in futures:
+            count, ordering = future.result()
+            cycles += count
+            orderings.update(ordering)
+    return cycles, orderings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--participants', type=int, default=1000)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--premature', type=float, default=Behaviour.premature,
+                        help='probability of a premature click per stage')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='worker processes, defaults to CPU count')
+    parser.add_argument('--channels', type=int, default=Config.channels,
+                        help='scented channels, every ordered pair is balanced')
+    parser.add_argument('--csv', help='write cycles to this file (single process)')
+    args = parser.parse_args()
+
+    config = Config()
+    config.channels = args.channels
+    config.scents = [f'Undefined {channel + 1}' for channel in range(args.channels)]
+    behaviour = Behaviour(premature=args.premature)
+    started = perf_counter()
+    if args.csv:
+        orderings = Counter()
+        with open(args.csv, 'w') as output:
+            output.write(Cycle.csv_header())
+
+            def collect(cycle: Cycle):
+                orderings[cycle.scent1, cycle.scent2] += 1
+                output.write(cycle.to_csv())
+            cycles = simulate(config, args.participants, behaviour,
+                              args.seed, on_cycle=collect)
+    else:
+        cycles, orderings = simulate_parallel(config, args.participants, behaviour,
+                                              args.seed, jobs=args.jobs)
+    elapsed = perf_counter() - started
+
+    print(f'{args.participants} participants, {cycles} cycles in {elapsed:.3f} s '
+          f'({args.participants / elapsed:.0f} participants/s)')
+    for (scent1, scent2), count in sorted(orderings.items()):
+        print(f'  {scent1} -> {scent2}: {count}')
+    batch_size = len(ordered_pairs(config.channels)) * config.balanced_count
+    sys.exit(0 if cycles == args.participants * batch_size else 1)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Results of all sessions in one indexed SQLite database"""
+import argparse
+from dataclasses import fields
+from datetime import datetime
+from engine import Cycle, Participant
+import locale
+from math import nan
+import sqlite3
+import sys
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+
+FIELDS = [f.name for f in fields(Cycle) if f.name != 'start_ns']
+"""`Cycle` fields stored, in `Cycle.to_csv()` order"""
+TEXT_FIELDS = {'start_date', 'participant_name', 'gender', 'smokes', 'scent1', 'scent2'}
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    participant TEXT NOT NULL,
+    gender TEXT,
+    age INTEGER,
+    smokes TEXT,
+    scents TEXT,
+    schedule TEXT
+);
+CREATE TABLE IF NOT EXISTS cycles (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions(id),
+    pair TEXT NOT NULL,
+    {', '.join(f'{name} {"TEXT" if name in TEXT_FIELDS else "INTEGER" if name == "age" else "REAL"}'
+               for name in FIELDS)}
+);
+CREATE INDEX IF NOT EXISTS sessions_participant ON sessions(participant, started);
+CREATE INDEX IF NOT EXISTS cycles_session ON cycles(session);
+CREATE INDEX IF NOT EXISTS cycles_participant ON cycles(participant_name, start_date);
+CREATE INDEX IF NOT EXISTS cycles_pair ON cycles(pair, start_date);
+CREATE INDEX IF NOT EXISTS cycles_ordering ON cycles(scent1, scent2, start_date);
+CREATE INDEX IF NOT EXISTS cycles_date ON cycles(start_date);
+'''
+"""`sessions.scents` is the scent on each channel separated by ' / ', `cycles.pair` the
+scents of a cycle in either order and `scent1` and `scent2` its ordering"""
+
+
+def scent_pair(scent1: str, scent2: str) -> str:
+    """Same key for both orderings of two scents"""
+    return ' / '.join(sorted([scent1, scent2]))
+
+
+class ResultStore:
+    """Appends cycles to an SQLite database shared by all sessions
+
+    The database runs in WAL mode, so analysis can read while an experiment
+    writes. Rows are inserted in one open transaction, committed every
+    `batch_size` rows or on `commit()`, which the owner calls when nothing
+    is time critical, e.g. between cycles. A crash loses the uncommitted
+    rows only. Use from one thread."""
+
+    def __init__(self, path: str, batch_size: int = 100):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = 0
+        """Rows inserted since the last commit"""
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent, commits skip fsync
+        self._connection.executescript(SCHEMA)
+
+    def begin_session(self, participant: Participant, scents: List[str], schedule: str = '',
+                      started: Optional[datetime] = None) -> int:
+        """Record a new session, returns its id for `write()`"""
+        started = started or datetime.now()
+        cursor = self._connection.execute(
+            'INSERT INTO sessions (started, participant, gender, age, smokes, scents, schedule) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (started.isoformat(), participant.name, participant.gender, participant.age,
+             participant.smokes, ' / '.join(scents), schedule))
+        self._inserted()
+        return cursor.lastrowid  # type: ignore
+
+    def write(self, session: int, cycle: Cycle):
+        """Insert a completed cycle of `session`"""
+        values = [getattr(cycle, name) for name in FIELDS]
+        values[0] = cycle.start_date.isoformat()
+        self._connection.execute(
+            f'INSERT INTO cycles (session, pair, {", ".join(FIELDS)}) '
+            f'VALUES (?, ?, {", ".join("?" * len(FIELDS))})',
+            [session, scent_pair(cycle.scent1, cycle.scent2)] + values)
+        self._inserted()
+
+    def _inserted(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self._connection.in_transaction:
+            self._connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sessions(self, participant: str) -> List[Tuple[str, int]]:
+        """Start and number of cycles of each session of `participant`, oldest first"""
+        return self._connection.execute(
+            'SELECT started, (SELECT COUNT(*) FROM cycles WHERE cycles.session = sessions.id) '
+            'FROM sessions WHERE participant = ? ORDER BY started', (participant,)).fetchall()
+
+    def cycles(self, participant: Optional[str] = None, scents: Optional[Tuple[str, str]] = None,
+               ordered: bool = False, since: Optional[datetime] = None,
+               until: Optional[datetime] = None) -> List[Cycle]:
+        """Cycles matching all given filters, oldest first
+
+        `scents` matches both orderings unless `ordered`, when it must be
+        the scent turned on first and second."""
+        conditions: List[str] = []
+        parameters: List[Any] = []
+        if participant is not None:
+            conditions.append('participant_name = ?')
+            parameters.append(participant)
+        if scents is not None and ordered:
+            conditions.append('scent1 = ? AND scent2 = ?')
+            parameters.extend(scents)
+        elif scents is not None:
+            conditions.append('pair = ?')
+            parameters.append(scent_pair(*scents))
+        if since is not None:
+            conditions.append('start_date >= ?')
+            parameters.append(since.isoformat())
+        if until is not None:
+            conditions.append('start_date < ?')
+            parameters.append(until.isoformat())
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        rows = self._connection.execute(
+            f'SELECT {", ".join(FIELDS)} FROM cycles{where} ORDER BY start_date, id', parameters)
+        return [self._cycle(row) for row in rows]
+
+    @staticmethod
+    def _cycle(row: Tuple) -> Cycle:
+        values: Dict[str, Any] = dict(zip(FIELDS, row))
+        values['start_date'] = datetime.fromisoformat(values['start_date'])
+        for name, value in values.items():
+            if value is None and name not in TEXT_FIELDS:
+                values[name] = nan  # SQLite stores NaN as NULL
+        return Cycle(**values)
+
+    def export(self, file: TextIO, **filters) -> int:
+        """Write the cycles matching `filters` (see `cycles()`) as `Cycle.to_csv()` lines
+
+        Numbers are formatted with the current `LC_NUMERIC` locale, as the
+        experiment does. Returns the number of cycles written."""
+        cycles = self.cycles(**filters)
+        file.write(Cycle.csv_header())
+        for cycle in cycles:
+            file.write(cycle.to_csv())
+        return len(cycles)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('export', help='write cycles in the session CSV format')
+    command.add_argument('output', nargs='?', help='CSV file, standard output if omitted')
+    command.add_argument('--participant')
+    command.add_argument('--scents', nargs=2, metavar=('SCENT1', 'SCENT2'))
+    command.add_argument('--ordered', action='store_true',
+                         help='only cycles turning on SCENT1 first')
+    command.add_argument('--since', type=datetime.fromisoformat, help='ISO 8601 date')
+    command.add_argument('--until', type=datetime.fromisoformat, help='ISO 8601 date')
+    command.add_argument('--locale', default='it_IT',
+                         help='locale for formatting numbers, as in config.toml')
+    command = commands.add_parser('sessions', help='list the sessions of a participant')
+    command.add_argument('participant')
+    args = parser.parse_args()
+
+    with ResultStore(args.database) as store:
+        match args.command:
+            case 'export':
+                locale.setlocale(locale.LC_NUMERIC, args.locale)
+                filters = {'participant': args.participant,
+                           'scents': tuple(args.scents) if args.scents else None,
+                           'ordered': args.ordered, 'since': args.since, 'until': args.until}
+                if args.output is None:
+                    count = store.export(sys.stdout, **filters)
+                else:
+                    with open(args.output, 'w', encoding='utf-8') as output:
+                        count = store.export(output, **filters)
+                print(f'Exported {count} cycles', file=sys.stderr)
+            case _:
+                for started, cycles in store.sessions(args.participant):
+                    print(f'{started}: {cycles} cycles')
@@ -0,0 +1,72 @@
+from engine import Config, Cycle
+import os
+import pytest
+from simulation import Behaviour, simulate
+
+np = pytest.importorskip('numpy')
+from analysis import Store, read_session, summarise  # noqa: E402
+
+
+def write_session(path, premature: float = 0.2, seed: int = 1) -> list:
+    cycles = []
+    simulate(Config(), 2, Behaviour(premature=premature), seed=seed, on_cycle=cycles.append)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(Cycle.csv_header())
+        for cycle in cycles:
+            file.write(cycle.to_csv())
+    return cycles
+
+
+def test_read_session_matches_cycles(tmp_path):
+    cycles = write_session(tmp_path / 'session.csv')
+    data = read_session(str(tmp_path / 'session.csv'))
+    assert len(data) == len(cycles)
+    assert list(data['scent1']) == [cycle.scent1 for cycle in cycles]
+    assert np.allclose(data['on_reaction'], [cycle.on_reaction for cycle in cycles],
+                       atol=5e-4)  # written with three decimals
+    assert data['start'][0] == np.datetime64(cycles[0].start_date)
+
+
+def test_read_session_decimal_comma(tmp_path):
+    path = tmp_path / 'session.csv'
+    write_session(path)
+    lines = path.read_text().splitlines(keepends=True)
+    comma = tmp_path / 'comma.csv'
+    comma.write_text(lines[0] + ''.join(  # numbers only, dates keep their point
+        ';'.join(fields[:7] + [field.replace('.', ',') for field in fields[7:]])
+        for fields in (line.split(';') for line in lines[1:])))
+    assert np.array_equal(read_session(str(comma))['on_reaction'],
+                          read_session(str(path))['on_reaction'])
+    assert np.array_equal(read_session(str(comma), ',')['off_click'],
+                          read_session(str(path), '.')['off_click'], equal_nan=True)
+
+
+def test_store_skips_ingested_files(tmp_path):
+    for seed in (1, 2):
+        write_session(tmp_path / f'session{seed}.csv', seed=seed)
+    paths = [str(tmp_path / 'session1.csv'), str(tmp_path / 'session2.csv')]
+    store = Store(str(tmp_path / 'store'))
+    assert store.ingest(paths, jobs=1) == 2
+    assert Store(str(tmp_path / 'store')).ingest(paths, jobs=1) == 0
+    with open(paths[0], 'a') as file:
+        file.write('\n')
+    stat = os.stat(paths[0])
+    os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert store.pending(paths) == [os.path.abspath(paths[0])]
+    assert len(store.load()) == sum(len(read_session(path)) for path in paths)
+
+
+def test_summarise_excludes_premature_clicks(tmp_path):
+    cycles = write_session(tmp_path / 'session.csv', premature=0.3)
+    data = read_session(str(tmp_path / 'session.csv'))
+    [entry] = summarise(data, [], 'on_reaction', resamples=200, seed=1)
+    reactions = [cycle.on_reaction for cycle in cycles if cycle.on_reaction >= 0]
+    assert entry['group'] == 'all'
+    assert entry['n'] == len(reactions)
+    assert entry['premature'] == sum(cycle.on_reaction == -1 for cycle in cycles)
+    valid = data['on_reaction'][data['on_reaction'] >= 0].astype(np.float64)
+    assert entry['mean'] == pytest.approx(valid.mean())
+    assert entry['low'] <= entry['mean'] <= entry['high']
+    by_scent = summarise(data, ['scent'], 'on_reaction', resamples=200, seed=1)
+    assert {entry['group'] for entry in by_scent} == set(Config().scents)
+    assert sum(entry['n'] for entry in by_scent) == len(reactions)
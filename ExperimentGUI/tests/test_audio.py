@@ -0,0 +1,52 @@
+from audio import FilePlayer, Sound, load_wav, open_player
+import pytest
+import time
+import wave
+
+
+def write_wav(path, frames: bytes, rate: int = 1000):
+    with wave.open(str(path), 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(rate)
+        file.writeframes(frames)
+
+
+def test_loop_wraps_without_gaps():
+    sound = Sound('', bytes(range(8)), 2, 2, 1000)  # two 4 byte frames
+    assert sound.frame_count == 2
+    assert sound.loop(1, 1) == bytes(range(4, 8))
+    assert sound.loop(1, 4) == bytes(range(4, 8)) + bytes(range(8)) + bytes(range(4))
+
+
+def test_load_wav_rejects_other_files(tmp_path):
+    path = tmp_path / 'noise.wav'
+    path.write_bytes(b'not a wav file')
+    with pytest.raises(ValueError, match='not an uncompressed wav file'):
+        load_wav(str(path))
+
+
+def test_open_player_backends(tmp_path):
+    path = tmp_path / 'noise.wav'
+    write_wav(path, bytes(200))
+    assert isinstance(open_player('none', str(path)), FilePlayer)
+    assert open_player(str(tmp_path / 'out.wav'), str(path)).output == str(tmp_path / 'out.wav')
+    with pytest.raises(ValueError, match='Unknown audio backend'):
+        open_player('speakers', str(path))
+
+
+def test_file_player_writes_the_looped_stream(tmp_path):
+    path = tmp_path / 'noise.wav'
+    frames = bytes(range(200))  # 100 frames, a tenth of a second
+    write_wav(path, frames)
+    output = tmp_path / 'out.wav'
+    player = open_player(str(output), str(path), buffer=0.02)
+    player.start()
+    time.sleep(0.3)
+    player.stop(timeout=1.0)
+    assert not player.is_alive() and player.error == ''
+    with wave.open(str(output), 'rb') as file:
+        written = file.readframes(file.getnframes())
+        assert file.getframerate() == 1000
+    assert len(written) >= 2 * 200  # more than a full loop
+    assert written == (frames * (len(written) // len(frames) + 1))[:len(written)]
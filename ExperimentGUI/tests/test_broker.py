@@ -0,0 +1,61 @@
+import asyncio
+from broker import Broker, ClientState
+from emulator import Emulator
+import os
+import pytest
+import serial
+import sys
+
+
+def test_client_state_follows_the_firmware():
+    state = ClientState(3)
+    replies = [state.apply(command) for command in 'E13\n0J2']
+    assert state.intensities == [0, 10, 0]
+    assert replies[0] == 'Set 50% duty cycle\r\n'
+    assert replies[3] is None
+    assert state.apply('4') == 'Only 3 channels configured\r\n'
+
+
+async def read_lines(reader: asyncio.StreamReader, count: int):
+    return [await asyncio.wait_for(reader.readline(), 2.0) for _ in range(count)]
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+@pytest.mark.skipif(sys.platform == 'win32' or not hasattr(os, 'openpty'),
+                    reason='the emulator needs a pseudo-terminal')
+def test_broker_merges_clients_and_releases_on_disconnect():
+    async def run(emulator: Emulator):
+        link = serial.Serial(emulator.port, 115200, timeout=0.1)
+        broker = Broker(link, asyncio.get_running_loop(), 3)
+        broker.start()
+        server = await asyncio.start_server(broker.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader1, writer1 = await asyncio.open_connection('127.0.0.1', port)
+            reader2, writer2 = await asyncio.open_connection('127.0.0.1', port)
+            await read_lines(reader1, 2)  # banner
+            await read_lines(reader2, 2)
+            writer1.write(b'1')
+            assert await read_lines(reader1, 1) == [b'Turned on channel 1 with 100% duty cycle\r\n']
+            writer2.write(b'E12')
+            assert len(await read_lines(reader2, 3)) == 3
+            assert emulator.intensities == (10, 5, 0)  # the highest on each channel
+            writer1.close()
+            await wait_for(lambda: emulator.intensities == (5, 5, 0))
+            writer2.close()
+            await wait_for(lambda: emulator.intensities == (0, 0, 0))
+        finally:
+            server.close()
+            await server.wait_closed()
+            broker.close()
+            link.close()
+
+    with Emulator(3) as emulator:
+        asyncio.run(run(emulator))
@@ -0,0 +1,107 @@
+from broker import ClientState
+from device import CommandEncoder, DeviceState, OlfactoryDevice, SerialWorker
+from emulator import Emulator, Faults
+import os
+import pytest
+import random
+import serial
+import sys
+from time import perf_counter, sleep
+
+
+def random_intensities(rng: random.Random, channel_count: int):
+    return tuple(rng.choice([0, 0, 1, 5, 10]) for _ in range(channel_count))
+
+
+@pytest.mark.parametrize('channel_count', [2, 3, 9])
+def test_encoder_reaches_every_target(channel_count):
+    encoder = CommandEncoder(channel_count)
+    rng = random.Random(channel_count)
+    for _ in range(500):
+        start = random_intensities(rng, channel_count)
+        next_intensity = rng.randint(1, 10)
+        firmware = ClientState(channel_count)
+        firmware.intensities, firmware.next_intensity = list(start), next_intensity
+        current = rng.choice([None, DeviceState(start, next_intensity)])
+        if current is None:
+            firmware.intensities = [rng.randint(0, 10) for _ in range(channel_count)]
+        target = random_intensities(rng, channel_count)
+        data, expected = encoder.encode(current, target)
+        for char in data.decode('ascii'):
+            firmware.apply(char)
+        assert tuple(firmware.intensities) == target == expected.intensities
+        if expected.next_intensity:  # 0 while unknown
+            assert firmware.next_intensity == expected.next_intensity
+
+
+def test_encoder_does_not_precompute_every_state():
+    started = perf_counter()
+    encoder = CommandEncoder(9)
+    assert encoder.encode(None, (10,) + (0,) * 8)[0] == b'0J1'
+    assert perf_counter() - started < 0.5
+
+
+def test_set_channels_rejects_channels_beyond_the_device():
+    device = OlfactoryDevice(lambda data, on_done, at: None, channel_count=3)  # type: ignore
+    with pytest.raises(ValueError):
+        device.set_channels(1 << 3)
+
+
+def test_redundant_commands_skipped():
+    sent = []
+    device = OlfactoryDevice(lambda data, on_done, at: sent.append(data), channel_count=3)  # type: ignore
+    device.set_intensities((10, 0, 0))
+    device.set_intensities((10, 0, 0))
+    assert sent == [b'0J1']
+
+
+needs_pty = pytest.mark.skipif(sys.platform == 'win32' or not hasattr(os, 'openpty'),
+                               reason='the emulator needs a pseudo-terminal')
+
+
+@needs_pty
+@pytest.mark.parametrize('channel_count', [3, 6])
+def test_commands_against_emulator(channel_count):
+    rng = random.Random(channel_count)
+    with Emulator(channel_count) as emulator:
+        link = serial.Serial(emulator.port, 115200, timeout=0.1)
+        worker = SerialWorker(link)
+        worker.start()
+        device = OlfactoryDevice(worker.submit, channel_count, cancel=worker.cancel)
+        try:
+            for _ in range(30):
+                target = random_intensities(rng, channel_count)
+                completed = []
+                if device.set_intensities(target, completed.append) is not None:
+                    deadline = perf_counter() + 2.0
+                    while not completed and perf_counter() < deadline:
+                        worker.dispatch()
+                        sleep(0.001)
+                    assert completed and not completed[0].error
+                assert emulator.intensities == target
+                assert device.acknowledged is not None
+                assert device.acknowledged.intensities == target
+        finally:
+            worker.stop(timeout=2.0)
+            link.close()
+
+
+@needs_pty
+def test_reply_split_across_read_timeouts():
+    with Emulator(3, Faults(split_reply=0.25)) as emulator:
+        link = serial.Serial(emulator.port, 115200, timeout=0.1)
+        worker = SerialWorker(link, ack_timeout=2.0)
+        worker.start()
+        try:
+            completed = []
+            worker.submit(b'0J1', completed.append)
+            deadline = perf_counter() + 3.0
+            while not completed and perf_counter() < deadline:
+                worker.dispatch()
+                sleep(0.01)
+            assert completed and completed[0].error == ''
+            assert len(completed[0].acks) == 3
+            assert emulator.intensities == (10, 0, 0)
+        finally:
+            worker.stop(timeout=2.0)
+            link.close()
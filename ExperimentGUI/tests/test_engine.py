@@ -0,0 +1,52 @@
+from collections import Counter
+from engine import Config, Cycle, Participant, Session, Stage
+from simulation import Behaviour, SimulatedDevice, VirtualClock, simulate
+
+
+def new_session(config: Config, saved: list):
+    clock = VirtualClock()
+    session = Session(config, Participant('test', 'Other', 30, 'No'), config.scents[:2],
+                      clock, SimulatedDevice(clock), on_cycle=saved.append)
+    return session, clock
+
+
+def test_premature_click_after_armed_command_saves_cycle():
+    saved = []
+    session, clock = new_session(Config(), saved)
+    session.start()
+    while session.stage != Stage.TIME_OFF:
+        if session.stage in (Stage.START, Stage.ACK_ON, Stage.ACK_SW):
+            session.click()
+        else:
+            clock.run(clock.time + 500_000_000)
+    session.click()  # cancels the armed turn off
+    assert session.stage == Stage.START
+    # the simulated device reports the cancelled command when it was due
+    clock.run(clock.time + int(Config().delay.max * 1e9) + 1_000_000_000)
+    assert session.stage == Stage.START
+    assert len(saved) == 1
+    assert saved[0].off_reaction == -1
+
+
+def test_simulation_balances_orderings():
+    config = Config()
+    config.channels = 3
+    config.scents = ['A', 'B', 'C']
+    orderings: Counter = Counter()
+
+    def count(cycle: Cycle):
+        orderings[cycle.scent1, cycle.scent2] += 1
+    cycles = simulate(config, 4, Behaviour(premature=0.2), seed=1, on_cycle=count)
+    assert cycles == 4 * 6 * config.balanced_count
+    assert set(orderings.values()) == {4 * config.balanced_count}
+
+
+def test_simulation_reproducible():
+    def run():
+        lines = []
+        simulate(Config(), 3, Behaviour(premature=0.2), seed=6,
+                 on_cycle=lambda cycle: lines.append(cycle.to_csv()))
+        return lines
+    first = run()
+    assert first == run()
+    assert first[0].startswith('2000-01-01T00:00:00;')
@@ -0,0 +1,41 @@
+from device import OlfactoryDevice
+from envelope import Envelope, EnvelopePlayer, crossfade, ramp
+from simulation import SimulatedDevice, VirtualClock
+
+
+def new_player(budget: float):
+    clock = VirtualClock()
+    simulated = SimulatedDevice(clock)
+    device = OlfactoryDevice(simulated.acknowledge_later, 2, cancel=simulated.cancel_later)
+    return EnvelopePlayer(device, clock, tick=0.05, lead=0.2, budget=budget), clock
+
+
+def test_shapes():
+    assert ramp(1, 2, 10, 1.0, 2).levels(0.5) == (6, 0)
+    assert ramp(2, 2, 10, 1.0, 2).levels(5.0) == (0, 10)
+    assert crossfade(1, 2, 1.0, channel_count=2).levels(0.25) == (8, 2)
+
+
+def test_token_bucket_refills_over_the_envelope():
+    player, clock = new_player(budget=10)
+    # switches channel every tick, 2 bytes each time, far over 10 bytes per second
+    alternate = Envelope(2.0, lambda t: (10, 0) if round(t / 0.05) % 2 == 0 else (0, 10))
+    player.play(alternate)
+    clock.run()
+    report = player.report
+    assert report.ticks == 41
+    assert report.skipped > 0
+    assert report.bytes <= 10 * (2.0 + 0.2) + 3  # budget, initial bucket and the first reset
+    starts = [command.at / 1e9 for command in player._commands]
+    # spread over the whole envelope, not one burst while the bucket was full
+    assert max(b - a for a, b in zip(starts, starts[1:])) < 0.3
+    assert starts[-1] >= 1.8
+    assert report.max_deviation == 0.0
+
+
+def test_last_tick_is_sent_over_budget():
+    player, clock = new_player(budget=1)
+    player.play(ramp(1, 1, 10, 1.0, 2))
+    clock.run()
+    assert player.report.skipped > 0
+    assert player.device.expected.intensities == (10, 0)
@@ -0,0 +1,50 @@
+from engine import Config, Participant, Session, Stage
+from experiment import ExperimentWindow
+from monitor import LatencyMonitor, RunningStats
+from simulation import SimulatedDevice, VirtualClock
+from time import perf_counter_ns
+from types import SimpleNamespace
+
+
+class Text:
+    def set(self, text: str):
+        pass
+
+
+def test_running_stats():
+    stats = RunningStats()
+    for value in (1.0, 2.0, 3.0, 4.0):
+        stats.add(value)
+    assert (stats.count, stats.mean, stats.max) == (4, 2.5, 4.0)
+    assert abs(stats.sd - 1.2909944) < 1e-6
+
+
+def test_input_latency_lands_in_the_clicked_cycle():
+    clock = VirtualClock()
+    clock.time = perf_counter_ns()  # clicks are timed with perf_counter_ns()
+    saved = []
+    window = SimpleNamespace(recorder=None, monitor=LatencyMonitor(None),  # type: ignore
+                             statustext=Text(), cycletext=Text())
+    window.session = Session(Config(), Participant('test', 'Other', 30, 'No'), ['A', 'B'],
+                             clock, SimulatedDevice(clock), on_cycle=saved.append,
+                             on_stage=lambda old, new: ExperimentWindow.stage_changed(
+                                 window, old, new))  # type: ignore
+    window.session.start()
+
+    def click(late_ms: int):
+        """Click with the event `late_ms` older than the handler"""
+        event = SimpleNamespace(time=perf_counter_ns() // 1_000_000 - late_ms)
+        ExperimentWindow.acknowledge(window, event)  # type: ignore
+        clock.run(clock.time + 20_000_000)
+    click(0)  # the fastest event, measuring 0
+    while window.session.stage != Stage.ACK_OFF:
+        if window.session.stage in (Stage.ACK_ON, Stage.ACK_SW):
+            click(0)
+        else:
+            clock.run(clock.time + 500_000_000)
+    click(300)  # the off reaction ends the cycle
+    clock.run(clock.time + 1_000_000_000)
+    assert len(saved) == 1
+    assert saved[0].input_latency_max >= 0.25
+    click(0)
+    assert window.monitor.input.max < 0.25
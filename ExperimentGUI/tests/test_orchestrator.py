@@ -0,0 +1,56 @@
+import asyncio
+from emulator import Emulator
+from engine import Config, Delay
+from orchestrator import load_queue, run_queued
+import os
+import pytest
+import sys
+import threading
+import time
+
+
+def test_load_queue_by_station(tmp_path):
+    path = tmp_path / 'queue.csv'
+    path.write_text('station,name,gender,age,smokes\n'
+                    '2,anna,Female,31,No\n1,bruno,Male,45,Yes\n2,carla,Female,28,No\n')
+    queues = load_queue(str(path), 2)
+    assert [[participant.name for participant in queue] for queue in queues] == \
+        [['bruno'], ['anna', 'carla']]
+    assert queues[0][0].age == 45
+
+
+@pytest.mark.parametrize('row', ['3,anna,Female,31,No', '1,anna,Female,old,No', '1,anna'])
+def test_load_queue_rejects_bad_rows(tmp_path, row):
+    path = tmp_path / 'queue.csv'
+    path.write_text(f'station,name,gender,age,smokes\n1,bruno,Male,45,Yes\n{row}\n')
+    with pytest.raises(ValueError, match=':3:'):
+        load_queue(str(path), 2)
+
+
+@pytest.mark.skipif(sys.platform == 'win32' or not hasattr(os, 'openpty'),
+                    reason='the emulator needs a pseudo-terminal')
+def test_queued_participants_run_one_batch_each(tmp_path):
+    path = tmp_path / 'queue.csv'
+    path.write_text('station,name,gender,age,smokes\n1,anna,Female,31,No\n1,bruno,Male,45,Yes\n')
+    config = Config()
+    config.delay = Delay()
+    config.delay.min, config.delay.max = 0.01, 0.02
+    config.balanced_count = 1
+    done = threading.Event()
+
+    def clicks():
+        # slower than the timed stages, so every click lands on a stage waiting for one
+        while not done.wait(0.1):
+            yield 'station1\n'
+
+    with Emulator(2) as emulator:
+        try:
+            stats = asyncio.run(run_queued(config, [emulator.port], load_queue(str(path), 1),
+                                           clicks(), str(tmp_path), report_interval=60))
+        finally:
+            done.set()
+            time.sleep(0.2)  # the click thread stops before its loop is gone
+    assert stats['cycles'] == 2 * 2  # two orderings of two channels each
+    assert stats['stations']['station1']['failed'] == 0
+    assert len(list(tmp_path.glob('*_station1_anna.csv'))) == 1
+    assert len(list(tmp_path.glob('*_station1_bruno.csv'))) == 1
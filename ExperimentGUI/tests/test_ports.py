@@ -0,0 +1,108 @@
+from engine import Config
+from experiment import ControlWindow
+from ports import Port, PortScanner
+from types import SimpleNamespace
+
+UNO = Port('/dev/ttyACM0', 'Arduino Uno', 0x2341, 0x0043)
+CLONE = Port('/dev/ttyUSB0', 'USB2.0-Serial', 0x1A86, 0x7523)
+OTHER = Port('/dev/ttyS0', 'ttyS0')
+
+
+def scan(scanner: PortScanner, *ports: Port):
+    scanner._scanned({port.device: port for port in ports})
+
+
+def test_arduino_ports_recognised():
+    assert UNO.is_arduino and CLONE.is_arduino and not OTHER.is_arduino
+    assert UNO.label == '/dev/ttyACM0 - Arduino Uno (Arduino)'
+
+
+def test_changes_report_added_and_removed():
+    scanner = PortScanner()
+    assert scanner.changes() is None
+    scan(scanner, UNO, OTHER)
+    assert scanner.changes() == ([UNO, OTHER], [])
+    assert scanner.changes() is None
+    scan(scanner, UNO, OTHER, CLONE)
+    scan(scanner, CLONE)
+    assert scanner.changes() == ([CLONE], [UNO, OTHER])
+
+
+def test_port_plugged_in_and_out_between_calls_not_reported():
+    scanner = PortScanner()
+    scan(scanner, OTHER)
+    scanner.changes()
+    scan(scanner, OTHER, UNO)
+    scan(scanner, OTHER)
+    assert scanner.changes() is None
+
+
+def test_reported_port_gone_again_between_calls_is_removed():
+    scanner = PortScanner()
+    scan(scanner, UNO)
+    scanner.changes()
+    scan(scanner)
+    scan(scanner, UNO)
+    scan(scanner)
+    assert scanner.changes() == ([], [UNO])
+
+
+def test_replugged_port_reported_removed_and_added():
+    scanner = PortScanner()
+    scan(scanner, UNO)
+    scanner.changes()
+    scan(scanner)
+    scan(scanner, UNO)
+    assert scanner.changes() == ([UNO], [UNO])
+
+
+class Var:
+    def __init__(self, value: str = ''):
+        self.value = value
+
+    def get(self) -> str:
+        return self.value
+
+    def set(self, value: str):
+        self.value = value
+
+
+def control_window(scanner: PortScanner):
+    """Stand-in with what `ControlWindow.update_ports()` uses, connecting without a port"""
+    window = SimpleNamespace(scanner=scanner, ports={}, ports_box={}, config=Config(), serial=None,
+                             com_port=Var(), device_text=Var(), last_port=UNO.device,
+                             auto_connect=True, update_active=lambda: None,
+                             root=SimpleNamespace(after=lambda delay, callback: None))
+
+    def connect():
+        window.serial = SimpleNamespace(port=window.com_port.get().split(' - ')[0])
+        window.auto_connect = True
+
+    def disconnect():
+        window.serial = None
+    window.connect, window.disconnect = connect, disconnect
+    window.disconnect_clicked = lambda: ControlWindow.disconnect_clicked(window)  # type: ignore
+    window.update_ports = lambda: ControlWindow.update_ports(window)  # type: ignore
+    return window
+
+
+def test_last_port_reconnected_unless_disconnected_by_operator():
+    scanner = PortScanner()
+    window = control_window(scanner)
+    scan(scanner, UNO)
+    window.update_ports()
+    assert window.serial is not None and window.serial.port == UNO.device
+    scan(scanner)
+    scan(scanner, UNO)  # replugged between two checks
+    window.update_ports()
+    assert window.serial is not None
+    window.disconnect_clicked()
+    scan(scanner, UNO, OTHER)
+    window.update_ports()
+    assert window.serial is None
+    window.connect()
+    scan(scanner)
+    window.update_ports()
+    scan(scanner, UNO)
+    window.update_ports()
+    assert window.serial is not None
@@ -0,0 +1,74 @@
+import json
+import random
+from engine import Config, Participant, Stage
+from replay import Recorder, Replay
+from schedule import generate
+from simulation import Behaviour, SimulatedDevice, SyntheticParticipant, VirtualClock
+
+
+def record(path: str, seed: int, precise_timing: bool = True, channels: int = 2) -> int:
+    """Record a simulated session whose cycles carry monitor fields, like the GUI's"""
+    config = Config()
+    config.precise_timing = precise_timing
+    config.channels = channels
+    config.scents = [f'Scent {channel}' for channel in range(channels)]
+    clock = VirtualClock()
+    device = SimulatedDevice(clock, channel_count=3)
+    schedule = generate(config.balanced_count, 5.0, 10.0, seed, channel_count=channels)
+    saved = []
+    recorder = Recorder(config, Participant('test', 'Other', 30, 'No'), config.scents,
+                        schedule, clock, device, device, on_cycle=saved.append)
+    participant = SyntheticParticipant(recorder.session, clock, Behaviour(premature=0.2),
+                                       random.Random(seed), schedule.batch_size)
+
+    def stage_changed(old_stage: Stage, new_stage: Stage):
+        cycle = recorder.session.current_cycle
+        if new_stage == Stage.START and cycle is not None:
+            # as `LatencyMonitor.attach()`, which a replay does not have
+            cycle.loop_lag_max = cycle.loop_jitter = 0.001
+            cycle.input_latency_max = cycle.timer_late_max = 0.002
+        participant.stage_changed(old_stage, new_stage)
+    recorder.session.on_stage = stage_changed
+
+    def click():
+        participant._click = None
+        recorder.click()
+    participant.click = click  # type: ignore
+    participant.finish = recorder.finish  # type: ignore
+    recorder.start()
+    clock.run()
+    recorder.save(path)
+    return len(saved)
+
+
+def test_replay_matches_recording(tmp_path):
+    for seed, precise_timing, channels in [(1, True, 2), (2, False, 2), (3, True, 3)]:
+        path = str(tmp_path / f'{seed}.replay.json')
+        cycles = record(path, seed, precise_timing, channels)
+        report = Replay.load(path).run()
+        assert report.ok, report
+        assert report.cycles == cycles
+        assert report.events == len(json.load(open(path))['events'])
+
+
+def test_replay_detects_changed_commands(tmp_path):
+    path = str(tmp_path / 'session.replay.json')
+    record(path, 4)
+    with open(path) as file:
+        log = json.load(file)
+    log['config']['intensity'] = 5
+    report = Replay(log).run()
+    assert report.command_mismatches > 0
+    assert not report.ok
+
+
+def test_replay_detects_changed_cycles(tmp_path):
+    path = str(tmp_path / 'session.replay.json')
+    record(path, 5)
+    with open(path) as file:
+        log = json.load(file)
+    for event in log['events']:
+        if event[0] == 'cycle':
+            event[1][-1] += 1.0  # a recorded field the session computes
+    report = Replay(log).run()
+    assert report.cycle_mismatches == report.cycles > 0
@@ -0,0 +1,44 @@
+from engine import Config
+from results import CycleBuffer, ResultWriter, repair
+from simulation import Behaviour, simulate
+
+
+def test_repair_removes_incomplete_line(tmp_path):
+    path = tmp_path / 'results.csv'
+    path.write_bytes(b'header\nline 1\nline 2 cut sho')
+    assert repair(str(path)) == len(b'line 2 cut sho')
+    assert path.read_bytes() == b'header\nline 1\n'
+    assert repair(str(path)) == 0
+    assert path.read_bytes() == b'header\nline 1\n'
+
+
+def test_repair_without_any_newline(tmp_path):
+    path = tmp_path / 'results.csv'
+    path.write_bytes(b'x' * 10000)
+    assert repair(str(path)) == 10000
+    assert path.read_bytes() == b''
+
+
+def test_writer_appends_header_once(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    for _ in range(2):
+        with ResultWriter(path, 'header\n', fsync_interval=0) as writer:
+            writer.write('line\n')
+    with open(path) as file:
+        assert file.read() == 'header\nline\nline\n'
+
+
+def test_cycle_buffer_round_trip():
+    cycles = []
+    simulate(Config(), 3, Behaviour(premature=0.3), seed=2, on_cycle=cycles.append)
+    buffer = CycleBuffer()
+    for cycle in cycles:
+        buffer.append(cycle)
+    assert len(buffer) == len(cycles)
+    restored = list(buffer)
+    assert [cycle.start_date for cycle in restored] == [cycle.start_date for cycle in cycles]
+    assert [cycle.to_csv() for cycle in restored] == [cycle.to_csv() for cycle in cycles]
+    assert any(cycle.on_reaction == -1 or cycle.sw_reaction == -1 or cycle.off_reaction == -1
+               for cycle in restored)
+    buffer.clear()
+    assert len(buffer) == 0 and list(buffer) == []
@@ -0,0 +1,82 @@
+from engine import Config
+from experiment import ExperimentWindow
+import pytest
+from schedule import _CHANNELS, _HEADER, MAGIC, Schedule, generate, ordered_pairs
+from types import SimpleNamespace
+
+
+def test_round_trip(tmp_path):
+    schedule = generate(3, 5.0, 10.0, seed=7, batches=2)
+    assert schedule.problems() == []
+    assert Schedule.from_bytes(schedule.to_bytes()) == schedule
+    path = tmp_path / 'session.schedule'
+    schedule.save(str(path))
+    loaded = Schedule.load(str(path))
+    assert loaded == schedule
+    assert loaded.digest() == schedule.digest()
+
+
+def test_round_trip_of_more_channels():
+    schedule = generate(3, 5.0, 10.0, seed=7, batches=2, channel_count=4)
+    assert schedule.problems() == []
+    assert Schedule.from_bytes(schedule.to_bytes()) == schedule
+
+
+def test_version_1_files_load_as_two_channels():
+    schedule = generate(5, 5.0, 10.0, seed=42)
+    data = schedule.to_bytes()
+    _, _, *fields = _HEADER.unpack_from(data)
+    version_1 = _HEADER.pack(MAGIC, 1, *fields) + data[_HEADER.size + _CHANNELS.size:]
+    loaded = Schedule.from_bytes(version_1)
+    assert loaded.channel_count == 2
+    assert loaded == schedule
+
+
+def test_every_ordered_pair_balanced():
+    schedule = generate(2, 5.0, 10.0, seed=1, channel_count=3)
+    counts = [list(schedule.orderings).count(ordering) for ordering in range(len(ordered_pairs(3)))]
+    assert counts == [2] * 6
+
+
+def test_seed_reproduces_batches():
+    schedule = generate(5, 5.0, 10.0, seed=3)
+    again = generate(5, 5.0, 10.0, seed=3)
+    again.extend()
+    schedule.cycle(len(schedule))  # extends by one batch
+    assert schedule == again
+
+
+def test_truncated_file_rejected():
+    data = generate(5, 5.0, 10.0, seed=1).to_bytes()
+    with pytest.raises(ValueError):
+        Schedule.from_bytes(data[:-8])
+    with pytest.raises(ValueError):
+        Schedule.from_bytes(b'XXXX' + data[4:])
+    for size in (10, _HEADER.size + 1):
+        with pytest.raises(ValueError):
+            Schedule.from_bytes(data[:size])
+
+
+def start_with_schedule(path: str, scents: int) -> str:
+    """Error shown when starting a participant in a stand-in experiment window"""
+    config = Config()
+    config.schedule = path
+    shown = []
+    control = SimpleNamespace(config=config, scents=[f'Scent {channel}' for channel in range(scents)],
+                              queue=['participant'], error_text=SimpleNamespace(set=shown.append))
+    control.next_participant = lambda: control.queue.pop(0)
+    window = SimpleNamespace(control=control, closed=False)
+    window.quit = lambda: setattr(window, 'closed', True)
+    ExperimentWindow.start_participant(window)  # type: ignore
+    assert window.closed
+    assert control.queue == ['participant']
+    return shown[-1]
+
+
+def test_unusable_schedule_closes_the_experiment_window(tmp_path):
+    path = tmp_path / 'session.schedule'
+    path.write_bytes(b'not a schedule')
+    assert start_with_schedule(str(path), 2).startswith(f'Cannot use the schedule {path}')
+    generate(2, 5.0, 10.0, seed=1, channel_count=3).save(str(path))
+    assert start_with_schedule(str(path), 2).endswith('it is for 3 channels, 2 scents are chosen')
+    assert 'No such file' in start_with_schedule(str(tmp_path / 'missing.schedule'), 2)
@@ -0,0 +1,33 @@
+from engine import Config, Participant
+import io
+from simulation import Behaviour, simulate
+from store import ResultStore
+
+
+def test_export_matches_to_csv(tmp_path):
+    cycles = []
+    simulate(Config(), 2, Behaviour(premature=0.3), seed=4, on_cycle=cycles.append)
+    with ResultStore(str(tmp_path / 'results.sqlite'), batch_size=7) as store:
+        session = store.begin_session(Participant('abcdef', 'Other', 30, 'No'), ['A', 'B'])
+        for cycle in cycles:
+            store.write(session, cycle)
+        output = io.StringIO()
+        assert store.export(output) == len(cycles)
+    expected = ''.join(cycle.to_csv() for cycle in cycles)
+    assert output.getvalue() == cycles[0].csv_header() + expected
+
+
+def test_sessions_count_their_cycles(tmp_path):
+    cycles = []
+    simulate(Config(), 1, Behaviour(), seed=5, on_cycle=cycles.append)
+    with ResultStore(str(tmp_path / 'results.sqlite')) as store:
+        participant = Participant('abcdef', 'Other', 30, 'No')
+        first = store.begin_session(participant, ['A', 'B'])
+        for cycle in cycles:
+            store.write(first, cycle)
+        store.begin_session(Participant('ghijkl', 'Other', 30, 'No'), ['A', 'B'])
+        store.begin_session(participant, ['A', 'B'])
+        assert [count for _, count in store.sessions('abcdef')] == [len(cycles), 0]
+        plan = store._connection.execute(
+            'EXPLAIN QUERY PLAN SELECT COUNT(*) FROM cycles WHERE session = 1').fetchall()
+        assert 'cycles_session' in ' '.join(str(row) for row in plan)
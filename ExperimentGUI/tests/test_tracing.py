@@ -0,0 +1,44 @@
+import json
+from tracing import Tracer
+
+
+def test_disabled_records_nothing():
+    tracer = Tracer(4)
+    tracer.instant('click', 'input')
+    assert tracer.drain() == []
+
+
+def test_drain_returns_each_event_once_in_order():
+    tracer = Tracer(8)
+    tracer.enabled = True
+    tracer.instant('click', 'input', 1000, stage='START')
+    tracer.complete('write', 'serial', 2000, 5000)
+    events = tracer.drain()
+    assert [(event[1], event[2], event[3], event[4]) for event in events] == \
+        [(1000, 0, 'i', 'click'), (2000, 3000, 'X', 'write')]
+    assert events[0][7] == {'stage': 'START'}
+    assert tracer.drain() == []
+
+
+def test_lapped_events_are_counted_as_dropped():
+    tracer = Tracer(4)
+    tracer.enabled = True
+    for i in range(10):
+        tracer.instant(f'event{i}', 'test', i + 1)
+    assert [event[4] for event in tracer.drain()] == ['event6', 'event7', 'event8', 'event9']
+    assert tracer.dropped == 6
+
+
+def test_trace_file_is_valid_json(tmp_path):
+    path = tmp_path / 'session.trace.json'
+    tracer = Tracer(16)
+    tracer.start(str(path), interval=0.01)
+    tracer.begin('TIME_ON', 'stage', 1000)
+    tracer.end('TIME_ON', 'stage', 4000)
+    tracer.stop()
+    tracer.instant('after', 'test')  # not recorded once stopped
+    events = json.loads(path.read_text())
+    assert [event['ph'] for event in events if event.get('cat') == 'stage'] == ['B', 'E']
+    assert {event['name'] for event in events if event['ph'] == 'M'} == \
+        {'thread_name', 'process_name'}
+    assert tracer.drain() == []
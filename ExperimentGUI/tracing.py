@@ -0,0 +1,150 @@
+"""In-memory event tracing drained to a Chrome trace (Perfetto) JSON file
+
+Recording stores a tuple in a preallocated ring buffer and never blocks on
+I/O; a background thread formats and writes the events. Open the file in
+https://ui.perfetto.dev or chrome://tracing."""
+from itertools import count
+import json
+import os
+import threading
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+
+Event = Tuple[int, int, int, str, str, str, int, Optional[Dict[str, Any]]]
+"""Index, timestamp and duration in ns, phase, name, category, thread, arguments"""
+
+
+class Tracer:
+    """Ring buffer of trace events, safe to record from any thread"""
+
+    def __init__(self, capacity: int = 1 << 16):
+        assert capacity & (capacity - 1) == 0, 'capacity must be a power of two'
+        self.capacity = capacity
+        self.enabled = False
+        """Recording is skipped while disabled, costing one attribute check"""
+        self.dropped = 0
+        """Events overwritten before they were drained"""
+        self._mask = capacity - 1
+        self._events: List[Optional[Event]] = [None] * capacity
+        self._counter = count()  # next() is atomic, unlike incrementing an int
+        self._drained = 0
+        self._writer: Optional['TraceWriter'] = None
+
+    def _record(self, phase: str, name: str, category: str, timestamp: int,
+                duration: int = 0, args: Optional[Dict[str, Any]] = None):
+        index = next(self._counter)
+        self._events[index & self._mask] = (index, timestamp or perf_counter_ns(), duration,
+                                            phase, name, category, threading.get_ident(), args)
+
+    def instant(self, name: str, category: str, timestamp: int = 0, **args):
+        """Event at `timestamp` (`perf_counter_ns()`, now if 0)"""
+        if self.enabled:
+            self._record('i', name, category, timestamp, 0, args or None)
+
+    def complete(self, name: str, category: str, start: int, end: int, **args):
+        """Event lasting from `start` to `end`"""
+        if self.enabled:
+            self._record('X', name, category, start, end - start, args or None)
+
+    def begin(self, name: str, category: str, timestamp: int = 0, **args):
+        """Start of a span on this thread, closed by `end()`"""
+        if self.enabled:
+            self._record('B', name, category, timestamp, 0, args or None)
+
+    def end(self, name: str, category: str, timestamp: int = 0):
+        if self.enabled:
+            self._record('E', name, category, timestamp)
+
+    def drain(self) -> List[Event]:
+        """Events recorded since the last drain, oldest first; call from one thread only"""
+        events = []
+        while True:
+            event = self._events[self._drained & self._mask]
+            if event is None or event[0] < self._drained:
+                return events  # not recorded yet
+            if event[0] > self._drained:
+                # lapped by the recorders, skip to the oldest event still buffered
+                oldest = event[0] - self.capacity + 1
+                self.dropped += oldest - self._drained
+                self._drained = oldest
+                continue
+            events.append(event)
+            self._drained += 1
+
+    def start(self, path: str, interval: float = 0.5):
+        """Enable recording and write events to `path` every `interval` seconds"""
+        self.stop()
+        self._writer = TraceWriter(self, path, interval)
+        self._writer.start()
+        self.enabled = True
+
+    def stop(self):
+        """Disable recording and write the remaining events"""
+        self.enabled = False
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+
+
+class TraceWriter(threading.Thread):
+    """Drains a `Tracer` to a file in the Chrome trace JSON array format
+
+    Every event is written as soon as it is drained; the format allows the
+    closing bracket to be missing, so the file stays readable after a crash."""
+
+    def __init__(self, tracer: Tracer, path: str, interval: float = 0.5):
+        super().__init__(name='TraceWriter', daemon=True)
+        self.tracer = tracer
+        self.path = path
+        self.interval = interval
+        self._file: TextIO = open(path, 'w')
+        self._file.write('[\n')
+        self._pid = os.getpid()
+        self._threads: Dict[int, str] = {}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.write(self.tracer.drain())
+        self.write(self.tracer.drain())
+        if self.tracer.dropped:
+            self.write_event({'ph': 'i', 'name': f'{self.tracer.dropped} events dropped',
+                              'cat': 'trace', 'ts': perf_counter_ns() / 1000, 's': 'g',
+                              'pid': self._pid, 'tid': 0})
+        # last event without the trailing comma, closing the array
+        self._file.write(json.dumps({'ph': 'M', 'name': 'process_name', 'pid': self._pid,
+                                     'args': {'name': 'experiment'}}) + ']\n')
+        self._file.close()
+
+    def write(self, events: List[Event]):
+        for _, timestamp, duration, phase, name, category, thread, args in events:
+            if thread not in self._threads:
+                self._name_thread(thread)
+            event: Dict[str, Any] = {'ph': phase, 'name': name, 'cat': category,
+                                     'ts': timestamp / 1000, 'pid': self._pid, 'tid': thread}
+            if phase == 'X':
+                event['dur'] = duration / 1000
+            elif phase == 'i':
+                event['s'] = 't'
+            if args is not None:
+                event['args'] = args
+            self.write_event(event)
+        self._file.flush()
+
+    def write_event(self, event: Dict[str, Any]):
+        self._file.write(json.dumps(event, default=str) + ',\n')
+
+    def _name_thread(self, thread: int):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        self._threads[thread] = names.get(thread, str(thread))
+        self.write_event({'ph': 'M', 'name': 'thread_name', 'pid': self._pid, 'tid': thread,
+                          'args': {'name': self._threads[thread]}})
+
+
+tracer = Tracer()
+"""Tracer shared by the engine, the serial worker and the GUI"""
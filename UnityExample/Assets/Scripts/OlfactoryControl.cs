@@ -2,6 +2,7 @@ using System;
 using System.Collections;
 using System.Collections.Generic;
 using System.IO.Ports;
+using System.Net.Sockets;
 using System.Text;
 using Unity.Collections;
 using UnityEditor;
@@ -14,9 +15,12 @@ using UnityEngine.UI;
 public class OlfactoryControl : MonoBehaviour
 {
     public string portName;
+    public int brokerPort = 0; // port of broker.py on this computer, 0 to open portName directly
     int baudRate = 115200;
 
     static SerialPort serialPort;
+    static TcpClient brokerClient;
+    static NetworkStream brokerStream;
 
     int intensity1 = 10;
     int intensity2 = 10;
@@ -27,25 +31,65 @@ public class OlfactoryControl : MonoBehaviour
         OpenPort();
     }
 
+    void Update()
+    {
+        // Discard the broker's replies so they do not pile up
+        if (brokerStream != null && brokerStream.DataAvailable)
+        {
+            byte[] buffer = new byte[1024];
+            brokerStream.Read(buffer, 0, buffer.Length);
+        }
+    }
+
     void OnApplicationQuit()
     {
-        serialPort.Close();
+        // Either may be null if opening it failed in Start
+        if (IsOpen())
+        {
+            Write("0"); // Leave no channel on
+        }
+        if (brokerClient != null)
+        {
+            brokerClient.Close();
+        }
+        if (serialPort != null)
+        {
+            serialPort.Close();
+        }
+    }
+
+    bool IsOpen()
+    {
+        return brokerClient != null ? brokerClient.Connected : serialPort != null && serialPort.IsOpen;
+    }
+
+    void Write(string command)
+    {
+        if (brokerStream != null)
+        {
+            byte[] data = Encoding.ASCII.GetBytes(command);
+            brokerStream.Write(data, 0, data.Length);
+        }
+        else
+        {
+            serialPort.Write(command);
+        }
     }
 
     public void SetOlfactory(bool channel1, bool channel2)
     {
-        if (serialPort != null && serialPort.IsOpen)
+        if (IsOpen())
         {
-            serialPort.Write("0"); // Reset all channels
+            Write("0"); // Reset all channels
             if (channel1)
             {
                 char intensityChar = (char)(intensity1 - 1 + 'A');
-                serialPort.Write(String.Format("{0}1", intensityChar)); // Enable channel 1
+                Write(String.Format("{0}1", intensityChar)); // Enable channel 1
             }
             if (channel2)
             {
                 char intensityChar = (char)(intensity2 - 1 + 'A');
-                serialPort.Write(String.Format("{0}2", intensityChar)); // Enable channel 2
+                Write(String.Format("{0}2", intensityChar)); // Enable channel 2
             }
         }
         else
@@ -56,6 +100,15 @@ public class OlfactoryControl : MonoBehaviour
 
     void OpenPort()
     {
+        if (brokerPort > 0)
+        {
+            // Shares the device with the experiment GUI through broker.py
+            brokerClient = new TcpClient("127.0.0.1", brokerPort);
+            brokerClient.NoDelay = true;
+            brokerStream = brokerClient.GetStream();
+            print("Connected to broker");
+            return;
+        }
         serialPort = new SerialPort(portName, baudRate);
         // serialPort.DtrEnable = false;  // This can be used to prevent the Arduino from resetting on connection, add 10uF capacitor between RST and GND
         serialPort.ReadTimeout = 15;